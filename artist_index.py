@@ -0,0 +1,175 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# default location of the artist index (stored in the home directory so every run shares it)
+ARTIST_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.genius_link_artists.sqlite')
+
+# number of artists kept in memory in front of the database
+LRU_SIZE = 4096
+
+# number of songs in a row a group of artists has to resolve with the same artist rule before the links of the other
+# rule are only probed if none of its own links exist
+CONFIRMATIONS = 2
+
+
+def artists_key(artists):
+    """
+    Determines the key corrections of a group of artists are stored under
+    :param artists: list of spotify artist objects in the order spotify lists them
+    :return: key string, None if any of the artists has no spotify id (local files)
+    """
+
+    ids = [artist.get('id') for artist in artists]
+    if not ids or not all(ids):
+        return None
+    return ','.join(ids)
+
+
+def artist_rule(variant):
+    """
+    Determines the artist rule of a variant, the title rules applied on top of it depend on the song and not the artists
+    :param variant: name of the variant such as 'main_artist+without_container' or 'without_slash'
+    :return: 'main_artist' or 'all_artists'
+    """
+
+    return 'main_artist' if variant.split('+', 1)[0] == 'main_artist' else 'all_artists'
+
+
+class ArtistIndex:
+    """
+    Persistent index mapping spotify artist ids to the words of their genius slug, with a bounded in-memory LRU in
+    front of it, along with corrections learned about groups of artists (such as a pair which only resolves as the
+    primary artist)
+    """
+
+    def __init__(self, path=ARTIST_INDEX_PATH, lru_size=LRU_SIZE):
+        """
+        Opens (and creates if needed) the index database
+        :param path: location of the database file (':memory:' keeps the index in memory only)
+        :param lru_size: number of artists kept in memory
+        """
+
+        self.path = path
+        self.lru_size = lru_size
+
+        # artist id -> (name, lowercased words, words of the name as spotify lists it), least recently used first
+        self.lru = OrderedDict()
+
+        # counters exposed through stats()
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.computed = 0
+
+        # the connection is shared between threads, so every statement runs under this lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS artists (id TEXT PRIMARY KEY, name TEXT NOT NULL, '
+                                'words TEXT NOT NULL, main_words TEXT NOT NULL, updated REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS corrections (artists TEXT PRIMARY KEY, '
+                                'variant TEXT NOT NULL, confirmed INTEGER NOT NULL, updated REAL NOT NULL)')
+        self.connection.commit()
+
+    def words(self, artist):
+        """
+        Determines the words of an artist in a genius link, computing them only the first time the artist is seen
+        :param artist: spotify artist object
+        :return: tuple of the lowercased words and the words of the name as spotify lists it (used for the main
+            artist fallback)
+        """
+
+        from genius_link import artist_words
+
+        artist_id = artist.get('id')
+        name = artist['name']
+        if not artist_id:
+            return artist_words(name)
+
+        with self.lock:
+            # a renamed artist is computed again
+            entry = self.lru.get(artist_id)
+            if entry is not None and entry[0] == name:
+                self.lru.move_to_end(artist_id)
+                self.memory_hits += 1
+                return entry[1], entry[2]
+
+            row = self.connection.execute('SELECT name, words, main_words FROM artists WHERE id = ?',
+                                          (artist_id,)).fetchone()
+            if row is not None and row[0] == name:
+                words, main_words = tuple(json.loads(row[1])), tuple(json.loads(row[2]))
+                self.database_hits += 1
+            else:
+                words, main_words = artist_words(name)
+                self.connection.execute('INSERT OR REPLACE INTO artists (id, name, words, main_words, updated) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        (artist_id, name, json.dumps(words), json.dumps(main_words), time.time()))
+                self.connection.commit()
+                self.computed += 1
+
+            self.lru[artist_id] = (name, words, main_words)
+            if len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+            return words, main_words
+
+    def correction(self, artists):
+        """
+        Looks up the artist rule a group of artists is known to resolve with
+        :param artists: list of the spotify artist objects of a song
+        :return: tuple of the artist rule learned for the group ('main_artist' or 'all_artists') and whether it has been
+            confirmed by enough songs in a row to skip the links of the other rule, None if nothing has been learned
+        """
+
+        key = artists_key(artists)
+        if key is None or len(artists) < 2:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT variant, confirmed FROM corrections WHERE artists = ?',
+                                          (key,)).fetchone()
+        return (row[0], row[1] >= CONFIRMATIONS) if row else None
+
+    def learn(self, artists, variant):
+        """
+        Records which artist rule a song by a group of artists resolved with
+        :param artists: list of the spotify artist objects of the song
+        :param variant: name of the variant which was found (such as 'main_artist+without_container')
+        """
+
+        key = artists_key(artists)
+        if key is None or len(artists) < 2:
+            return
+
+        # only the artist part of the variant is about the artists, the title rules depend on the song
+        rule = artist_rule(variant)
+        with self.lock:
+            row = self.connection.execute('SELECT variant, confirmed FROM corrections WHERE artists = ?',
+                                          (key,)).fetchone()
+            confirmed = row[1] + 1 if row and row[0] == rule else 1
+            self.connection.execute('INSERT OR REPLACE INTO corrections (artists, variant, confirmed, updated) '
+                                    'VALUES (?, ?, ?, ?)', (key, rule, confirmed, time.time()))
+            self.connection.commit()
+
+    def stats(self):
+        """
+        Reports how often artists were found in memory, in the database or had to be computed
+        :return: dictionary of counters and the number of stored artists and corrections
+        """
+
+        with self.lock:
+            artists = self.connection.execute('SELECT COUNT(*) FROM artists').fetchone()[0]
+            corrections = self.connection.execute('SELECT COUNT(*) FROM corrections').fetchone()[0]
+        return {'memory_hits': self.memory_hits, 'database_hits': self.database_hits, 'computed': self.computed,
+                'artists': artists, 'corrections': corrections}
+
+    def close(self):
+        """
+        Closes the database connection
+        """
+
+        with self.lock:
+            self.connection.close()
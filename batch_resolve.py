@@ -0,0 +1,304 @@
+import argparse
+import json
+import resource
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import genius_link
+import instrumentation
+from candidate_stats import CandidateStats, signature
+from resolution_cache import ResolutionCache
+from slug_index import SlugIndex
+
+
+# number of tracks sent to a worker process at once
+BATCH_SIZE = 256
+
+# number of batches which can be waiting on the process pool at once (keeps memory flat for any input size)
+BATCHES_IN_FLIGHT = 4
+
+# number of tracks whose candidate links are probed at the same time
+PROBE_WORKERS = 4
+
+
+def read_jsonl(path):
+    """
+    Streams spotify track objects out of a JSONL file, one object per line
+    :param path: location of the file ('-' reads from standard input)
+    :return: generator of spotify track objects (playlist and saved track entries are unwrapped), a line which is not
+        valid JSON is yielded as the ValueError it raised and other JSON values as they are, so the resolver writes
+        them out with an error instead of stopping
+    """
+
+    file = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as error:
+                yield ValueError('line %d is not valid JSON (%s)' % (number, error))
+                continue
+            # playlist items and saved tracks hold the track under 'track', the currently playing object under 'item'
+            if isinstance(record, dict):
+                record = record.get('track') or record.get('item') or record
+            yield record
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def read_pages(user, page):
+    """
+    Streams spotify track objects out of a paginated spotify result
+    :param user: spotify user object
+    :param page: first page of results (from current_user_saved_tracks, playlist_items, ...)
+    :return: generator of spotify track objects
+    """
+
+    # only one page is held in memory at a time
+    while page:
+        for record in page['items']:
+            record = record.get('track') or record
+            yield record
+        page = user.next(page) if page.get('next') else None
+
+
+def normalize_batch(records):
+    """
+    Builds the candidate links of a batch of tracks (runs inside a worker process)
+    :param records: list of spotify track objects
+    :return: list of (track, (variant, candidate link) pairs, feature signature, error) tuples, the track only keeps
+        the fields written to the output and error is None unless the track could not go through the cleanup,
+        along with the instrumentation recorded by the worker for this batch (None if instrumentation is off)
+    """
+
+    results = []
+    for record in records:
+        # one broken record never takes the rest of the batch down with it
+        try:
+            track = {'id': record.get('id'), 'name': record['name'],
+                     'artists': [{'name': artist['name']} for artist in record['artists']]}
+        except (KeyError, TypeError, AttributeError) as error:
+            results.append(({'id': record.get('id') if isinstance(record, dict) else None, 'name': None,
+                             'artists': []}, [], None, 'malformed track (%r)' % error))
+            continue
+        track_name = track['name'].lower()
+        try:
+            # the signature is computed here as well, so the parent process only has to probe
+            slug = genius_link.Slug.from_track(track['artists'], track_name)
+            # a title the guards gave the simplified slug is handled like one which failed the cleanup, its link is
+            # written but not cached or learned from
+            if slug.simplified:
+                results.append((track, list(slug.variants()), None, 'title too long or slow for the cleanup rules, '
+                                                                    'simplified link used'))
+                continue
+            results.append((track, list(slug.variants()), signature(track['artists'], track_name, slug), None))
+        except Exception as error:
+            # the simplified slug does not go through the cleanup rules, so the title still gets its plain link
+            instrumentation.count('simplified', reason='error')
+            results.append((track, list(genius_link.Slug.simple(track['artists'], track_name).variants()), None,
+                            'cleanup failed (%r), simplified link used' % error))
+
+    # the stage timings of the worker are sent back with the batch so the parent can report them
+    return results, instrumentation.snapshot(clear=True) if instrumentation.enabled else None
+
+
+def start_worker(metrics):
+    """
+    Sets up a worker process
+    :param metrics: if True the worker records stage timings
+    """
+
+    if metrics:
+        instrumentation.enable()
+
+
+def peak_memory():
+    """
+    Determines the peak resident memory of this process and of its worker processes
+    :return: tuple of peak memory of this process and the largest worker process in megabytes
+    """
+
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macos
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, workers
+
+
+def resolve_records(records, output, workers=None, probe_workers=PROBE_WORKERS, batch_size=BATCH_SIZE, cache=None,
+                    probe=True, stats=None, index=None):
+    """
+    Resolves the genius links of a stream of tracks and writes them out as JSONL as soon as each batch is done
+    :param records: iterable of spotify track objects
+    :param output: file object the results are written to
+    :param workers: number of worker processes building candidate links (defaults to the number of cpus)
+    :param probe_workers: number of tracks whose candidate links are probed at the same time
+    :param batch_size: number of tracks sent to a worker process at once
+    :param cache: ResolutionCache used to skip already resolved tracks and store new results (None disables caching)
+    :param probe: if False the candidate links are written out without being probed
+    :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    :return: number of tracks written
+    """
+
+    written = 0
+
+    def write(track, url, candidates, error=None):
+        nonlocal written
+        track['url'] = url
+        if not probe:
+            track['candidates'] = candidates
+        if error is not None:
+            track['error'] = error
+        output.write(json.dumps(track) + '\n')
+        written += 1
+
+    def finish(future):
+        # probing is network bound, so it runs on threads while the processes keep building the next batches
+        normalized, metrics = future.result()
+        if metrics is not None:
+            instrumentation.merge(metrics)
+        # tracks which failed the cleanup are probed with their simplified link, without learning from them
+        links = probe_pool.map(lambda result: genius_link.probe_variants(
+            result[1], stats if result[3] is None else None, result[2], index) if result[1] else '',
+            normalized) if probe else [None] * len(normalized)
+        for (track, variants, feature_signature, error), url in zip(normalized, links):
+            candidates = [link for variant, link in variants]
+            # songs genius could not be asked about are written without a link and are not cached, so they are
+            # resolved again next time
+            if probe and url is None:
+                write(track, '', candidates, error or 'genius could not be reached')
+                continue
+            # tracks which failed the cleanup are not cached either, their link is only a best effort
+            if error is not None:
+                write(track, url, candidates, error)
+                continue
+            if probe and cache is not None:
+                track_name = track['name'].lower()
+                cache.put(track['id'], track['artists'], track_name, url, genius_link.get_rules_fingerprint(),
+                          genius_link.rule_features(track_name), candidates)
+            write(track, url, candidates)
+        output.flush()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+                             initargs=(instrumentation.enabled,)) as process_pool, \
+            ThreadPoolExecutor(max_workers=probe_workers) as probe_pool:
+        # batches submitted to the process pool which have not been written yet
+        pending = deque()
+        records = iter(records)
+
+        # becomes True once every record has been read from the input
+        exhausted = False
+
+        while not exhausted or pending:
+            batch = []
+            consumed = 0
+            for record in islice(records, 0 if exhausted else batch_size):
+                consumed += 1
+                # lines which are not JSON objects are written out with an error like any other malformed track
+                if not isinstance(record, dict):
+                    write({'id': None, 'name': None, 'artists': []}, '' if probe else None, [],
+                          str(record) if isinstance(record, ValueError) else 'malformed track (not a JSON object)')
+                    continue
+                # local files and podcast episodes without artists cannot have a genius link
+                if not record.get('artists'):
+                    continue
+                # cached tracks are written straight away without going through the pipeline
+                if cache is not None and isinstance(record.get('name'), str):
+                    # a track whose artists cannot be read is left to normalize_batch, which writes it with an error
+                    try:
+                        url = cache.get(record.get('id'), record['artists'], record['name'].lower())
+                        track = {'id': record.get('id'), 'name': record['name'],
+                                 'artists': [{'name': artist['name']} for artist in record['artists']]}
+                    except (KeyError, TypeError, AttributeError):
+                        url = None
+                    if url is not None:
+                        write(track, url, None)
+                        continue
+                batch.append(record)
+            exhausted = exhausted or consumed < batch_size
+
+            if batch:
+                pending.append(process_pool.submit(normalize_batch, batch))
+            # waits on the oldest batch once enough are in flight, or once the input has run out
+            if pending and (len(pending) >= BATCHES_IN_FLIGHT or exhausted):
+                finish(pending.popleft())
+
+    return written
+
+
+def main():
+    """
+    Runs the batch resolver from the command line and reports its throughput
+    """
+
+    parser = argparse.ArgumentParser(description='Resolves the genius links of whole libraries of spotify tracks')
+    parser.add_argument('input', nargs='?', help='JSONL file of spotify track objects (- for standard input)')
+    parser.add_argument('output', help='JSONL file the results are written to (- for standard output)')
+    parser.add_argument('--saved-tracks', action='store_true', help='resolve the saved tracks of the spotify user')
+    parser.add_argument('--playlist', help='resolve the tracks of a spotify playlist')
+    parser.add_argument('--username', default=genius_link.USERNAME,
+                        help='spotify user to read saved tracks or playlists for')
+    parser.add_argument('--workers', type=int, help='number of worker processes (defaults to the number of cpus)')
+    parser.add_argument('--probe-workers', type=int, default=PROBE_WORKERS,
+                        help='number of tracks probed at the same time')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='number of tracks per worker batch')
+    parser.add_argument('--cache', action='store_true', help='use and fill the resolution cache')
+    parser.add_argument('--no-probe', action='store_true', help='write the candidate links without probing them')
+    parser.add_argument('--learn', action='store_true',
+                        help='probe the links most likely to work first and record which ones did')
+    parser.add_argument('--index', help='index of known genius slugs checked before probing (see slug_index.py)')
+    parser.add_argument('--metrics', help='record stage timings and counters and save them to this file as JSON')
+    arguments = parser.parse_args()
+
+    if arguments.metrics:
+        instrumentation.enable()
+
+    # picks where the tracks are streamed from
+    if arguments.saved_tracks or arguments.playlist:
+        user = genius_link.get_user(arguments.username)
+        if arguments.playlist:
+            records = read_pages(user, user.playlist_items(arguments.playlist))
+        else:
+            records = read_pages(user, user.current_user_saved_tracks(limit=50))
+    elif arguments.input:
+        records = read_jsonl(arguments.input)
+    else:
+        parser.error('an input file, --saved-tracks or --playlist is required')
+
+    output = sys.stdout if arguments.output == '-' else open(arguments.output, 'w', encoding='utf-8')
+    cache = ResolutionCache() if arguments.cache else None
+    stats = CandidateStats() if arguments.learn else None
+    index = SlugIndex(arguments.index) if arguments.index else None
+
+    start = time.perf_counter()
+    written = resolve_records(records, output, arguments.workers, arguments.probe_workers, arguments.batch_size,
+                              cache, not arguments.no_probe, stats, index)
+    elapsed = time.perf_counter() - start
+
+    if output is not sys.stdout:
+        output.close()
+    if cache is not None:
+        cache.close()
+    if stats is not None:
+        stats.save()
+    if index is not None:
+        index.close()
+
+    # throughput and memory are reported on standard error so they never mix with the results
+    own, workers = peak_memory()
+    print('%d tracks in %.2f s (%.1f tracks/sec), peak RSS %.1f MB (largest worker %.1f MB)'
+          % (written, elapsed, written / elapsed if elapsed else 0, own, workers), file=sys.stderr)
+    if arguments.metrics:
+        with open(arguments.metrics, 'w') as file:
+            file.write(instrumentation.export_json())
+
+
+if __name__ == '__main__':
+    main()
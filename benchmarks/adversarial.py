@@ -0,0 +1,137 @@
+import argparse
+import json
+import math
+import random
+import sys
+import time
+
+import genius_link
+
+
+# artists every adversarial title is resolved with (two, so the featured artist rules run)
+ARTISTS = [{'name': 'Travis Scott'}, {'name': 'The Weeknd'}]
+
+# families of hostile titles, each builds a title of about the given length out of the characters and keywords the
+# cleanup rules react to (containers without an end, feat markers without a container after them, ...)
+FAMILIES = {
+    'open_brackets': lambda length: ']' + '[' * (length - 1),
+    'open_parens_feat': lambda length: 'remastered!feat' + '(' * (length - 19) + 'feat',
+    'open_parens_word': lambda length: '/)!' + '(' * (length - 4) + 'a',
+    'repeated_feat': lambda length: 'interlude' + 'feat.' * ((length - 9) // 5),
+    'repeated_with': lambda length: ('with ' * length)[:length],
+    'hyphens': lambda length: ('- ' * length)[:length - 10] + 'remastered',
+    'slashes': lambda length: ('a / ' * length)[:length],
+    'nested': lambda length: '(a ' * (length // 6) + ') ' * (length // 6),
+}
+
+# pieces random titles are built from when searching for new hostile titles
+PIECES = ['feat', 'feat.', 'with', '(', ')', '[', ']', '-', ' - ', '/', 'a', 'a ', ' ', ',', 'remastered', 'interlude',
+          '.', '!', '$']
+
+
+def time_title(title, guarded):
+    """
+    Times the cleanup pipeline on one title
+    :param title: lowercase title
+    :param guarded: if True the length guard and time budget are on, if False the rules run however long they take
+    :return: number of seconds the slug took to build
+    """
+
+    start = time.perf_counter()
+    if guarded:
+        genius_link.Slug.from_track(ARTISTS, title)
+    else:
+        genius_link.Slug.from_track(ARTISTS, title, max_length=None, budget=None)
+    return time.perf_counter() - start
+
+
+def growth(lengths, seconds):
+    """
+    Estimates how the time grows with the length of the title from the two longest measurements
+    :param lengths: list of title lengths
+    :param seconds: list of times measured for them
+    :return: exponent k of time ~ length ** k, None if there are not enough measurements
+    """
+
+    if len(seconds) < 2 or min(seconds[-2:]) <= 0:
+        return None
+    return round(math.log(seconds[-1] / seconds[-2]) / math.log(lengths[len(seconds) - 1] / lengths[len(seconds) - 2]),
+                 2)
+
+
+def run_families(lengths, guarded, max_seconds):
+    """
+    Times every family of hostile titles at every length
+    :param lengths: list of title lengths
+    :param guarded: if True the length guard and time budget are on
+    :param max_seconds: a family stops growing once one of its titles takes longer than this
+    :return: dictionary of family -> {'ms': list of milliseconds per length, 'growth': exponent}
+    """
+
+    results = {}
+    for family, build in FAMILIES.items():
+        seconds = []
+        for length in lengths:
+            seconds.append(time_title(build(length), guarded))
+            if seconds[-1] > max_seconds:
+                break
+        results[family] = {'ms': [round(value * 1000, 3) for value in seconds], 'growth': growth(lengths, seconds)}
+    return results
+
+
+def search(trials, length, seed):
+    """
+    Searches for new hostile titles by repeating random pieces and keeping the slowest ones
+    :param trials: number of random titles tried
+    :param length: length of every random title
+    :param seed: seed of the random number generator
+    :return: list of (milliseconds, title prefix) of the five slowest titles found
+    """
+
+    rnd = random.Random(seed)
+    found = []
+    for _ in range(trials):
+        unit = ''.join(rnd.choice(PIECES) for _ in range(rnd.randint(1, 4)))
+        prefix = ''.join(rnd.choice(PIECES) for _ in range(rnd.randint(0, 3)))
+        title = (prefix + unit * (length // len(unit) + 1))[:length]
+        found.append((round(time_title(title, False) * 1000, 3), title[:40]))
+    return sorted(found, reverse=True)[:5]
+
+
+def main():
+    """
+    Measures the worst case cleanup time against the length of the title, with and without the guards
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks the slug pipeline on hostile titles')
+    parser.add_argument('--lengths', default='64,256,1024,4096', help='comma separated title lengths')
+    parser.add_argument('--max-seconds', type=float, default=2.0,
+                        help='a family stops growing once one of its unguarded titles takes longer than this')
+    parser.add_argument('--search', type=int, default=0, help='number of random titles tried looking for new ones')
+    parser.add_argument('--seed', type=int, default=2021, help='seed of the random search')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    arguments = parser.parse_args()
+
+    lengths = [int(length) for length in arguments.lengths.split(',')]
+    results = {
+        'python': sys.version.split()[0],
+        'lengths': lengths,
+        'max_title_length': genius_link.MAX_TITLE_LENGTH,
+        'title_time_budget_ms': genius_link.TITLE_TIME_BUDGET * 1000,
+        'unguarded': run_families(lengths, False, arguments.max_seconds),
+        'guarded': run_families(lengths, True, arguments.max_seconds),
+    }
+    # the worst title of any family at any length is what a batch worker can get stuck on
+    for mode in ('unguarded', 'guarded'):
+        results['worst_%s_ms' % mode] = max(max(family['ms']) for family in results[mode].values())
+    if arguments.search:
+        results['search'] = search(arguments.search, lengths[-1], arguments.seed)
+
+    print(json.dumps(results, indent=2))
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import random
+import sys
+import time
+
+import genius_link
+from benchmarks.make_corpus import CORPUS_PATH
+from benchmarks.pipeline import load_corpus, time_stages
+from columnar import ColumnarNormalizer
+
+
+def per_row(rows):
+    """
+    Builds the candidate slugs of every row one at a time, the way the rest of the package does
+    :param rows: list of (artist names, title) pairs
+    :return: list of candidate slug lists
+    """
+
+    # the main artist keeps the case spotify lists it in, so the slugs are cut out of the links without lowercasing
+    start, end = len(genius_link.GENIUS_URL), -len('-lyrics')
+    return [[link[start:end] for link in genius_link.build_candidates([{'name': name} for name in names],
+                                                                     title.lower())]
+            for names, title in rows]
+
+
+def columnar(rows):
+    """
+    Builds the candidate slugs of every row with a fresh columnar normalizer
+    :param rows: list of (artist names, title) pairs
+    :return: tuple of the list of candidate slug lists and the number of distinct songs normalized
+    """
+
+    normalizer = ColumnarNormalizer()
+    slugs, candidates = normalizer.normalize([names for names, title in rows], [title for names, title in rows])
+    return candidates, normalizer.normalized
+
+
+def library(corpus, rows, seed):
+    """
+    Draws a library shaped sample from the corpus, a few songs make up most of the rows as in real listening exports
+    :param corpus: list of cases
+    :param rows: number of rows drawn
+    :param seed: seed of the random number generator
+    :return: list of (artist names, title) pairs
+    """
+
+    rnd = random.Random(seed)
+    songs = [([artist['name'] for artist in case['artists']], case['title']) for case in corpus]
+    rnd.shuffle(songs)
+    # zipf weights, the song of rank k is played about 1 / k as often as the most played one
+    return rnd.choices(songs, weights=[1 / rank for rank in range(1, len(songs) + 1)], k=rows)
+
+
+def measure(rows):
+    """
+    Times both modes over the same rows and checks they agree
+    :param rows: list of (artist names, title) pairs
+    :return: dictionary of rows per second of both modes, the speedup and the number of rows which differ
+    """
+
+    start = time.perf_counter()
+    expected = per_row(rows)
+    row_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    candidates, distinct = columnar(rows)
+    columnar_seconds = time.perf_counter() - start
+
+    return {
+        'rows': len(rows),
+        'distinct_songs': distinct,
+        'per_row_rows_per_sec': round(len(rows) / row_seconds, 1),
+        'columnar_rows_per_sec': round(len(rows) / columnar_seconds, 1),
+        'speedup': round(row_seconds / columnar_seconds, 2),
+        'mismatches': sum(old != new for old, new in zip(expected, candidates)),
+    }
+
+
+def main():
+    """
+    Compares the columnar mode against the per row functions on the golden corpus and on a library shaped sample
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks the columnar normalization mode')
+    parser.add_argument('--corpus', default=CORPUS_PATH, help='JSONL corpus of artists, title and expected slug')
+    parser.add_argument('--rows', type=int, default=200000, help='number of rows of the library shaped sample')
+    parser.add_argument('--seed', type=int, default=2021, help='seed of the library shaped sample')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    arguments = parser.parse_args()
+
+    corpus = load_corpus(arguments.corpus)
+    rows = [([artist['name'] for artist in case['artists']], case['title']) for case in corpus]
+
+    # the stage functions themselves are the reference the columnar slugs have to match exactly
+    totals, stage_slugs = time_stages(corpus)
+    candidates, distinct = columnar(rows)
+
+    results = {
+        'python': sys.version.split()[0],
+        'stage_function_mismatches': sum(slug != links[0] for slug, links in zip(stage_slugs, candidates)),
+        'corpus': measure(rows),
+        'library': measure(library(corpus, arguments.rows, arguments.seed)),
+    }
+
+    print(json.dumps(results, indent=2))
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
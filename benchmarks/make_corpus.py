@@ -0,0 +1,151 @@
+import json
+import os
+import random
+import re
+
+import unidecode
+
+
+# location of the golden corpus used by the pipeline benchmark
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.jsonl')
+
+# every example from the README, with the slug genius actually uses for it
+README_CASES = [
+    (['Travis Scott'], 'goosebumps', 'travis-scott-goosebumps'),
+    (['Khalid', 'Swae Lee'], 'The Ways (with Swae Lee)', 'khalid-and-swae-lee-the-ways'),
+    (['Mac Miller', 'Miguel'], 'Weekend (feat. Miguel)', 'mac-miller-weekend'),
+    (['Kendrick Lamar', 'Travis Scott'], 'Big Shot (with Travis Scott)', 'kendrick-lamar-and-travis-scott-big-shot'),
+    (['Mac Miller', 'Lil Wayne'], 'The Question', 'mac-miller-the-question'),
+    (['The Beatles'], 'Strawberry Fields Forever', 'the-beatles-strawberry-fields-forever'),
+    (['Travis Scott', 'The Weeknd'], 'Pray 4 Love (feat. The Weeknd)', 'travis-scott-pray-4-love'),
+    (['Kendrick Lamar', 'Niki Randa'], "I Am Who Am (Killin' Time) [feat. Niki Randa]",
+     'kendrick-lamar-i-am-who-am-killin-time'),
+    (['Lil Baby', 'Gunna', 'Drake'], 'Never Recover (Lil Baby & Gunna, Drake)', 'lil-baby-and-gunna-never-recover'),
+    (['Drake'], 'Cameras / Good Ones Go Interlude - Medley', 'drake-cameras'),
+    (['Mac Miller'], 'Perfect Circle / God Speed', 'mac-miller-perfect-circle-god-speed'),
+]
+
+# artists the synthetic cases are built from (accents, dollar signs and punctuation all show up in real names)
+ARTISTS = ['Drake', 'Khalid', 'Swae Lee', 'Travis Scott', 'Kendrick Lamar', 'Mac Miller', 'Miguel', 'The Weeknd',
+           'Lil Baby', 'Gunna', 'Beyoncé', 'A$AP Rocky', 'Post Malone', 'SZA', 'J. Cole', 'Rosalía', 'Bad Bunny',
+           'Tyler, The Creator', 'Frank Ocean', 'Billie Eilish', 'Ty Dolla $ign', 'Jhené Aiko', 'Future',
+           'Kid Cudi', 'Childish Gambino', 'Doja Cat', 'Sam Smith', 'Dua Lipa', 'Björk', 'Sigur Rós',
+           'Florence + The Machine', 'Daniel Caesar', 'H.E.R.', 'Chance the Rapper', 'Anderson .Paak', 'Mýa']
+
+# titles the synthetic cases are built from
+TITLES = ['Hotline Bling', 'Nights', 'Passionfruit', 'Sicko Mode', 'Location', 'Redbone', 'Good Days',
+          'Blinding Lights', 'Self Control', 'Best Part', 'Praise The Lord', 'Nice For What', 'Come Through',
+          'Dreams', 'Ivy', 'Pink + White', 'Lost', 'Thinkin Bout You', 'Runaway', 'Money Trees', 'Alright',
+          'Love Galore', 'The Less I Know The Better', 'Sunflower', 'Circles', 'Stay', 'Solo', 'Nikes',
+          'Pyramids', 'Electric', 'Get You', 'Japanese Denim', 'Bad Guy', 'Levitating', 'Kill Bill', 'Snooze',
+          'Después de la Playa', 'Canción', 'Jóga', 'Hoppípolla', "Don't", "Gangsta's Paradise", 'Mr. Brightside',
+          'Who Dat Boy', 'Can I Kick It?', 'N.Y. State of Mind', 'Crew Love', 'Pink Matter', 'Lemon Pepper Freestyle']
+
+# words which are kept when they are in a container, the container itself is dropped
+KEEP_WORDS = ['Interlude', 'Intro', 'Outro', 'Prelude']
+
+
+def slugify(text):
+    """
+    Turns an artist name or title into the words genius uses for it, independently of the pipeline
+    :param text: artist name or title
+    :return: list of lowercase words
+    """
+
+    text = unidecode.unidecode(text).lower()
+    text = re.sub(r"['’.,?]", '', text)
+    return re.findall(r'[a-z0-9]+', text)
+
+
+def artists_slug(artists):
+    """
+    Determines the artist part of a genius slug
+    :param artists: list of artist names responsible for the song
+    :return: list of words with 'and' before the last artist
+    """
+
+    words = []
+    for num, artist in enumerate(artists):
+        if num and num == len(artists) - 1:
+            words.append('and')
+        words.extend(slugify(artist))
+    return words
+
+
+def synthetic_case(rnd):
+    """
+    Builds one synthetic case by decorating a plain title the way spotify does
+    :param rnd: random number generator
+    :return: tuple of artist names, title and expected slug
+    """
+
+    main_artists = rnd.sample(ARTISTS, rnd.choice([1, 1, 1, 2]))
+    title = rnd.choice(TITLES)
+    slug_title = slugify(title)
+    other = rnd.choice([artist for artist in ARTISTS if artist not in main_artists])
+    style = rnd.choice(['plain', 'feat', 'feat_bracket', 'feat_hyphen', 'with', 'remastered', 'bonus', 'acoustic',
+                        'keep', 'slash'])
+
+    # featured artists are listed by spotify but left out of the slug, 'with' artists are part of it
+    artists = list(main_artists)
+    slug_artists = main_artists
+    if style == 'feat':
+        title += ' (feat. %s)' % other
+        artists.append(other)
+    elif style == 'feat_bracket':
+        title += ' [feat. %s]' % other
+        artists.append(other)
+    elif style == 'feat_hyphen':
+        title += ' - feat. %s' % other
+        artists.append(other)
+    elif style == 'with':
+        title += ' (with %s)' % other
+        artists.append(other)
+        slug_artists = artists
+    # release information after a hyphen is dropped entirely
+    elif style == 'remastered':
+        title += ' - Remastered %d' % rnd.randint(1995, 2023)
+    elif style == 'bonus':
+        title += ' - Bonus Track'
+    elif style == 'acoustic':
+        title += ' - Acoustic'
+    # interlude style words stay in the slug
+    elif style == 'keep':
+        word = rnd.choice(KEEP_WORDS)
+        title += ' - %s' % word
+        slug_title = slug_title + slugify(word)
+    # both halves of a slash stay in the slug
+    elif style == 'slash':
+        second = rnd.choice([other_title for other_title in TITLES if other_title != title])
+        title += ' / ' + second
+        slug_title = slug_title + slugify(second)
+
+    return artists, title, '-'.join(artists_slug(slug_artists) + slug_title)
+
+
+def main():
+    """
+    Writes the golden corpus, the README examples first followed by the synthetic cases
+    """
+
+    rnd = random.Random(2021)
+    cases = [(artists, title, expected, 'readme') for artists, title, expected in README_CASES]
+    seen = {(tuple(artists), title) for artists, title, expected, source in cases}
+
+    # synthetic cases are deduplicated so every line of the corpus is a distinct input
+    while len(cases) < 3000:
+        artists, title, expected = synthetic_case(rnd)
+        if (tuple(artists), title) in seen:
+            continue
+        seen.add((tuple(artists), title))
+        cases.append((artists, title, expected, 'synthetic'))
+
+    with open(CORPUS_PATH, 'w', encoding='utf-8') as file:
+        for artists, title, expected, source in cases:
+            file.write(json.dumps({'artists': [{'name': artist} for artist in artists], 'title': title,
+                                   'expected': expected, 'source': source}, ensure_ascii=False) + '\n')
+    print('wrote %d cases to %s' % (len(cases), CORPUS_PATH))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import genius_link
+from benchmarks.make_corpus import CORPUS_PATH
+
+
+# stages of the pipeline in the order a title goes through them
+STAGES = ['remove_artists_featured', 'split_artists', 'remove_end_track', 'split_track_name', 'genius_link']
+
+
+def load_corpus(path=CORPUS_PATH):
+    """
+    Reads the golden corpus
+    :param path: location of the corpus (JSONL of artists, title and expected slug)
+    :return: list of cases
+    """
+
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def link_slug(html_address):
+    """
+    Takes the slug out of a genius link
+    :param html_address: genius link
+    :return: slug between the genius url and the '-lyrics' ending (lowercase)
+    """
+
+    return html_address[len(genius_link.GENIUS_URL):-len('-lyrics')].lower()
+
+
+def time_stages(corpus):
+    """
+    Runs every case of the corpus through the pipeline once, timing each stage separately
+    :param corpus: list of cases
+    :return: tuple of total seconds spent in each stage and the slug produced for each case
+    """
+
+    totals = dict.fromkeys(STAGES, 0.0)
+    slugs = []
+    clock = time.perf_counter
+
+    for case in corpus:
+        track_name = case['title'].lower()
+
+        start = clock()
+        all_artists = genius_link.remove_artists_featured(case['artists'], track_name)
+        after_featured = clock()
+        all_artists_split = genius_link.split_artists(all_artists)
+        after_split_artists = clock()
+        cleaned = genius_link.remove_end_track(track_name, all_artists_split)
+        after_end_track = clock()
+        track_split = genius_link.split_track_name(cleaned[0])
+        after_split_track = clock()
+        html_address = genius_link.genius_link(all_artists_split, track_split)
+        end = clock()
+
+        totals['remove_artists_featured'] += after_featured - start
+        totals['split_artists'] += after_split_artists - after_featured
+        totals['remove_end_track'] += after_end_track - after_split_artists
+        totals['split_track_name'] += after_split_track - after_end_track
+        totals['genius_link'] += end - after_split_track
+        slugs.append(link_slug(html_address))
+
+    return totals, slugs
+
+
+def current_commit():
+    """
+    Determines the commit the benchmark is run on
+    :return: commit hash, None if the repository is not available
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(corpus, repeat=5):
+    """
+    Benchmarks the pipeline over the corpus and checks its slugs against the expected ones
+    :param corpus: list of cases
+    :param repeat: number of times the corpus is run, the fastest run of each stage is kept
+    :return: dictionary of results
+    """
+
+    best = dict.fromkeys(STAGES, float('inf'))
+    best_total = float('inf')
+    slugs = []
+
+    for _ in range(repeat):
+        totals, slugs = time_stages(corpus)
+        for stage in STAGES:
+            best[stage] = min(best[stage], totals[stage])
+        best_total = min(best_total, sum(totals.values()))
+
+    # a case also counts as found if any of the fallback links matches the expected slug
+    candidates = [[link_slug(link) for link in genius_link.build_candidates(case['artists'], case['title'].lower())]
+                  for case in corpus]
+
+    primary = sum(slug == case['expected'] for slug, case in zip(slugs, corpus))
+    any_candidate = sum(case['expected'] in links for links, case in zip(candidates, corpus))
+    readme = [num for num, case in enumerate(corpus) if case['source'] == 'readme']
+
+    return {
+        'commit': current_commit(),
+        'python': sys.version.split()[0],
+        'cases': len(corpus),
+        'repeat': repeat,
+        'stages_us_per_title': {stage: round(best[stage] / len(corpus) * 1e6, 3) for stage in STAGES},
+        'end_to_end_us_per_title': round(best_total / len(corpus) * 1e6, 3),
+        'titles_per_sec': round(len(corpus) / best_total, 1),
+        'accuracy': {
+            'primary': round(primary / len(corpus), 4),
+            'any_candidate': round(any_candidate / len(corpus), 4),
+            'readme_primary': sum(slugs[num] == corpus[num]['expected'] for num in readme),
+            'readme_any_candidate': sum(corpus[num]['expected'] in candidates[num] for num in readme),
+            'readme_cases': len(readme),
+        },
+        'slugs': slugs,
+    }
+
+
+def compare(results, previous):
+    """
+    Prints how the timings and accuracy changed against an earlier run
+    :param results: dictionary of results of this run
+    :param previous: dictionary of results of the earlier run
+    """
+
+    print('compared with %s:' % (previous.get('commit') or 'previous run'))
+    for stage in STAGES + ['end_to_end']:
+        old = previous['stages_us_per_title'][stage] if stage in STAGES else previous['end_to_end_us_per_title']
+        new = results['stages_us_per_title'][stage] if stage in STAGES else results['end_to_end_us_per_title']
+        print('  %-24s %9.3f -> %9.3f us/title (%+.1f%%)' % (stage, old, new, (new - old) / old * 100 if old else 0))
+    for key in ('primary', 'any_candidate'):
+        print('  accuracy %-15s %.4f -> %.4f' % (key, previous['accuracy'][key], results['accuracy'][key]))
+
+    # slugs which changed between the runs are listed, as they are the first place to look for regressions
+    if len(previous.get('slugs', [])) == len(results['slugs']):
+        changed = sum(old != new for old, new in zip(previous['slugs'], results['slugs']))
+        print('  %d slugs changed' % changed)
+
+
+def main():
+    """
+    Runs the pipeline benchmark from the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks the slug pipeline over the golden corpus')
+    parser.add_argument('--corpus', default=CORPUS_PATH, help='JSONL corpus of artists, title and expected slug')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs over the corpus (fastest is kept)')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--failures', type=int, default=0, help='number of wrong slugs to print')
+    arguments = parser.parse_args()
+
+    corpus = load_corpus(arguments.corpus)
+    results = run_benchmark(corpus, arguments.repeat)
+
+    # the summary is printed without the slugs, which are only kept in the saved file for comparisons
+    print(json.dumps({key: value for key, value in results.items() if key != 'slugs'}, indent=2))
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(results, json.load(file))
+    for slug, case in [(slug, case) for slug, case in zip(results['slugs'], corpus)
+                       if slug != case['expected']][:arguments.failures]:
+        print('%-60s %s != %s' % (case['title'][:60], slug, case['expected']))
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
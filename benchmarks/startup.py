@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# root of the repository, the benchmarked interpreters are started from there so genius_link can be imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# code run by each cold interpreter, every step prints how long it took in seconds as one JSON object
+SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import genius_link
+imported = time.perf_counter()
+genius_link.build_candidates([{'name': 'Khalid'}, {'name': 'Swae Lee'}], 'the ways (with swae lee)')
+resolved = time.perf_counter()
+if PROBE:
+    genius_link.probe_candidates(genius_link.build_candidates([{'name': 'Drake'}], 'hotline bling'))
+probed = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_resolution': resolved - imported, 'first_probe': probed - resolved,
+                  'heavy_modules': sorted(name for name in ('spotipy', 'requests', 'unidecode', 'urllib3', 'sqlite3')
+                                          if name in sys.modules)}))
+'''
+
+
+def run_once(probe):
+    """
+    Starts a fresh interpreter, imports genius_link and resolves a song offline (and optionally probes one)
+    :param probe: if True the first probe against genius is timed as well
+    :return: dictionary of timings in seconds and the heavy modules loaded by the end
+    """
+
+    # the wall time of the whole interpreter includes python's own startup, which the import time does not
+    output = subprocess.run([sys.executable, '-c', 'PROBE = %r\n' % probe + SCRIPT], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """
+    Measures the cold import time and first resolution time of genius_link over several fresh interpreters
+    """
+
+    parser = argparse.ArgumentParser(description='Measures the cold start cost of genius_link')
+    parser.add_argument('--runs', type=int, default=20, help='number of fresh interpreters to start')
+    parser.add_argument('--probe', action='store_true', help='also time the first probe against genius')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    arguments = parser.parse_args()
+
+    runs = [run_once(arguments.probe) for _ in range(arguments.runs)]
+
+    # medians are reported because the first interpreter started also pays for a cold file cache
+    results = {'runs': arguments.runs, 'python': sys.version.split()[0]}
+    for step in ('import', 'first_resolution', 'first_probe'):
+        results[step + '_ms'] = round(statistics.median(run[step] for run in runs) * 1000, 3)
+    results['heavy_modules'] = runs[-1]['heavy_modules']
+
+    print(json.dumps(results, indent=2))
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
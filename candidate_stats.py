@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import threading
+
+
+# default location of the learned statistics (stored in the home directory so every run shares them)
+STATS_PATH = os.path.join(os.path.expanduser('~'), '.genius_link_stats.json')
+
+# number of recorded resolutions between two saves of the statistics
+SAVE_EVERY = 20
+
+# a variant is probed alone before the others once its estimated chance of being the right link reaches this
+PROBE_ALONE_THRESHOLD = 0.6
+
+# a variant needs at least this many recorded attempts before it is trusted enough to be probed alone
+PROBE_ALONE_MIN_ATTEMPTS = 5
+
+
+def signature(artists_json, track_name, slug):
+    """
+    Determines the feature signature of a song, songs with the same signature tend to be found by the same variant
+    :param artists_json: an list containing the names of all artists responsible for the song
+    :param track_name: lowercase name of the song as spotify lists it
+    :param slug: Slug object of the song
+    :return: signature string such as 'artists=2,container=1,slash=0,keyword=strip' (artist counts above 3 are 3)
+    """
+
+    from genius_link import title_features
+
+    features = title_features(track_name)
+    keyword = 'strip' if 'strip' in features else 'keep' if 'keep' in features else 'none'
+    return 'artists=%d,container=%d,slash=%d,keyword=%s' % (min(len(artists_json), 3), slug.container is not None,
+                                                            slug.slash is not None, keyword)
+
+
+class CandidateStats:
+    """
+    Learned success rates of each fallback variant per feature signature, persisted as JSON
+    """
+
+    def __init__(self, path=STATS_PATH, save_every=SAVE_EVERY):
+        """
+        Loads the statistics (starts empty if the file does not exist yet)
+        :param path: location of the JSON file (None keeps the statistics in memory only)
+        :param save_every: number of recorded resolutions between two saves
+        """
+
+        self.path = path
+        self.save_every = save_every
+        # signature -> variant -> [successes, attempts]
+        self.table = {}
+        # number of resolutions recorded since the last save
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.table = json.load(file)
+
+    def success_rate(self, signature, variant):
+        """
+        Estimates how likely a variant is to be the right link for songs with a signature
+        :param signature: feature signature of the song
+        :param variant: name of the variant
+        :return: estimated success rate (0.5 for variants never tried)
+        """
+
+        successes, attempts = self.table.get(signature, {}).get(variant, (0, 0))
+        # one imaginary success and one imaginary failure keep rarely tried variants from jumping to the front
+        return (successes + 1) / (attempts + 2)
+
+    def order(self, signature, variants):
+        """
+        Reorders the candidate links of a song so the variants most likely to work are probed first
+        :param signature: feature signature of the song
+        :param variants: list of (variant, genius link) pairs in their original order
+        :return: reordered list of (variant, genius link) pairs (ties keep their original order)
+        """
+
+        with self.lock:
+            return sorted(variants, key=lambda pair: -self.success_rate(signature, pair[0]))
+
+    def probe_alone(self, signature, variant):
+        """
+        Determines if a variant is likely enough to work that it should be probed before the others are
+        :param signature: feature signature of the song
+        :param variant: name of the variant
+        :return: True if the variant should be probed alone first
+        """
+
+        with self.lock:
+            attempts = self.table.get(signature, {}).get(variant, (0, 0))[1]
+            return attempts >= PROBE_ALONE_MIN_ATTEMPTS and \
+                self.success_rate(signature, variant) >= PROBE_ALONE_THRESHOLD
+
+    def record(self, signature, failed, found=None):
+        """
+        Records the outcome of resolving a song
+        :param signature: feature signature of the song
+        :param failed: list of variants which were probed and did not exist
+        :param found: variant which was found, None if no link was found
+        """
+
+        with self.lock:
+            variants = self.table.setdefault(signature, {})
+            for variant in failed:
+                variants.setdefault(variant, [0, 0])[1] += 1
+            if found is not None:
+                counts = variants.setdefault(found, [0, 0])
+                counts[0] += 1
+                counts[1] += 1
+            self.unsaved += 1
+            save = self.unsaved >= self.save_every
+
+        if save:
+            self.save()
+
+    def save(self):
+        """
+        Writes the statistics to disk (through a temporary file so a crash never leaves half a file behind)
+        """
+
+        with self.lock:
+            self.unsaved = 0
+            if not self.path:
+                return
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as file:
+                json.dump(self.table, file, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+
+    def reset(self):
+        """
+        Forgets every recorded outcome and saves the empty statistics
+        """
+
+        with self.lock:
+            self.table = {}
+        self.save()
+
+    def report(self):
+        """
+        Formats the statistics as a table, most common signatures first
+        :return: string with one line per signature and variant
+        """
+
+        with self.lock:
+            rows = sorted(self.table.items(), key=lambda item: -sum(counts[1] for counts in item[1].values()))
+            lines = []
+            for signature_name, variants in rows:
+                lines.append(signature_name)
+                for variant, (successes, attempts) in sorted(variants.items(), key=lambda item: -item[1][0]):
+                    lines.append('    %-45s %6d / %-6d found' % (variant, successes, attempts))
+            return '\n'.join(lines)
+
+
+def main():
+    """
+    Shows or resets the learned statistics from the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Shows or resets which fallback variants find genius links')
+    parser.add_argument('action', choices=['show', 'json', 'reset'], help='print as a table, print as JSON or reset')
+    parser.add_argument('--path', default=STATS_PATH, help='location of the statistics file')
+    arguments = parser.parse_args()
+
+    stats = CandidateStats(arguments.path)
+    if arguments.action == 'show':
+        print(stats.report() or 'no resolutions recorded yet')
+    elif arguments.action == 'json':
+        print(json.dumps(stats.table, indent=2, sort_keys=True))
+    else:
+        stats.reset()
+        print('statistics reset')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+import argparse
+import csv
+import json
+import sys
+import time
+
+import genius_link
+
+
+# number of rows read, normalized and written at once
+CHUNK_ROWS = 100000
+
+# number of distinct songs whose slugs are remembered across chunks before the memory is cleared
+MEMO_SIZE = 1000000
+
+# separator between the artists of a song in a csv column (artist names can hold commas, such as Tyler, The Creator)
+ARTIST_SEPARATOR = ';'
+
+# characters joining strings which are cleaned in one call, never part of a title or artist name
+JOINER = '\x00'
+
+
+def remove_accents_all(strings):
+    """
+    Removes the accents from many strings at once, the same way genius_link.remove_accents does one at a time
+    :param strings: list of strings
+    :return: list of the strings without accents, in the same order
+    """
+
+    # ascii strings are left as they are by unidecode, only the others go through it, all of them in a single call
+    # (unidecode replaces one character at a time, so joining the strings never changes the result)
+    others = [num for num, string in enumerate(strings) if not string.isascii()]
+    cleaned = list(strings)
+    if others:
+        for num, string in zip(others, genius_link.remove_accents(JOINER.join(strings[num] for num in others))
+                               .split(JOINER)):
+            cleaned[num] = string
+    return cleaned
+
+
+class ArtistWords:
+    """
+    Words of the artists of a column, computed once per distinct name and passed to genius_link.Slug.from_track in
+    place of an ArtistIndex
+    """
+
+    def __init__(self):
+        # artist name -> (lowercased words, words of the name as spotify lists it)
+        self.known = {}
+
+    def add(self, names):
+        """
+        Computes the words of every name not seen before, removing the accents of all of them in one pass
+        :param names: iterable of artist names
+        """
+
+        names = [name for name in set(names) if name not in self.known]
+        unaccented = remove_accents_all([name.lower() for name in names] + names)
+        for num, name in enumerate(names):
+            # the same words genius_link.artist_words determines for one name
+            self.known[name] = (tuple(word[:-1] for word in genius_link.split_artists([unaccented[num]])),
+                                tuple(word[:-1] for word in genius_link.split_artists([unaccented[len(names) + num]])))
+
+    def words(self, artist):
+        """
+        Looks up the words of an artist
+        :param artist: spotify artist object
+        :return: tuple of the lowercased words and the words of the name as spotify lists it
+        """
+
+        return self.known[artist['name']]
+
+    def clear(self):
+        """
+        Forgets every artist seen so far
+        """
+
+        self.known.clear()
+
+
+class ColumnarNormalizer:
+    """
+    Builds the genius slugs of whole columns of titles and artist lists, running the cleanup once per distinct song and
+    once per distinct artist and broadcasting the results back to every row
+    """
+
+    def __init__(self, exhaustive=False, memo_size=MEMO_SIZE):
+        """
+        Sets up the memory of the songs seen so far
+        :param exhaustive: if True every combination of fallback rules is kept as a candidate
+        :param memo_size: number of distinct songs remembered across chunks before the memory is cleared
+        """
+
+        self.exhaustive = exhaustive
+        self.memo_size = memo_size
+        self.artist_words = ArtistWords()
+
+        # (artist names, lowercase title) -> (slug, list of candidate slugs)
+        self.memo = {}
+
+        # counters of the rows seen, the distinct songs actually normalized and the songs which broke the cleanup or
+        # could not be read
+        self.rows = 0
+        self.normalized = 0
+        self.errors = 0
+
+    def normalize(self, artists, titles):
+        """
+        Builds the slugs of a chunk of rows
+        :param artists: list of the artist names of every row (each a list of names, main artist first)
+        :param titles: list of the titles of every row, as spotify lists them
+        :return: tuple of the list of slugs and the list of candidate slug lists of every row (slugs are genius links
+            without the genius url and the '-lyrics' ending, the first candidate is the slug)
+        """
+
+        # every row is reduced to the key of its song, the work below only runs for songs not seen before (a missing
+        # title, such as an empty or absent csv cell or a null in parquet or pandas, is kept as None)
+        keys = [(tuple(names), title.lower() if isinstance(title, str) and title.strip() else None)
+                for names, title in zip(artists, titles)]
+        # the artists are forgotten along with the songs, so neither grows without bound on huge exports
+        if len(self.memo) > self.memo_size:
+            self.memo.clear()
+            self.artist_words.clear()
+        new = [key for key in dict.fromkeys(keys) if key not in self.memo]
+        self.artist_words.add(name for names, title in new for name in names if isinstance(name, str))
+
+        start, end = len(genius_link.GENIUS_URL), -len('-lyrics')
+        for names, title in new:
+            # rows without a title or without readable artists get an empty slug and are counted, the file goes on
+            if title is None or not names or not all(isinstance(name, str) for name in names):
+                self.errors += 1
+                self.memo[(names, title)] = ('', [])
+                continue
+            artists_json = [{'name': name} for name in names]
+            # one title which breaks the cleanup rules gets its simplified slug instead of stopping the whole file
+            try:
+                slug = genius_link.Slug.from_track(artists_json, title, artist_index=self.artist_words)
+            except Exception:
+                self.errors += 1
+                try:
+                    slug = genius_link.Slug.simple(artists_json, title)
+                except Exception:
+                    self.memo[(names, title)] = ('', [])
+                    continue
+            candidates = [link[start:end] for variant, link in slug.variants(self.exhaustive)]
+            self.memo[(names, title)] = (candidates[0], candidates)
+
+        self.rows += len(keys)
+        self.normalized += len(new)
+
+        # broadcasts the result of every song back to its rows
+        results = [self.memo[key] for key in keys]
+        return [slug for slug, candidates in results], [candidates for slug, candidates in results]
+
+
+def parse_artists(value, separator=ARTIST_SEPARATOR):
+    """
+    Reads the artists of a row, which can be a list already, a JSON list or names joined by a separator
+    :param value: artists cell of the row
+    :param separator: separator between the names in a plain string
+    :return: list of artist names (empty if the cell is missing, the normalizer then gives the row an empty slug)
+    """
+
+    if isinstance(value, (list, tuple)):
+        return [artist.get('name') if isinstance(artist, dict) else artist for artist in value]
+    # a missing cell is None in csv and parquet and a float nan in pandas
+    if not isinstance(value, str):
+        return []
+    if value.startswith('['):
+        # names can start with a bracket too (such as [dunkelbunt]), so a cell which is not a JSON list is split
+        try:
+            return parse_artists(json.loads(value), separator)
+        except ValueError:
+            pass
+    return [name.strip() for name in value.split(separator) if name.strip()]
+
+
+def normalize_frame(frame, artists_column='artists', title_column='title', exhaustive=False):
+    """
+    Adds the slug columns to a pandas data frame (pandas itself is never imported, any frame with list-like columns
+    works)
+    :param frame: data frame holding an artists column and a title column
+    :param artists_column: name of the column holding the artists of every row
+    :param title_column: name of the column holding the title of every row
+    :param exhaustive: if True every combination of fallback rules is kept as a candidate
+    :return: the frame with 'slug' and 'candidates' columns added
+    """
+
+    artists = [parse_artists(value) for value in frame[artists_column].tolist()]
+    frame['slug'], frame['candidates'] = ColumnarNormalizer(exhaustive).normalize(artists,
+                                                                                  frame[title_column].tolist())
+    return frame
+
+
+def normalize_csv(source, destination, normalizer, artists_column, title_column, chunk_rows=CHUNK_ROWS,
+                  separator=ARTIST_SEPARATOR):
+    """
+    Streams a csv file through the normalizer, writing every row back out with its slug columns
+    :param source: file object of the csv being read
+    :param destination: file object the csv with the slug columns is written to
+    :param normalizer: ColumnarNormalizer building the slugs
+    :param artists_column: name of the column holding the artists of every row
+    :param title_column: name of the column holding the title of every row
+    :param chunk_rows: number of rows read, normalized and written at once
+    :param separator: separator between the artists of a row
+    """
+
+    reader = csv.DictReader(source)
+    writer = csv.DictWriter(destination, reader.fieldnames + ['slug', 'candidates'])
+    writer.writeheader()
+
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) < chunk_rows:
+            continue
+        write_csv_chunk(writer, chunk, normalizer, artists_column, title_column, separator)
+        chunk = []
+    if chunk:
+        write_csv_chunk(writer, chunk, normalizer, artists_column, title_column, separator)
+
+
+def write_csv_chunk(writer, chunk, normalizer, artists_column, title_column, separator):
+    """
+    Normalizes one chunk of csv rows and writes it out
+    :param writer: csv.DictWriter of the destination
+    :param chunk: list of csv rows
+    :param normalizer: ColumnarNormalizer building the slugs
+    :param artists_column: name of the column holding the artists of every row
+    :param title_column: name of the column holding the title of every row
+    :param separator: separator between the artists of a row
+    """
+
+    slugs, candidates = normalizer.normalize([parse_artists(row[artists_column], separator) for row in chunk],
+                                             [row[title_column] for row in chunk])
+    for row, slug, row_candidates in zip(chunk, slugs, candidates):
+        row['slug'] = slug
+        row['candidates'] = ' '.join(row_candidates)
+    writer.writerows(chunk)
+
+
+def normalize_parquet(source, destination, normalizer, artists_column, title_column, chunk_rows=CHUNK_ROWS,
+                      separator=ARTIST_SEPARATOR):
+    """
+    Streams a parquet file through the normalizer one record batch at a time, writing the slug columns next to the
+    original ones (needs pyarrow)
+    :param source: location of the parquet file being read
+    :param destination: location the parquet file with the slug columns is written to
+    :param normalizer: ColumnarNormalizer building the slugs
+    :param artists_column: name of the column holding the artists of every row (a list or a string column)
+    :param title_column: name of the column holding the title of every row
+    :param chunk_rows: number of rows read, normalized and written at once
+    :param separator: separator between the artists of a row in a string column
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    reader = pq.ParquetFile(source)
+    writer = None
+    try:
+        for batch in reader.iter_batches(batch_size=chunk_rows):
+            artists = [parse_artists(value, separator) for value in batch.column(artists_column).to_pylist()]
+            slugs, candidates = normalizer.normalize(artists, batch.column(title_column).to_pylist())
+            table = pa.Table.from_batches([batch])
+            table = table.append_column('slug', pa.array(slugs, pa.string()))
+            table = table.append_column('candidates', pa.array(candidates, pa.list_(pa.string())))
+            if writer is None:
+                writer = pq.ParquetWriter(destination, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def main():
+    """
+    Normalizes a csv or parquet export from the command line and reports the throughput
+    """
+
+    parser = argparse.ArgumentParser(description='Adds genius slug columns to csv or parquet files of songs')
+    parser.add_argument('input', help='csv or parquet file of songs (- reads csv from standard input)')
+    parser.add_argument('output', help='file the rows are written to with their slugs (- writes csv to standard '
+                                       'output)')
+    parser.add_argument('--artists-column', default='artists',
+                        help='column holding the artists of every row (a list, a JSON list or names separated by ;)')
+    parser.add_argument('--title-column', default='title', help='column holding the title of every row')
+    parser.add_argument('--separator', default=ARTIST_SEPARATOR, help='separator between the artists of a row')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='number of rows normalized at once')
+    parser.add_argument('--exhaustive', action='store_true', help='keep every combination of fallback rules')
+    arguments = parser.parse_args()
+
+    normalizer = ColumnarNormalizer(arguments.exhaustive)
+    start = time.perf_counter()
+
+    if arguments.input.endswith('.parquet'):
+        try:
+            normalize_parquet(arguments.input, arguments.output, normalizer, arguments.artists_column,
+                              arguments.title_column, arguments.chunk_rows, arguments.separator)
+        except ImportError:
+            parser.error('reading and writing parquet files needs pyarrow (pip install pyarrow)')
+    else:
+        source = sys.stdin if arguments.input == '-' else open(arguments.input, newline='', encoding='utf-8')
+        destination = sys.stdout if arguments.output == '-' else open(arguments.output, 'w', newline='',
+                                                                      encoding='utf-8')
+        try:
+            normalize_csv(source, destination, normalizer, arguments.artists_column, arguments.title_column,
+                          arguments.chunk_rows, arguments.separator)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if destination is not sys.stdout:
+                destination.close()
+
+    # throughput is reported on standard error so it never mixes with the rows
+    elapsed = time.perf_counter() - start
+    print('%d rows (%d distinct songs, %d given a simplified or empty slug after an error) in %.2f s (%.1f rows/sec)'
+          % (normalizer.rows, normalizer.normalized, normalizer.errors, elapsed,
+             normalizer.rows / elapsed if elapsed else 0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,164 @@
-import spotipy
 import re
-import requests
-from requests.exceptions import HTTPError
-import unidecode
 import os
+import sys
+import time
+from collections import namedtuple
 
+import instrumentation
 
-def get_user(username):
+# spotipy, requests, unidecode and the resolution cache are imported inside the functions which use them, so importing
+# this module for the slug functions alone does not pay for the oauth and http stacks
+
+
+# spotify user the program runs for when none is given on the command line
+USERNAME = os.environ.get('spotify_username', 'raghu2001')
+
+# base of every genius lyrics link (can be pointed at a local server for testing)
+GENIUS_URL = 'https://genius.com/'
+
+# number of seconds to wait for genius to answer a single probe
+PROBE_TIMEOUT = 10
+
+# status codes which mean a link does not exist, any other answer than a 200 (a 429, a 5xx, no answer at all) says
+# nothing about the link
+MISSING_STATUSES = (404, 410)
+
+# largest number of probes sent to genius at the same time by the whole process, the connection pool of the shared
+# session is sized to match so every probe reuses a kept-alive connection
+PROBE_CONCURRENCY = 8
+
+# pooled keep-alive session shared by every probe, created the first time a link is probed
+session = None
+
+# executor every probe runs on, created the first time a link is probed (bounds the probes of every thread at once)
+probe_executor = None
+
+# spotify permissions asked for, prefetching also needs to read the queue, recently played and top tracks
+SCOPE = 'user-read-private user-read-email user-read-currently-playing'
+PREFETCH_SCOPE = SCOPE + ' user-read-playback-state user-read-recently-played user-top-read'
+
+# RateLimiter every probe waits on before it is sent (None sends probes straight away)
+rate_limiter = None
+
+# number of times a probe answered with a 429 is sent again once the rate limiter lets it through
+RATE_LIMIT_RETRIES = 3
+
+# fingerprint of the cleanup rules stored with every cached link, computed the first time it is needed
+rules_fingerprint = None
+
+# bounds in seconds on how long the watcher waits between polls while a song is playing
+WATCH_MIN_INTERVAL = 1
+WATCH_MAX_INTERVAL = 15
+
+# bounds in seconds on how long the watcher waits between polls while playback is paused or idle (doubles every poll)
+WATCH_IDLE_INTERVAL = 5
+WATCH_MAX_IDLE_INTERVAL = 60
+
+
+# titles longer than this skip the cleanup rules and get the simplified slug, some of the rules take time quadratic in
+# the length of titles full of containers and feat markers (see benchmarks/adversarial.py)
+MAX_TITLE_LENGTH = 300
+
+# number of seconds the cleanup of one title may take, checked after every stage, before the simplified slug is used
+TITLE_TIME_BUDGET = 0.05
+
+# precompiled pattern finding where the simplified slug cuts the title (a single character class or literal, so the
+# search is linear in the length of the title)
+SIMPLE_TITLE_END = re.compile(r'[(\[]| - ')
+
+
+# matches every feat/with marker, keyword and structural character in one scan of the title, used to skip the
+# cleanup rules which cannot apply (keywords are matched as plain substrings because the rules treat them that way too)
+TITLE_LEXER = re.compile(r'feat|with|remastered|bonus|acoustic|medley|prelude|intro|outro|interlude|[()\[\]/\\-]')
+
+# maps every match of TITLE_LEXER onto its token type, the kind of cleanup rule it can trigger
+TOKEN_TYPES = {
+    'feat': 'feat', 'with': 'feat',
+    'remastered': 'strip', 'bonus': 'strip', 'acoustic': 'strip', 'medley': 'strip',
+    'prelude': 'keep', 'intro': 'keep', 'outro': 'keep', 'interlude': 'keep',
+    '(': 'open', '[': 'open', ')': 'close', ']': 'close',
+    '/': 'slash', '\\': 'slash',
+    '-': 'hyphen',
+}
+
+# precompiled patterns used by regex_remove_artists and remove_artists_featured to find the featured artists
+FEAT_CONTAINER_ARTISTS = re.compile(r'((?<=feat)[\w\s.,@_!#$%^&*<>?\/|\}{~:\)\]-]+(?=([\[\(])))')
+FEAT_ARTISTS = re.compile(r'(?=(feat.))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([()\[\]]))')
+FEAT_IN_CONTAINER = re.compile(r'[(\[](?=(feat))')
+FEAT_AFTER_HYPHEN = re.compile(r'-[\s]?(?=(feat.))')
+FEAT_ANY_CASE = re.compile('feat.', re.IGNORECASE)
+CONTAINER_BODY = re.compile(r'[^)\]]+')
+ARTIST_SEPARATORS = re.compile('[,&]')
+
+# precompiled patterns used by split_artists to clean up the artist names
+ARTIST_PUNCTUATION = re.compile(r'[\'’.,?\\/]+')
+ARTIST_SPACED_PUNCTUATION = re.compile(r'[$]+')
+
+# precompiled patterns used by remove_end_track to clean up the track name
+TRACK_PUNCTUATION = re.compile(r'[\'’.,?]')
+TRACK_SPACED_PUNCTUATION = re.compile(r'[$!]+')
+FEAT_MARKER_CONTAINED = re.compile(r'[(\[-]+[\s]?(?=(feat.|with))')
+FEAT_MARKER_BRACKETED = re.compile(r'[(\[]+(?=(feat.|with))')
+FEAT_CLAUSE_BRACKETED = re.compile(r'[(\[]+(?=(feat.|with))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([)\]]))[)\]]')
+FEAT_MARKER_HYPHENATED = re.compile(r'[-]?[\s]+(?=(feat.|with))')
+FEAT_CLAUSE_HYPHENATED = re.compile(r'[-]?[\s]+(?=(feat.|with))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+')
+FEAT_MARKER_LOOSE = re.compile(r'(?<!\()(?<!\[)(?<!-)(feat.|with)')
+FEAT_CLAUSE_LOOSE_BEFORE_CONTAINER = \
+    re.compile(r'(?<!\()(?<!\[)(?<!-)(feat|with)[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([()\[\]]))')
+FEAT_CLAUSE_LOOSE = re.compile(r'(?<!\()(?<!\[)(?<!-)(feat|with)[\w\s.,@_!#$%^&*<>?/|\}{~:-]+')
+STRIP_KEYWORD_SUFFIX = re.compile(r'[\-][\s]?(?=(remastered|bonus|acoustic|medley))[\w\s.,@_!#$%^&*()<>?/|\}{~:-]+')
+KEEP_KEYWORD_CONTAINERS = re.compile('[()[]-]+')
+CONTAINER = re.compile(r'[\[(]+[\w\s.,@_!#$%^&*<>?/|\}{~:-]+[\])]+')
+CONTAINER_NESTED = re.compile(r'[\[(]+[\w\s.,@_!#$%^&*()<>?/|\}{~:-]+[\])]+')
+FEAT_MARKER = re.compile('feat.')
+FEAT_CONTAINER_REST = re.compile(r'(?<=(feat.))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+')
+CONTAINER_CHARACTERS = re.compile('[(\)\[\]]+')
+SLASH = re.compile(r'(?:[\s]?[/\\]+[\s]?)')
+
+
+def title_features(track_name):
+    """
+    Determines which token types appear in a track name, used to skip the cleanup rules which cannot apply
+    :param track_name: name of the song
+    :return: set of token types present in the track name ('feat', 'strip', 'keep', 'open', 'close', 'slash' and
+        'hyphen')
+    """
+
+    # one scan of the title finds every marker, the text in between them is never sliced out
+    return {TOKEN_TYPES[token] for token in TITLE_LEXER.findall(track_name)}
+
+
+def get_user(username, cache_path=None, requests_session=True, api_url=None, accounts_url=None, scope=SCOPE):
     """
     Authenticates user to spotify developer app by creating spotify authentication object from username
+    :param username: spotify user being authenticated
+    :param cache_path: file the access and refresh tokens of the user are kept in (defaults to .cache-<username>)
+    :param requests_session: requests session shared by every spotify request (True creates one for the user)
+    :param api_url: base url of the spotify web api (defaults to spotify's own, changed to test against a stand-in)
+    :param accounts_url: base url of the spotify accounts service (defaults to spotify's own)
+    :param scope: spotify permissions asked for (PREFETCH_SCOPE to allow prefetching)
     :return: spotify user object
     """
 
+    import spotipy
+
     # grabs the client_id and client_id_secret from the spotify developer app (keys stored on computer)
     client_id = os.environ.get('spotify_client_id')
     client_id_secret = os.environ.get('spotify_client_id_secret')
 
     # implements the o_auth_2 model which connects used to spotify developer app (generates access/refresh keys)
     o_auth_object = spotipy.oauth2.SpotifyOAuth(client_id=client_id, client_secret=client_id_secret, state='code',
-                                                scope='user-read-private user-read-email user-read-currently-playing',
-                                                username=username, redirect_uri='http://localhost:8888/callback')
+                                                scope=scope,
+                                                username=username, redirect_uri='http://localhost:8888/callback',
+                                                cache_path=cache_path, requests_session=requests_session)
+    if accounts_url:
+        o_auth_object.OAUTH_AUTHORIZE_URL = accounts_url + 'authorize'
+        o_auth_object.OAUTH_TOKEN_URL = accounts_url + 'api/token'
 
     # implements the client model and allows access to user information (depends on scope provided)
-    user = spotipy.Spotify(auth_manager=o_auth_object)
+    user = spotipy.Spotify(auth_manager=o_auth_object, requests_session=requests_session)
+    if api_url:
+        user.prefix = api_url
 
     # returns the user object
     return user
@@ -35,15 +171,8 @@ def remove_unnecessary_punctuation(list_check):
     :return: list_check after removing any redundancies
     """
 
-    # list to store any values which should be removed from list_check
-    remove = []
-
-    # iterates through list_check and removes all unnecessary punctuation
-    for num, i in enumerate(list_check):
-        if i == '' or i == '-' or i == ' ':
-            remove.append(num)
-    for i in sorted(remove, reverse=True):
-        del list_check[i]
+    # keeps every element which is not unnecessary punctuation (the list is edited in place)
+    list_check[:] = [i for i in list_check if i != '' and i != '-' and i != ' ']
 
     # returns edited list
     return list_check
@@ -57,16 +186,15 @@ def remove_elements(list_iter, list_check):
     :return: cleaned version of list_iter
     """
 
-    # list to store any values which should be removed from list_check
-    remove = []
+    if not list_check:
+        return list_iter
+
+    # an element is removed if it is part of any element of list_check, joining list_check on a character that never
+    # appears in names turns that into a single substring search per element instead of one per pair of elements
+    joined_check = '\x00'.join(list_check)
 
-    # iterates through list_iter and removes any elements in list_check from list_iter
-    for num, i in enumerate(list_iter):
-        for j in list_check:
-            if i in j:
-                remove.append(num)
-    for i in sorted(remove, reverse=True):
-        del list_iter[i]
+    # keeps every element of list_iter not found in list_check (the list is edited in place)
+    list_iter[:] = [i for i in list_iter if i not in joined_check]
 
     # returns cleaned version of list_iter
     return list_iter
@@ -79,6 +207,8 @@ def remove_accents(input_str):
     :return: cleaned version of artist name or track name
     """
 
+    import unidecode
+
     # cleans up input string (removes the accents)
     unaccented_string = unidecode.unidecode(input_str)
 
@@ -89,39 +219,41 @@ def remove_accents(input_str):
 def regex_remove_artists(regex_string, track_name, find_group, exclude_artists):
     """
     This method is used as a dependency to remove_artists_featured to extract artist names who are featured in a track
-    :param regex_string: string pattern being search for
+    :param regex_string: string or precompiled pattern being search for
     :param track_name: the actual name of the track to look at the featured artists on it
     :param find_group: boolean variable to denote if featured artists are contained in some kind of brackets
     :param exclude_artists: the actual list object being passed in as a reference
     :return: pass back the updated version of the referenced exclude_artists list
     """
 
+    # position of the feat. marker in the track name
+    feat_position = track_name.find('feat.')
+
     # if else statement searches through the track name to extract artist names contained in the feat section
     # the if statement checks for the regex expressions where there is extra information after the feat artists
     # the else statement only runs if there is no extra information after the feat artists
-    if re.search(regex_string, track_name):
-        # finds the match in the track name and returns to the user
-        match = re.search(regex_string, track_name)
-        substring_track_name = track_name[track_name.find('feat.') + 6:track_name.find('feat.') + 6 + len(match.group(0)
-                                                                                                          ) - 2]
+    match = re.search(regex_string, track_name)
+    if match:
+        # takes the artist names out of the track name using the length of the match
+        substring_track_name = track_name[feat_position + 6:feat_position + 6 + len(match.group(0)) - 2]
     else:
         # first statement is run if the feat. artists names are contained in some sort of container
         if find_group:
             # finds the artist names in the track removing the brackets
-            substring_track_name = re.match(r'[^)\]]+', track_name[track_name.find('feat.') + 6:])
+            substring_track_name = CONTAINER_BODY.match(track_name[feat_position + 6:])
             substring_track_name = substring_track_name.group(0)
         # this statement is run if the feat. artists are not contained in some sort of container
         else:
             # finds the artist names in the track
-            substring_track_name = track_name[track_name.find('feat.') + 6:]
+            substring_track_name = track_name[feat_position + 6:]
             substring_track_name = substring_track_name.strip()
 
     # removes any mention of the word 'and' with ',' in the substring
-    substring_track_name = re.sub(' and ', ',', substring_track_name)
+    substring_track_name = substring_track_name.replace(' and ', ',')
 
     # if else statement splits artists along the commas and the ampersands and adds it to exclude_artist list
-    if re.search('[,&]+', substring_track_name):
-        multiple_artists_exclude = re.split('[,&]', substring_track_name)
+    if ',' in substring_track_name or '&' in substring_track_name:
+        multiple_artists_exclude = ARTIST_SEPARATORS.split(substring_track_name)
         multiple_artists_exclude = [artist.strip() for artist in multiple_artists_exclude]
         exclude_artists.extend(multiple_artists_exclude)
     else:
@@ -131,42 +263,47 @@ def regex_remove_artists(regex_string, track_name, find_group, exclude_artists):
     return exclude_artists
 
 
-def remove_artists_featured(artists_json, track_name):
+def kept_artists(artists_json, track_name):
     """
-    Determines the relevant artists who were responsible for song
+    Determines the relevant artists who were responsible for song, without cleaning up their names
     :param artists_json: an list containing the names of all artists responsible in anyway for the making of the song
     :param track_name: the name of the song
-    :return: list of all relevant artists who were responsible for the song
+    :return: list of the spotify artist objects of all relevant artists (featured artists are left out)
     """
 
     # list of artists to exclude from genius link
     exclude_artists = []
 
     # if elif statements to check the different kinds of way artists might be featured in the song title
-    # if statement checks for '(feat. ---)'
-    if re.search(r'[(\[](?=(feat))', track_name):
-        exclude_artists = \
-            regex_remove_artists(
-                r'((?<=feat)[\w\s.,@_!#$%^&*<>?\/|\}{~:\)\]-]+(?=([\[\(])))', track_name, True, exclude_artists)
-    # elif statement checks for '-feat. --- ('
-    elif re.search(r'-[\s]?(?=(feat.))', track_name):
-        regex_remove_artists(r'(?=(feat.))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([()\[\]]))', track_name, False,
-                             exclude_artists)
-    # elif statement checks for 'feat. --- ('
-    elif re.search('feat.', track_name, re.IGNORECASE):
-        regex_remove_artists(r'(?=(feat.))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([()\[\]]))', track_name, False,
-                             exclude_artists)
-
-    # saves all artists who are responsible in making of song in list
-    all_artists = [artists_json[i]['name'].lower() for i in range(len(artists_json))]
-    print(all_artists, exclude_artists)
-
-    # removes feat artists in exclude_artists list
-    all_artists = remove_elements(all_artists, exclude_artists)
-
-    # removes the accents from the artist names
-    for num, i in enumerate(all_artists):
-        all_artists[num] = remove_accents(i)
+    # none of them can match unless TITLE_LEXER finds a feat marker, so most titles skip the searches entirely
+    if 'feat' in title_features(track_name.lower()):
+        # if statement checks for '(feat. ---)'
+        if FEAT_IN_CONTAINER.search(track_name):
+            exclude_artists = regex_remove_artists(FEAT_CONTAINER_ARTISTS, track_name, True, exclude_artists)
+        # elif statement checks for '-feat. --- ('
+        elif FEAT_AFTER_HYPHEN.search(track_name):
+            regex_remove_artists(FEAT_ARTISTS, track_name, False, exclude_artists)
+        # elif statement checks for 'feat. --- ('
+        elif FEAT_ANY_CASE.search(track_name):
+            regex_remove_artists(FEAT_ARTISTS, track_name, False, exclude_artists)
+
+    # an artist is left out if its name is part of any excluded name, the same check remove_elements makes
+    if not exclude_artists:
+        return list(artists_json)
+    joined_check = '\x00'.join(exclude_artists)
+    return [artist for artist in artists_json if artist['name'].lower() not in joined_check]
+
+
+def remove_artists_featured(artists_json, track_name):
+    """
+    Determines the relevant artists who were responsible for song
+    :param artists_json: an list containing the names of all artists responsible in anyway for the making of the song
+    :param track_name: the name of the song
+    :return: list of all relevant artists who were responsible for the song
+    """
+
+    # saves all relevant artists in making of song in list, lowercased and without accents
+    all_artists = [remove_accents(artist['name'].lower()) for artist in kept_artists(artists_json, track_name)]
 
     # returns all_artists list containing all relevant artists in making of song
     return all_artists
@@ -185,19 +322,16 @@ def split_artists(all_artists):
 
     # for loop goes through each artist in the track and subs out any abnormal characters
     for num, i in enumerate(all_artists):
-        all_artists[num] = re.sub(r'[\'’.,?\\/]+', '', all_artists[num])
-        all_artists[num] = re.sub(r'[$]+', ' ', all_artists[num])
+        all_artists[num] = ARTIST_SPACED_PUNCTUATION.sub(' ', ARTIST_PUNCTUATION.sub('', i))
 
     # list holds all individual artists after their names are split on spaces
-    all_artists_split = []
-    [all_artists_split.extend(i.split(' ')) for i in all_artists]
+    all_artists_split = [word for artist in all_artists for word in artist.split(' ')]
 
     # removes any unnecessary characters which might disrupt the genius link by adding unnecessary elements
     all_artists_split = remove_unnecessary_punctuation(all_artists_split)
 
     # list of individual elements of the artist portion of the genius link (includes every artist name split on space)
     all_artists_split = [i + '-' for i in all_artists_split]
-    [all_artists_split.remove(i) for i in all_artists_split if i == '-']
 
     # returns the final list used in genius link formation
     return all_artists_split
@@ -216,14 +350,16 @@ def remove_end_track(track_name, all_artists_split):
         track_name_slashed - contains information after the slash in song titles
     """
 
-    print(track_name)
-
     # remove accents from track name
     track_name = remove_accents(track_name)
 
     # statement goes through each artist in the track and subs out any abnormal characters
-    track_name = re.sub(r'[\'’.,?]', '', track_name)
-    track_name = re.sub(r'[$!]+', ' ', track_name)
+    track_name = TRACK_PUNCTUATION.sub('', track_name)
+    track_name = TRACK_SPACED_PUNCTUATION.sub(' ', track_name)
+
+    # scans the track name for markers once, each rule below only runs if the markers it looks for are present
+    # the track name is scanned again only after a rule actually changed it
+    features = title_features(track_name)
 
     # boolean variable which assesses if information (the artist names) is in the parenthesis
     important_in_par = False
@@ -240,37 +376,42 @@ def remove_end_track(track_name, all_artists_split):
 
     # if statements check for information inside of the track name
     # if statement searches for the feat. or with within some kind of container
-    if re.search(r'[(\[-]+[\s]?(?=(feat.|with))', track_name):
+    if 'feat' in features and FEAT_MARKER_CONTAINED.search(track_name):
         # if statement looks for feat. or with contained in brackets
-        if re.search(r'[(\[]+(?=(feat.|with))', track_name):
+        if FEAT_MARKER_BRACKETED.search(track_name):
             # cleans up the track name by cleaning up the feat. or with statement completely
-            track_name = re.sub(r'[(\[]+(?=(feat.|with))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([)\]]))[)\]]', '', track_name)
+            track_name, count = FEAT_CLAUSE_BRACKETED.subn('', track_name)
         # elif statement looks for feat. or with after hyphen
-        elif re.search(r'[-]?[\s]+(?=(feat.|with))', track_name):
+        elif FEAT_MARKER_HYPHENATED.search(track_name):
             # cleans up the track name by cleaning up the feat. or with statement completely
-            track_name = re.sub(r'[-]?[\s]+(?=(feat.|with))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+', '', track_name)
+            track_name, count = FEAT_CLAUSE_HYPHENATED.subn('', track_name)
+        else:
+            count = 0
+        if count:
+            features = title_features(track_name)
     # if statement searches for feat. or with when it is not enclosed within some kind of container
-    if re.search(r'(?<!\()(?<!\[)(?<!-)(feat.|with)', track_name):
+    if 'feat' in features and FEAT_MARKER_LOOSE.search(track_name):
         # if there is a container afterwards, subs in everything before it
-        if re.search(r'(?<!\()(?<!\[)(?<!-)(feat|with)[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([()\[\]]))', track_name):
-            # cleans up track name by substituting the feat. or with part before the container
-            track_name = re.sub(r'(?<!\()(?<!\[)(?<!-)(feat|with)[\w\s.,@_!#$%^&*<>?/|\}{~:-]+(?=([()\[\]]))', '',
-                                track_name)
+        track_name, count = FEAT_CLAUSE_LOOSE_BEFORE_CONTAINER.subn('', track_name)
         # if there is no container afterwards, subs in everything after feat. or with
-        else:
-            # cleans up track name by substituting the feat. or with part
-            track_name = re.sub(r'(?<!\()(?<!\[)(?<!-)(feat|with)[\w\s.,@_!#$%^&*<>?/|\}{~:-]+', '', track_name)
+        if not count:
+            track_name, count = FEAT_CLAUSE_LOOSE.subn('', track_name)
+        if count:
+            features = title_features(track_name)
     # if statement looks for remastered, bonus, acoustic, or medley within the track name
-    if 'remastered' in track_name or 'bonus' in track_name or 'acoustic' in track_name or 'medley' in track_name:
+    if 'strip' in features:
         # cleans up track name by cleaning up the remastered, bonus, acoustic, medley statement completely
-        track_name = re.sub(r'[\-][\s]?(?=(remastered|bonus|acoustic|medley))[\w\s.,@_!#$%^&*()<>?/|\}{~:-]+', '',
-                            track_name)
+        track_name, count = STRIP_KEYWORD_SUFFIX.subn('', track_name)
+        if count:
+            features = title_features(track_name)
     # if statement looks for prelude, intro, outro, or interlude within the track name
-    if 'prelude' in track_name or 'intro' in track_name or 'outro' in track_name or 'interlude' in track_name:
+    if 'keep' in features:
         # cleans up track name by removing any sort of brackets or hyphens (genius link uses those words)
-        track_name = re.sub('[()[]-]+', '', track_name)
+        track_name, count = KEEP_KEYWORD_CONTAINERS.subn('', track_name)
+        if count:
+            features = title_features(track_name)
     # if statement searches for any information in containers
-    if re.search(r'[\[(]+[\w\s.,@_!#$%^&*<>?/|\}{~:-]+[\])]+', track_name):
+    if 'open' in features and 'close' in features and CONTAINER.search(track_name):
         # surfs through relevant artists and if a relevant artist appears inside, sets important_in_par to True
         for i in all_artists_split:
             if i in track_name:
@@ -280,37 +421,37 @@ def remove_end_track(track_name, all_artists_split):
         # if a relevant artist exists within the container, then this statement runs
         if important_in_par:
             # if feat. exists in the container, it is replaced with '' along with the rest of the statement
-            if re.search('feat.', track_name):
+            if FEAT_MARKER.search(track_name):
                 # cleans up track name by removing all information in the parenthesis along with the 'feat.' word
-                track_name = re.sub(r'(?<=(feat.))[\w\s.,@_!#$%^&*<>?/|\}{~:-]+', '', track_name).replace('feat.', '')
+                track_name = FEAT_CONTAINER_REST.sub('', track_name).replace('feat.', '')
             # if feat. does not exist in the container, then this code is run
             else:
                 # cleans up track name by removing the information in the container
-                track_name = re.sub(r'[\[(]+[\w\s.,@_!#$%^&*()<>?/|\}{~:-]+[\])]+', '', track_name)
+                track_name = CONTAINER_NESTED.sub('', track_name)
         # if no artist name lies within the container, then this statement runs
         else:
-            print("DSFDSFDFDF")
             # this block stores the information inside of container in the extra_information variable
             # if the genius link does not work normally, this information can be removed from the end
-            extra_information = re.search(r'[\[(]+[\w\s.,@_!#$%^&*()<>?/|\}{~:-]+[\])]+', track_name)
-            extra_information = re.sub('[(\)\[\]]+', '', extra_information.group(0))
+            extra_information = CONTAINER_NESTED.search(track_name)
+            extra_information = CONTAINER_CHARACTERS.sub('', extra_information.group(0))
             # stores the words inside the container in an list, so it can be easily plugged into genius link
             extra_information = extra_information.split(' ')
             # removes any containers left from the cleanup
-            track_name = re.sub('[(\)\[\]]+', '', track_name)
+            track_name = CONTAINER_CHARACTERS.sub('', track_name)
             # variable changed to true to signify that there is information contained within parenthesis
             inside_parenthesis = True
+        features = title_features(track_name)
 
     # if statement searches for any slashes in of track name
-    if re.search(r'(?:[\s]?[/\\]+[\s]?)', track_name):
+    if 'slash' in features:
         # this block stores the information after the slash (sometimes only information behind slash is needed for link)
-        track_name_slashed = re.split(r'(?:[\s]?[/\\]+[\s]?)', track_name)[1:]
-        track_name = re.sub(r'(?:[\s]?[/\\]+[\s]?)', ' ', track_name)
+        # splitting on the slashes and joining with spaces is the same as substituting every slash with a space
+        track_name_slashed = SLASH.split(track_name)
+        track_name = ' '.join(track_name_slashed)
+        track_name_slashed = track_name_slashed[1:]
         # variable changed to true to signify that there is a slash in the track name
         slash = True
 
-    print(track_name)
-
     # returns the cleaned track name
     # returns the extra information inside of the parenthesis if there was any
     # returns the boolean variable stating if there was extra information within the parenthesis
@@ -319,6 +460,17 @@ def remove_end_track(track_name, all_artists_split):
     return track_name, extra_information, inside_parenthesis, slash, track_name_slashed
 
 
+def artist_words(name):
+    """
+    Determines the words of a single artist in the genius link, the same way the pipeline does for a list of artists
+    :param name: name of the artist as spotify lists it
+    :return: tuple of the words of the lowercased name and the words of the name as it is (used for the main artist)
+    """
+
+    return (tuple(word[:-1] for word in split_artists([remove_accents(name.lower())])),
+            tuple(word[:-1] for word in split_artists([remove_accents(name)])))
+
+
 def split_track_name(track_name):
     """
     Determines the portion of the genius link which contains the track name
@@ -329,14 +481,11 @@ def split_track_name(track_name):
     # splits track name along spaces into list
     track_name = track_name.split(' ')
 
-    print(track_name)
-
     # block removes any inconsistencies in track name (empty spaces or hyphens)
     track_name = remove_unnecessary_punctuation(track_name)
 
-    # splits track name along hyphens and removes any elements which just consist of only hyphens
+    # adds a hyphen after each element (elements which only consisted of a hyphen were removed above)
     track_name = [i + '-' for i in track_name]
-    [track_name.remove(i) for i in track_name if i == '-']
 
     # returns cleaned version of track name in the form of an list with a hyphen after each element
     return track_name
@@ -350,115 +499,809 @@ def genius_link(all_artists_split, track_name):
     :return: string containing genius link
     """
 
-    # list containing the list containing the artist names and list containing the track name
-    return_add = []
-    return_add.extend(all_artists_split)
-    return_add.extend(track_name)
+    # the artist names and the track name are joined into one string for the genius link and compiled into a link
+    html_address = GENIUS_URL + ''.join(all_artists_split) + ''.join(track_name) + 'lyrics'
 
-    # using the combined list containing everything, a string is creating for the genius link
-    return_add_string = ''
-    for i in return_add:
-        return_add_string = return_add_string + i
+    # the genius link is returned to the user
+    return html_address
 
-    print(return_add_string)
 
-    # the string is compiled into a link
-    html_address = 'https://genius.com/' + return_add_string + 'lyrics'
+class Slug(namedtuple('Slug', ['artists', 'main_artist', 'title', 'container', 'slash', 'simplified'],
+                      defaults=(False,))):
+    """
+    Immutable parts a genius link is built from, every fallback link is derived from these without redoing the cleanup
+    artists - tuple of the words of all relevant artists (with 'and' before the last one)
+    main_artist - tuple of the words of the main artist, None if only one artist is responsible for the song
+    title - tuple of the words of the cleaned track name
+    container - (start, stop) range of the title words which were inside a container, None if there was no container
+    slash - index of the first title word after the slash, None if there was no slash
+    simplified - True if the cleanup rules were skipped (Slug.simple), its link is only a best effort and is neither
+        cached nor learned from
+    """
 
-    # the genius link is returned to the user
+    __slots__ = ()
+
+    @classmethod
+    def from_track(cls, artists_json, track_name, max_length=MAX_TITLE_LENGTH, budget=TITLE_TIME_BUDGET,
+                   artist_index=None):
+        """
+        Runs the cleanup pipeline once and keeps its result
+        :param artists_json: an list containing the names of all artists responsible for the song
+        :param track_name: lowercase name of the song
+        :param max_length: titles longer than this get the simplified slug straight away (None turns the guard off)
+        :param budget: number of seconds the cleanup may take before the simplified slug is used instead, checked after
+            every stage (None turns the budget off)
+        :param artist_index: ArtistIndex the words of known artists are taken from instead of being computed again
+        :return: Slug object
+        """
+
+        # a stage cannot be interrupted once it runs, so the length guard bounds how long any one stage can take and
+        # the budget stops the stages after it
+        if max_length is not None and len(track_name) > max_length:
+            instrumentation.count('simplified', reason='length')
+            return cls.simple(artists_json, track_name)
+        deadline = time.perf_counter() + budget if budget is not None else None
+        original_name = track_name
+
+        # removes any irrelevant artists and stores it in a new list
+        with instrumentation.span('remove_artists_featured'):
+            if artist_index is None:
+                all_artists = remove_artists_featured(artists_json, track_name)
+            else:
+                all_artists = kept_artists(artists_json, track_name)
+
+        # splits artists and stores the result in an list (adds hyphen after each word)
+        with instrumentation.span('split_artists'):
+            if artist_index is None:
+                all_artists_split = split_artists(all_artists)
+            else:
+                # the index holds the words of every artist on its own, 'and' goes before the last one
+                words = [artist_index.words(artist)[0] for artist in all_artists]
+                if len(words) > 1:
+                    words.insert(len(words) - 1, ('and',))
+                all_artists_split = [word + '-' for artist in words for word in artist]
+
+        if deadline is not None and time.perf_counter() > deadline:
+            instrumentation.count('simplified', reason='budget')
+            return cls.simple(artists_json, original_name)
+
+        # cleans up track name and the information inside of it
+        with instrumentation.span('remove_end_track'):
+            track_name, extra_information, inside_parenthesis, slash, track_name_slashed = \
+                remove_end_track(track_name, all_artists_split)
+
+        if deadline is not None and time.perf_counter() > deadline:
+            instrumentation.count('simplified', reason='budget')
+            return cls.simple(artists_json, original_name)
+
+        # the main artist is only kept if it differs from the list of all artists
+        main_artist = None
+        if len(all_artists) > 1 and artist_index is not None:
+            main_artist = artist_index.words(artists_json[0])[1]
+        elif len(all_artists) > 1:
+            main_artist = tuple(word[:-1] for word in split_artists([remove_accents(artists_json[0]['name'])]))
+
+        # splits track name and stores it in a list (adds hyphen after each word)
+        with instrumentation.span('split_track_name'):
+            return cls.assemble(all_artists_split, main_artist, track_name, extra_information, inside_parenthesis,
+                                slash, track_name_slashed)
+
+    @classmethod
+    def assemble(cls, all_artists_split, main_artist, track_name, extra_information, inside_parenthesis, slash,
+                 track_name_slashed):
+        """
+        Builds the slug out of the results of the cleanup rules (the part of from_track which decides the links, kept
+        apart so the rules fingerprint does not change with the guards, the instrumentation or the artist index)
+        :param all_artists_split: words of all relevant artists from split_artists, each followed by a hyphen
+        :param main_artist: tuple of the words of the main artist, None if only one artist is responsible for the song
+        :param track_name: track name cleaned up by remove_end_track
+        :param extra_information: words which were inside the container, from remove_end_track
+        :param inside_parenthesis: True if the track name had a container
+        :param slash: True if the track name had a slash
+        :param track_name_slashed: parts of the track name after the slash, from remove_end_track
+        :return: Slug object
+        """
+
+        title = tuple(word[:-1] for word in split_track_name(track_name))
+
+        # the words inside the container are found as a run of title words (the last run, containers come late)
+        container = None
+        if inside_parenthesis:
+            words = tuple(word for word in extra_information if word not in ('', '-', ' '))
+            for start in range(len(title) - len(words), -1, -1):
+                if words and title[start:start + len(words)] == words:
+                    container = (start, start + len(words))
+                    break
+
+        # the words after the slash are always the last words of the title
+        slash_start = None
+        if slash:
+            tail = [word for part in track_name_slashed for word in part.split(' ') if word not in ('', '-', ' ')]
+            slash_start = len(title) - len(tail)
+
+        return cls(tuple(word[:-1] for word in all_artists_split), main_artist, title, container, slash_start)
+
+    @classmethod
+    def simple(cls, artists_json, track_name):
+        """
+        Builds a slug in time linear in the length of the title, without the cleanup rules (used for titles the rules
+        would take too long on, so one pathological title never stalls a worker)
+        :param artists_json: an list containing the names of all artists responsible for the song
+        :param track_name: lowercase name of the song
+        :return: Slug object with only the all artists variant, marked as simplified
+        """
+
+        # artists named in the title are the featured ones, the others are kept
+        artists = [remove_accents(artist['name'].lower()) for artist in artists_json[:1]] + \
+            [remove_accents(artist['name'].lower()) for artist in artists_json[1:]
+             if artist['name'].lower() not in track_name]
+
+        # everything from the first container or spaced hyphen on is dropped (feat clauses, remastered, live, ...)
+        end = SIMPLE_TITLE_END.search(track_name)
+        if end:
+            track_name = track_name[:end.start()]
+        track_name = TRACK_SPACED_PUNCTUATION.sub(' ', TRACK_PUNCTUATION.sub('', remove_accents(track_name)))
+        title = tuple(word[:-1] for word in split_track_name(' '.join(SLASH.split(track_name))))
+        return cls(tuple(word[:-1] for word in split_artists(artists)), None, title, None, None, True)
+
+    def title_words(self, without_container=False, without_slash=False):
+        """
+        Generates the words of the title, optionally leaving out the container or the part after the slash
+        :param without_container: if True the words which were inside the container are left out
+        :param without_slash: if True the words after the slash are left out
+        :return: generator of title words
+        """
+
+        skip_start, skip_stop = self.container if without_container and self.container else (0, 0)
+        stop = self.slash if without_slash and self.slash is not None else len(self.title)
+        for num in range(stop):
+            if not skip_start <= num < skip_stop:
+                yield self.title[num]
+
+    def link(self, main_artist=False, without_container=False, without_slash=False):
+        """
+        Determines the genius link of one variant
+        :param main_artist: if True only the main artist is used
+        :param without_container: if True the words which were inside the container are left out
+        :param without_slash: if True the words after the slash are left out
+        :return: string containing genius link
+        """
+
+        artists = self.main_artist if main_artist and self.main_artist is not None else self.artists
+        words = ''.join(word + '-' for word in artists)
+        words += ''.join(word + '-' for word in self.title_words(without_container, without_slash))
+        return GENIUS_URL + words + 'lyrics'
+
+    def variant_rules(self, exhaustive=False):
+        """
+        Generates the fallback rules which apply to this slug, in the order they should be preferred
+        :param exhaustive: if False only the original chain of fallbacks is generated (each one applied on top of the
+            previous one), if True every other combination of the rules follows it
+        :return: generator of (main_artist, without_container, without_slash) tuples
+        """
+
+        # the original chain: all artists, then main artist, then without container, then without slash
+        main_artist = self.main_artist is not None
+        yield False, False, False
+        if main_artist:
+            yield True, False, False
+        if self.container:
+            yield main_artist, True, False
+        if self.slash is not None:
+            yield main_artist, bool(self.container), True
+
+        # every remaining combination of the rules which apply
+        if exhaustive:
+            for rules in ((a, c, s) for a in (False, True) for c in (False, True) for s in (False, True)):
+                if (main_artist or not rules[0]) and (self.container or not rules[1]) \
+                        and (self.slash is not None or not rules[2]):
+                    yield rules
+
+    def variants(self, exhaustive=False):
+        """
+        Lazily generates the named candidate links of this slug without duplicates
+        :param exhaustive: if True every combination of fallback rules is generated after the original chain
+        :return: generator of (variant, genius link) pairs, variants are named after the rules applied such as
+            'all_artists', 'main_artist' or 'main_artist+without_container'
+        """
+
+        seen = set()
+        for rules in self.variant_rules(exhaustive):
+            link = self.link(*rules)
+            if link in seen:
+                continue
+            seen.add(link)
+            yield variant_name(*rules), link
+
+
+def variant_name(main_artist, without_container, without_slash):
+    """
+    Names a combination of fallback rules
+    :param main_artist: if True only the main artist is used
+    :param without_container: if True the words which were inside the container are left out
+    :param without_slash: if True the words after the slash are left out
+    :return: name such as 'all_artists' or 'main_artist+without_slash'
+    """
+
+    rules = [rule for rule, applied in (('main_artist', main_artist), ('without_container', without_container),
+                                        ('without_slash', without_slash)) if applied]
+    return '+'.join(rules) or 'all_artists'
+
+
+def candidate_variants(artists_json, track_name, exhaustive=False):
+    """
+    Determines every genius link worth trying for a song along with the fallback rules which produced it
+    :param artists_json: an list containing the names of all artists responsible in anyway for the making of the song
+    :param track_name: lowercase name of the song
+    :param exhaustive: if True every combination of fallback rules is tried, not only the original chain
+    :return: list of (variant, genius link) pairs without duplicate links, in the order they should be preferred
+    """
+
+    slug = Slug.from_track(artists_json, track_name)
+    with instrumentation.span('genius_link'):
+        return list(slug.variants(exhaustive))
+
+
+def build_candidates(artists_json, track_name, exhaustive=False):
+    """
+    Determines every genius link worth trying for a song, in the order they should be preferred
+    :param artists_json: an list containing the names of all artists responsible in anyway for the making of the song
+    :param track_name: lowercase name of the song
+    :param exhaustive: if True every combination of fallback rules is tried, not only the original chain
+    :return: list of candidate genius links without duplicates (all artists, main artist only, without the information
+        in parenthesis, without the information after the slash)
+    """
+
+    return [link for variant, link in candidate_variants(artists_json, track_name, exhaustive)]
+
+
+def get_rules_fingerprint():
+    """
+    Fingerprints the rules a slug is built with, so links cached under older rules can be found (only done once)
+    :return: hex string which changes whenever a pattern or the code of a rule changes
+    """
+
+    global rules_fingerprint
+
+    import hashlib
+    import inspect
+
+    if rules_fingerprint is None:
+        digest = hashlib.sha1()
+        # every compiled pattern of the module, in a stable order (the simplified slug is never cached, so neither
+        # its pattern, its code nor the guards choosing it are part of the fingerprint)
+        for name, value in sorted(globals().items()):
+            if isinstance(value, re.Pattern) and name != 'SIMPLE_TITLE_END':
+                digest.update(('%s=%s/%d\n' % (name, value.pattern, value.flags)).encode())
+        digest.update(repr(sorted(TOKEN_TYPES.items())).encode())
+        # the code of every rule (the bytecode is used when the source is not available, such as in a frozen build),
+        # Slug.from_track only runs them, what it does around them (guards, instrumentation, the artist index) never
+        # changes a link
+        for rule in (remove_unnecessary_punctuation, remove_accents, regex_remove_artists, kept_artists,
+                     remove_artists_featured, split_artists, remove_end_track, artist_words, split_track_name,
+                     Slug.assemble, Slug.title_words, Slug.link, Slug.variant_rules):
+            try:
+                digest.update(inspect.getsource(rule).encode())
+            except (OSError, TypeError):
+                digest.update(rule.__code__.co_code)
+        rules_fingerprint = digest.hexdigest()[:16]
+
+    # returns the fingerprint of the rules
+    return rules_fingerprint
+
+
+def rule_features(track_name):
+    """
+    Determines which cleanup rules a title can trigger, stored with its cached link so a change to one rule only has to
+    look at the titles which use it
+    :param track_name: lowercase name of the song
+    :return: comma separated token types of the title such as 'close,feat,open' ('' for a plain title)
+    """
+
+    return ','.join(sorted(title_features(track_name)))
+
+
+def get_session():
+    """
+    Creates the pooled keep-alive session used to probe genius links (only done once)
+    :return: requests session object
+    """
+
+    global session
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # the session keeps connections to genius open so later probes skip the tcp and tls handshakes, never more probes
+    # run at once than it keeps connections, so none of them is opened only to be discarded
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=PROBE_CONCURRENCY))
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=PROBE_CONCURRENCY))
+
+    # returns the session object
+    return session
+
+
+def get_probe_executor():
+    """
+    Creates the executor every probe runs on (only done once)
+    :return: ThreadPoolExecutor with PROBE_CONCURRENCY threads
+    """
+
+    global probe_executor
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the probes of every song resolved at the same time share these threads, so however many threads resolve songs
+    # the number of requests to genius in flight stays bounded
+    if probe_executor is None:
+        probe_executor = ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY, thread_name_prefix='probe')
+
+    # returns the executor object
+    return probe_executor
+
+
+def probe_link(html_address, probe_session=None, timeout=PROBE_TIMEOUT, sent=None):
+    """
+    Checks if a genius link exists without downloading the lyrics page
+    :param html_address: genius link being checked
+    :param probe_session: requests session to send the request through (defaults to the shared session)
+    :param timeout: number of seconds to wait for genius to answer
+    :param sent: deque the link is appended to for every request sent to genius (None to not count them)
+    :return: status code of the response, None if genius could not be reached
+    """
+
+    from requests.exceptions import RequestException
+
+    if probe_session is None:
+        probe_session = get_session()
+
+    try:
+        for attempt in range(RATE_LIMIT_RETRIES + 1 if rate_limiter is not None else 1):
+            if rate_limiter is not None:
+                rate_limiter.acquire('genius')
+            # a HEAD request only transfers the status line and headers
+            instrumentation.count('probes')
+            if sent is not None:
+                sent.append(html_address)
+            response = probe_session.head(html_address, allow_redirects=True, timeout=timeout)
+            # if the server does not support HEAD, a streamed GET is closed as soon as the status line arrives
+            if response.status_code in (405, 501):
+                instrumentation.count('probes')
+                if sent is not None:
+                    sent.append(html_address)
+                response = probe_session.get(html_address, stream=True, timeout=timeout)
+                response.close()
+            # a 429 holds back every probe for as long as genius asks and this one is sent again afterwards
+            if response.status_code != 429 or rate_limiter is None:
+                break
+            rate_limiter.retry_after('genius', response.headers.get('Retry-After'))
+    except RequestException:
+        return None
+
+    # returns the status code of the link
+    return response.status_code
+
+
+def probe_candidates(candidates, probe_session=None, timeout=PROBE_TIMEOUT, outcomes=None, sent=None):
+    """
+    Probes all candidate links at the same time and returns the most preferred one which exists
+    :param candidates: list of genius links ordered from most to least preferred
+    :param probe_session: requests session to send the requests through (defaults to the shared session)
+    :param timeout: number of seconds to wait for genius to answer each probe
+    :param outcomes: dictionary filled with link -> True (found), False (missing) or None (failed) for every probe
+        which finished (None to not keep them)
+    :param sent: deque every link is appended to for each request sent to genius, including the probes which finish
+        after the winner is known (None to not count them)
+    :return: the first candidate (in order of preference) which genius answered with a 200, '' if genius answered that
+        every candidate is missing, None if none was found but some probes failed or were rate limited
+    """
+
+    if not candidates:
+        return ''
+
+    from concurrent.futures import as_completed
+
+    # every candidate is probed at once, so the worst case is one round trip instead of one per fallback (unless the
+    # shared probe threads are all busy with other songs)
+    executor = get_probe_executor()
+    futures = {executor.submit(probe_link, link, probe_session, timeout, sent): num
+               for num, link in enumerate(candidates)}
+
+    # list storing if each candidate was found (None while the probe has not finished)
+    found = [None] * len(candidates)
+    # index of the most preferred candidate which has been found so far
+    winner = None
+    # becomes True once a probe gets an answer which does not tell if its link exists
+    failed = False
+
+    try:
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            num = futures[future]
+            status = future.result()
+            found[num] = status == 200
+            failed = failed or (status != 200 and status not in MISSING_STATUSES)
+            if outcomes is not None:
+                outcomes[candidates[num]] = True if found[num] else (False if status in MISSING_STATUSES else None)
+
+            # a found link cancels every less preferred probe which has not started yet
+            if found[num] and (winner is None or num < winner):
+                winner = num
+                for other, other_num in futures.items():
+                    if other_num > winner:
+                        other.cancel()
+
+            # stops as soon as every more preferred candidate is known to be missing
+            if winner is not None and not any(found[i] is not False for i in range(winner)):
+                break
+    finally:
+        # probes which have not started yet are dropped, the threads are shared with other songs
+        for future in futures:
+            future.cancel()
+
+    # returns the winning link, an empty string if none of the links exist, or None if that is not known
+    if winner is not None:
+        return candidates[winner]
+    return None if failed else ''
+
+
+def probe_variants(variants, stats=None, signature=None, index=None, preferred=None, confirmed=False, sent=None):
+    """
+    Probes the candidate links of a song, learning which fallback variants work for songs like it
+    :param variants: list of (variant, genius link) pairs in their original order
+    :param stats: CandidateStats deciding which link is probed on its own first and recording the outcome (None
+        probes every link at once)
+    :param signature: feature signature of the song (only needed with stats)
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    :param preferred: artist rule the artists of the song are known to resolve with ('main_artist' or 'all_artists'),
+        its variants are probed on their own first (None if nothing is known)
+    :param confirmed: if True the rule has been confirmed by enough songs that a link of it is accepted as found, the
+        variants of the other rule are only probed if none of its own links exist
+    :param sent: deque every link is appended to for each request sent to genius (None to not count them)
+    :return: the most preferred genius link (in the original order, or among the variants of a confirmed rule) which
+        exists, '' if none of the links exist, None if none was found but some probes failed (nothing is recorded then,
+        as the outcome is not known)
+    """
+
+    # a link known to exist is answered without any request, the index being out of date only means probing anyway
+    if index is not None:
+        html_address = index.find([link for variant, link in variants])
+        instrumentation.count('index', result='miss' if html_address is None else 'hit')
+        if html_address is not None:
+            # links missing from the index were never probed, so only the variant found is recorded
+            if stats is not None:
+                stats.record(signature, [], dict((link, variant) for variant, link in variants)[html_address])
+            return html_address
+
+    # variants known to work for the artists, or the one which almost always works for this kind of song, are probed
+    # on their own first, the learned statistics only decide what is probed first and never which link wins
+    first = []
+    if preferred is not None:
+        from artist_index import artist_rule
+        first = [pair for pair in variants if artist_rule(pair[0]) == preferred]
+    elif stats is not None and len(variants) > 1:
+        likely = stats.order(signature, variants)[0]
+        if stats.probe_alone(signature, likely[0]):
+            first = [likely]
+
+    # link -> True (found), False (missing) or None (failed) of every link probed
+    outcomes = {}
+    html_address = probe_candidates([link for variant, link in first], outcomes=outcomes, sent=sent) if first else ''
+
+    # the links more preferred than the one found still have to be missing before it is accepted, unless the artists
+    # are confirmed to resolve with the rule it was found with, if nothing was found every other link is probed
+    position = [link for variant, link in variants].index(html_address) if html_address else len(variants)
+    if html_address and confirmed:
+        position = 0
+    rest = [pair for pair in variants[:position] if pair not in first]
+    if rest:
+        html_address = probe_candidates([link for variant, link in rest], outcomes=outcomes, sent=sent) or html_address
+
+    # nothing found while some probes failed says nothing about the song
+    if not html_address and None in outcomes.values():
+        return None
+
+    # every link which answered is recorded, missing ones as failed and the winner as found
+    if stats is not None:
+        found = dict((link, variant) for variant, link in variants).get(html_address)
+        stats.record(signature, [variant for variant, link in variants if outcomes.get(link) is False], found)
+
+    # returns the genius link, or an empty string as none of the links exist
     return html_address
 
 
-def main():
+def resolve_item(item, cache=None, stats=None, index=None, artist_index=None, sent=None):
     """
-    Runs the entire program
-    :return: genius link of song user is currently listening to
+    Determines the genius link of a spotify track object, using the cache to skip the work for known songs
+    :param item: spotify track object (the 'item' of the currently playing track)
+    :param cache: ResolutionCache storing previously resolved links (None disables caching)
+    :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    :param artist_index: ArtistIndex holding the words of known artists and what their songs resolve with
+    :param sent: deque every link is appended to for each request sent to genius (None to not count them)
+    :return: genius link of the song, '' if no link could be found, None if genius could not be reached (or kept
+        rate limiting) so it is not known whether the song has a link
     """
 
-    # creates a user object which links to the user's spotify
-    user = get_user('raghu2001')
+    start = time.perf_counter()
 
     # gets all artists responsible in making the song (stores in an list)
-    artists_json = user.current_user_playing_track()['item']['artists']
+    artists_json = item['artists']
 
     # gets the track name and makes it lowercase
-    track_name = user.current_user_playing_track()['item']['name']
-    track_name = track_name.lower()
+    track_name = item['name'].lower()
+
+    # a cached song skips the cleanup and the probing entirely (including songs known to have no link)
+    if cache is not None:
+        html_address = cache.get(item.get('id'), artists_json, track_name)
+        instrumentation.count('cache', result='miss' if html_address is None else 'hit')
+        if html_address is not None:
+            instrumentation.observe_resolution(time.perf_counter() - start)
+            return html_address
+
+    # generates every link worth trying up front
+    slug = Slug.from_track(artists_json, track_name, artist_index=artist_index)
+    with instrumentation.span('genius_link'):
+        variants = list(slug.variants())
+
+    # a simplified slug skipped the cleanup rules (its title was too long or took too long, which depends on the load
+    # of the machine), so what its link finds says nothing about the rules and is not learned from
+    if slug.simplified:
+        stats = None
+    signature = None
+    if stats is not None:
+        from candidate_stats import signature as feature_signature
+        signature = feature_signature(artists_json, track_name, slug)
+
+    # artists whose songs are known to resolve with only the main artist (or with all of them) get those links first,
+    # once that is confirmed the links of the other rule are only probed if none of them exist
+    preferred, confirmed = None, False
+    if artist_index is not None and slug.main_artist is not None:
+        correction = artist_index.correction(artists_json)
+        instrumentation.count('artist_correction', result='miss' if correction is None else
+                              'confirmed' if correction[1] else 'hit')
+        if correction is not None:
+            preferred, confirmed = correction
+
+    # probes the links, the ones most likely to work first
+    with instrumentation.span('probe'):
+        html_address = probe_variants(variants, stats, signature, index, preferred, confirmed, sent)
+
+    # genius being unreachable or rate limiting says nothing about the song, so nothing is cached for it and the
+    # caller can try again later
+    if html_address is None:
+        instrumentation.count('resolutions', variant='unknown')
+        instrumentation.observe_resolution(time.perf_counter() - start)
+        return None
+
+    # records which fallback rule produced the link that worked
+    found = dict((link, variant) for variant, link in variants).get(html_address, 'not_found')
+    instrumentation.count('resolutions', variant=found)
+    if artist_index is not None and slug.main_artist is not None and html_address:
+        artist_index.learn(artists_json, found)
+
+    # stores the result, including a missing link so it is not probed again (the best effort link of a simplified slug
+    # is not kept, the next lookup gets another chance at the cleanup rules)
+    if cache is not None and not slug.simplified:
+        cache.put(item.get('id'), artists_json, track_name, html_address, get_rules_fingerprint(),
+                  rule_features(track_name), [link for variant, link in variants])
+
+    # returns the genius link
+    instrumentation.observe_resolution(time.perf_counter() - start)
+    return html_address
 
-    print(track_name)
 
-    # removes any irrelevant artists and stores it in a new list
-    all_artists = remove_artists_featured(artists_json, track_name)
+def resolve(artists, title, cache=None, track_id=None, stats=None, index=None, artist_index=None):
+    """
+    Determines the genius link of a song from its artists and title, without going through spotify
+    :param artists: list of artist names or spotify artist objects, main artist first
+    :param title: name of the song as spotify lists it
+    :param cache: ResolutionCache storing previously resolved links (None disables caching)
+    :param track_id: spotify id of the song if it is known (used as the cache key)
+    :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    :param artist_index: ArtistIndex holding the words of known artists and what their songs resolve with
+    :return: genius link of the song, '' if no link could be found, None if genius could not be reached
+    """
 
-    # splits artists and stores the result in an list (adds hyphen after each word)
-    all_artists_split = split_artists(all_artists)
+    # builds the same track object spotify would return, so resolution goes through the exact same path
+    artists_json = [artist if isinstance(artist, dict) else {'name': artist} for artist in artists]
+    return resolve_item({'id': track_id, 'name': title, 'artists': artists_json}, cache, stats, index, artist_index)
 
-    # cleans up track name and the information inside of it
-    track_name, extra_information, inside_parenthesis, slash, track_name_slashed = remove_end_track(track_name,
-                                                                                                    all_artists_split)
 
-    print(track_name_slashed)
+def report_link(html_address, item):
+    """
+    Default action of the watcher when the song changes, prints the link of the new song
+    :param html_address: genius link of the song, '' if no link could be found
+    :param item: spotify track object of the song
+    """
 
-    # splits track name and stores it in a list (adds hyphen after each word)
-    track_name = split_track_name(track_name)
+    if html_address:
+        print(html_address)
+    else:
+        print('Cannot find link!')
+    sys.stdout.flush()
 
-    # compiles the artist list and the track name list together to make a link for the genius lyrics
-    html_address = genius_link(all_artists_split, track_name)
 
-    # this block of code tests if the genius link
-    # try statement first tests the genius link from the first run
-    try:
-        # tests the response to check if the link is available
-        response = requests.get(html_address)
-        print(response.raise_for_status())
-        print(response.status_code)
-    # if there is an HTTP exception, this block is run with changes to the link
-    except HTTPError:
-        # this block checks if there are multiple artists responsible for the song, tries with only the main artist
-        if len(all_artists) > 1:
-            # gets the first artist responsible for the song
-            all_artists = [artists_json[0]['name']]
-            # for loop goes through the artist and removes the accents from the artist name
-            for num, i in enumerate(all_artists):
-                all_artists[num] = remove_accents(i)
-            # splits the artist name by each word and adds a hyphen at the end
-            all_artists_split = split_artists(all_artists)
-            # returns the genius link
-            html_address = genius_link(all_artists_split, track_name)
-
-        # block of code retires the genius link
-        if requests.get(html_address).status_code == 200:
-            pass
-
-        # this block checks if the track name contained a container with misc. information
-        if inside_parenthesis:
-            # block of code to remove unnecessary information (information in parenthesis)
-            track_name = remove_elements(track_name, extra_information)
-            # returns the genius link
-            html_address = genius_link(all_artists_split, track_name)
+def next_poll_interval(playing, idle_interval):
+    """
+    Determines how long the watcher waits before asking spotify for the currently playing song again
+    :param playing: currently playing object returned by spotify (None if nothing is playing)
+    :param idle_interval: current wait while playback is paused or idle
+    :return: tuple of the number of seconds to wait and the idle interval to use for the next poll
+    """
 
-        # block of code retires the genius link
-        if requests.get(html_address).status_code == 200:
-            pass
+    # while paused or idle the wait doubles every poll (up to a bound), playing music resets it
+    if not playing or not playing.get('is_playing') or not playing.get('item'):
+        return idle_interval, min(idle_interval * 2, WATCH_MAX_IDLE_INTERVAL)
 
-        # this block checks if the track name contains a slash
-        if slash:
-            # block of code to remove unnecessary information (information after the slash)
-            track_name = remove_elements(track_name, track_name_slashed)
-            # returns the genius link
-            html_address = genius_link(all_artists_split, track_name)
-
-        # block of code retires the genius link
-        # if the link does not work, returns that the link is not available
-        if requests.get(html_address).status_code == 200:
-            pass
-        else:
-            print('Cannot find link!')
-            html_address = ''
+    # while playing the next change is expected when the song ends, but it is still checked regularly for skips
+    remaining = (playing['item']['duration_ms'] - (playing.get('progress_ms') or 0)) / 1000
+    return min(max(remaining, WATCH_MIN_INTERVAL), WATCH_MAX_INTERVAL), WATCH_IDLE_INTERVAL
 
-    return html_address
+
+def watch(user, cache=None, on_change=report_link, max_polls=None, sleep=time.sleep, stats=None, index=None,
+          prefetcher=None, artist_index=None):
+    """
+    Keeps watching the song the user is listening to and resolves its genius link whenever it changes
+    :param user: spotify user object (anything with a current_user_playing_track method)
+    :param cache: ResolutionCache storing previously resolved links (None disables caching)
+    :param on_change: function called with the genius link and the spotify track object when the song changes
+    :param max_polls: number of times spotify is polled before returning (None keeps watching forever)
+    :param sleep: function used to wait between polls
+    :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    :param prefetcher: Prefetcher resolving the songs likely to play next in the background (None turns it off)
+    :param artist_index: ArtistIndex holding the words of known artists and what their songs resolve with
+    """
+
+    from spotipy import SpotifyException
+    from requests.exceptions import RequestException
+
+    # id of the last song a link was resolved for (left unchanged while genius cannot be reached, so the song is
+    # resolved again on the next poll)
+    last_track = None
+    # wait between polls while playback is paused or idle
+    idle_interval = WATCH_IDLE_INTERVAL
+    # number of times spotify has been polled
+    polls = 0
+
+    while max_polls is None or polls < max_polls:
+        # a single request per poll returns the song, whether it is playing and how far into it the user is
+        try:
+            playing = user.current_user_playing_track()
+        except (SpotifyException, RequestException):
+            playing = None
+        polls += 1
+
+        # the link is only resolved when the song changes (local files have no id, so their uri is used)
+        item = playing.get('item') if playing else None
+        if item:
+            track = item.get('id') or item.get('uri') or item['name']
+            if track != last_track:
+                if prefetcher is None:
+                    html_address = resolve_item(item, cache, stats, index, artist_index)
+                else:
+                    # prefetching waits while the song being listened to is resolved, then moves on to the next ones
+                    with prefetcher.foreground():
+                        html_address = resolve_item(item, cache, stats, index, artist_index)
+                if html_address is not None:
+                    last_track = track
+                    if prefetcher is not None:
+                        prefetcher.song_changed(item)
+                    on_change(html_address, item)
+
+        interval, idle_interval = next_poll_interval(playing, idle_interval)
+        if max_polls is None or polls < max_polls:
+            sleep(interval)
+
+
+def main(username=USERNAME, index_path=None):
+    """
+    Runs the entire program
+    :param username: spotify user whose currently playing song is looked up
+    :param index_path: location of the index of known genius slugs (defaults to the usual location if it exists)
+    :return: genius link of song user is currently listening to
+    """
+
+    from resolution_cache import ResolutionCache
+    from candidate_stats import CandidateStats
+    from slug_index import INDEX_PATH, open_index
+    from artist_index import ArtistIndex
+
+    # creates a user object which links to the user's spotify
+    user = get_user(username)
+
+    # gets the currently playing song once, it holds both the artists and the track name
+    item = user.current_user_playing_track()['item']
+
+    # opens the cache of previously resolved links and the statistics of which fallbacks work
+    cache = ResolutionCache()
+    stats = CandidateStats()
+    index = open_index(index_path or INDEX_PATH)
+    artist_index = ArtistIndex()
+
+    # determines the genius link of the song
+    html_address = resolve_item(item, cache, stats, index, artist_index)
+    cache.close()
+    stats.save()
+    artist_index.close()
+
+    # if none of the links work, returns that the link is not available (along with the closest known songs)
+    if html_address is None:
+        print('Cannot reach Genius, try again later!')
+    elif not html_address:
+        print('Cannot find link!')
+        if index is not None:
+            first_candidate = build_candidates(item['artists'], item['name'].lower())[0]
+            for distance, slug in index.suggest(first_candidate[len(GENIUS_URL):-len('-lyrics')]):
+                print('Did you mean ' + GENIUS_URL + slug + '-lyrics')
+    if index is not None:
+        index.close()
+
+    return html_address or ''
+
+
+def cli(argv=None):
+    """
+    Command line entry point, prints the genius link of the song playing on spotify
+    :param argv: list of command line arguments (defaults to the arguments the program was started with)
+    """
+
+    import argparse
+    from resolution_cache import ResolutionCache
+    from candidate_stats import CandidateStats
+    from slug_index import INDEX_PATH, open_index
+    from prefetch import PREFETCH_BUDGET, Prefetcher
+    from artist_index import ArtistIndex
+
+    parser = argparse.ArgumentParser(description='Finds the genius link of the song playing on spotify')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and print the link every time the song changes')
+    parser.add_argument('--username', default=USERNAME, help='spotify user whose song is looked up')
+    parser.add_argument('--metrics-port', type=int,
+                        help='record timings and counters and serve them on this port (/metrics and /metrics.json)')
+    parser.add_argument('--index', default=INDEX_PATH,
+                        help='index of known genius slugs checked before probing (used if it exists)')
+    parser.add_argument('--prefetch-depth', type=int, default=0,
+                        help='with --watch, resolve this many queued, recently played and top tracks in the background')
+    parser.add_argument('--prefetch-budget', type=int, default=PREFETCH_BUDGET,
+                        help='largest number of requests made for prefetching in any hour')
+    arguments = parser.parse_args(argv)
+
+    if arguments.metrics_port:
+        instrumentation.enable()
+        instrumentation.serve(arguments.metrics_port)
+
+    if arguments.watch:
+        # keeps one authenticated user object, one cache and one set of statistics alive for the whole session
+        stats = CandidateStats()
+        cache = ResolutionCache()
+        index = open_index(arguments.index)
+        artist_index = ArtistIndex()
+        user = get_user(arguments.username, scope=PREFETCH_SCOPE if arguments.prefetch_depth else SCOPE)
+        prefetcher = Prefetcher(user, cache, stats, index, arguments.prefetch_depth, arguments.prefetch_budget,
+                                artist_index=artist_index) if arguments.prefetch_depth else None
+        try:
+            watch(user, cache, stats=stats, index=index, prefetcher=prefetcher, artist_index=artist_index)
+        finally:
+            # the prefetcher is stopped first, its thread uses the databases closed below
+            if prefetcher is not None:
+                prefetcher.stop()
+                print(prefetcher.report(), file=sys.stderr)
+            stats.save()
+            cache.close()
+            artist_index.close()
+            if index is not None:
+                index.close()
+    else:
+        # calls the entire function and returns the link
+        link = main(arguments.username, arguments.index)
+        print(link)
 
 
-# calls the entire function and returns the link
-link = main()
-print(link)
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,262 @@
+import json
+import threading
+import time
+
+
+# instrumentation is off unless enable() is called, every recording function returns straight away while it is off
+enabled = False
+
+# upper bounds in seconds of the buckets of the end to end resolution latency histogram
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# guards every update, probes are recorded from several threads at once
+lock = threading.Lock()
+
+# stage name -> [number of spans, total seconds]
+spans = {}
+# (counter name, (label, value) pairs) -> value
+counters = {}
+# count of resolutions in each latency bucket (the last one is +Inf), total seconds and number of resolutions
+histogram = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+
+
+class Span:
+    """
+    Context manager timing one stage of the pipeline
+    """
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        with lock:
+            total = spans.setdefault(self.stage, [0, 0.0])
+            total[0] += 1
+            total[1] += elapsed
+        return False
+
+
+class NullSpan:
+    """
+    Context manager which does nothing, handed out while instrumentation is off
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+# the same do-nothing span is shared by every call while instrumentation is off, so no object is created per call
+NULL_SPAN = NullSpan()
+
+
+def enable():
+    """
+    Turns instrumentation on
+    """
+
+    global enabled
+    enabled = True
+
+
+def disable():
+    """
+    Turns instrumentation off (recorded values are kept)
+    """
+
+    global enabled
+    enabled = False
+
+
+def reset():
+    """
+    Clears every recorded value
+    """
+
+    with lock:
+        spans.clear()
+        counters.clear()
+        histogram['buckets'] = [0] * (len(LATENCY_BUCKETS) + 1)
+        histogram['sum'] = 0.0
+        histogram['count'] = 0
+
+
+def span(stage):
+    """
+    Times a stage of the pipeline, used as 'with instrumentation.span(stage):'
+    :param stage: name of the stage
+    :return: context manager timing the stage (does nothing while instrumentation is off)
+    """
+
+    return Span(stage) if enabled else NULL_SPAN
+
+
+def count(name, value=1, **labels):
+    """
+    Adds to a counter
+    :param name: name of the counter
+    :param value: amount added to the counter
+    :param labels: labels separating the values of the counter (for example variant='main_artist')
+    """
+
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe_resolution(seconds):
+    """
+    Records the end to end latency of one resolution in the histogram
+    :param seconds: time the resolution took
+    """
+
+    if not enabled:
+        return
+    # the first bucket whose bound is at least the latency, or the +Inf bucket
+    bucket = next((num for num, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+    with lock:
+        histogram['buckets'][bucket] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def snapshot(clear=False):
+    """
+    Copies every recorded value into plain data which can be sent between processes
+    :param clear: if True the recorded values are cleared after being copied
+    :return: dictionary of spans, counters and the latency histogram
+    """
+
+    with lock:
+        data = {
+            'spans': {stage: list(total) for stage, total in spans.items()},
+            'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+            'histogram': {'buckets': list(histogram['buckets']), 'sum': histogram['sum'],
+                          'count': histogram['count']},
+        }
+    if clear:
+        reset()
+    return data
+
+
+def merge(data):
+    """
+    Adds the values of a snapshot (for example from a worker process) to the recorded values
+    :param data: dictionary returned by snapshot()
+    """
+
+    with lock:
+        for stage, (number, seconds) in data['spans'].items():
+            total = spans.setdefault(stage, [0, 0.0])
+            total[0] += number
+            total[1] += seconds
+        for name, labels, value in data['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for num, number in enumerate(data['histogram']['buckets']):
+            histogram['buckets'][num] += number
+        histogram['sum'] += data['histogram']['sum']
+        histogram['count'] += data['histogram']['count']
+
+
+def export_json():
+    """
+    Exports every recorded value as JSON
+    :return: JSON string
+    """
+
+    data = snapshot()
+    data['spans'] = {stage: {'count': number, 'seconds': seconds} for stage, (number, seconds) in data['spans'].items()}
+    data['histogram']['bounds'] = list(LATENCY_BUCKETS) + ['+Inf']
+    return json.dumps(data, indent=2)
+
+
+def prometheus_labels(labels):
+    """
+    Formats labels the way the prometheus text format expects them
+    :param labels: dictionary of labels
+    :return: string such as '{variant="main_artist"}', '' if there are no labels
+    """
+
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels.items()) + '}'
+
+
+def export_prometheus():
+    """
+    Exports every recorded value in the prometheus text format
+    :return: string in the prometheus text format
+    """
+
+    data = snapshot()
+    lines = ['# TYPE genius_link_stage_seconds summary']
+    for stage, (number, seconds) in sorted(data['spans'].items()):
+        lines.append('genius_link_stage_seconds_sum{stage="%s"} %r' % (stage, seconds))
+        lines.append('genius_link_stage_seconds_count{stage="%s"} %d' % (stage, number))
+
+    # counters are grouped by name so each one gets a single TYPE line
+    for name in sorted({name for name, labels, value in data['counters']}):
+        lines.append('# TYPE genius_link_%s_total counter' % name)
+        for counter_name, labels, value in data['counters']:
+            if counter_name == name:
+                lines.append('genius_link_%s_total%s %r' % (name, prometheus_labels(labels), value))
+
+    # prometheus buckets are cumulative
+    lines.append('# TYPE genius_link_resolution_seconds histogram')
+    cumulative = 0
+    for bound, number in zip(list(LATENCY_BUCKETS) + ['+Inf'], data['histogram']['buckets']):
+        cumulative += number
+        lines.append('genius_link_resolution_seconds_bucket{le="%s"} %d' % (bound, cumulative))
+    lines.append('genius_link_resolution_seconds_sum %r' % data['histogram']['sum'])
+    lines.append('genius_link_resolution_seconds_count %d' % data['histogram']['count'])
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serves the recorded values over http in a background thread, /metrics in the prometheus text format and
+    /metrics.json as JSON
+    :param port: port to listen on
+    :param host: address to listen on
+    :return: the http server object (call shutdown() on it to stop serving)
+    """
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = export_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = export_json(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
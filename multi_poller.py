@@ -0,0 +1,286 @@
+import argparse
+import heapq
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import genius_link
+import instrumentation
+from candidate_stats import CandidateStats
+from rate_limiter import RateLimiter
+from resolution_cache import ResolutionCache
+from slug_index import INDEX_PATH, open_index
+
+
+# requests per second and burst size allowed toward spotify, shared by every account
+SPOTIFY_RATE = (5.0, 10)
+
+# requests per second and burst size allowed toward genius, shared by every account
+GENIUS_RATE = (10.0, 20)
+
+# number of songs resolved at the same time (their probes share the genius_link.PROBE_CONCURRENCY probe threads)
+RESOLVE_WORKERS = 4
+
+# directory the token cache of every account is kept in
+TOKEN_DIRECTORY = os.path.join(os.path.expanduser('~'), '.genius_link_tokens')
+
+
+def pooled_session(connections):
+    """
+    Creates a requests session keeping connections to one service open for every thread using it
+    :param connections: largest number of connections kept open
+    :return: requests session object
+    """
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    pooled = requests.Session()
+    pooled.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+    pooled.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+    return pooled
+
+
+def report_change(username, html_address, item):
+    """
+    Default action of the poller when the song of an account changes, prints the user and the link of the new song
+    :param username: spotify user whose song changed
+    :param html_address: genius link of the song, '' if no link could be found
+    :param item: spotify track object of the song
+    """
+
+    print('%s: %s' % (username, html_address or 'Cannot find link!'))
+    sys.stdout.flush()
+
+
+class Account:
+    """
+    Polling state of one spotify account
+    """
+
+    __slots__ = ('username', 'user', 'last_track', 'idle_interval', 'polls')
+
+    def __init__(self, username, user):
+        self.username = username
+        self.user = user
+        # id of the last song a link was resolved for
+        self.last_track = None
+        # wait between polls while playback is paused or idle
+        self.idle_interval = genius_link.WATCH_IDLE_INTERVAL
+        # number of times spotify has been polled for this account
+        self.polls = 0
+
+
+class MultiPoller:
+    """
+    Watches the songs of many spotify accounts from one process, polls are scheduled one at a time from a heap so
+    they are spread out instead of arriving in bursts
+    """
+
+    def __init__(self, users, limiter, cache=None, stats=None, index=None, on_change=report_change,
+                 resolve_workers=RESOLVE_WORKERS, clock=time.monotonic, sleep=time.sleep):
+        """
+        Sets up the poller
+        :param users: dictionary of username -> spotify user object
+        :param limiter: RateLimiter every spotify poll waits on (genius probes wait on it through genius_link)
+        :param cache: ResolutionCache storing previously resolved links (None disables caching)
+        :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+        :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+        :param on_change: function called with the username, genius link and spotify track object on every change
+        :param resolve_workers: number of songs resolved at the same time
+        :param clock: function returning the current time in seconds
+        :param sleep: function used to wait for the next poll
+        """
+
+        self.accounts = [Account(username, user) for username, user in users.items()]
+        self.limiter = limiter
+        self.cache = cache
+        self.stats = stats
+        self.index = index
+        self.on_change = on_change
+        self.clock = clock
+        self.sleep = sleep
+        self.started = clock()
+
+        # resolution runs off the polling thread, so a slow genius never delays the polls of other accounts
+        self.executor = ThreadPoolExecutor(max_workers=resolve_workers)
+
+        # (time of the next poll, order the account was added in) of every account, the first polls are staggered
+        # evenly over one idle interval so starting many accounts never sends one burst
+        spacing = genius_link.WATCH_IDLE_INTERVAL / max(len(self.accounts), 1)
+        self.schedule = [(self.started + num * spacing, num) for num in range(len(self.accounts))]
+        heapq.heapify(self.schedule)
+
+    def resolve(self, account, item):
+        """
+        Resolves the genius link of a song an account changed to and reports it (runs on a worker thread)
+        :param account: Account whose song changed
+        :param item: spotify track object of the song
+        """
+
+        try:
+            html_address = genius_link.resolve_item(item, self.cache, self.stats, self.index)
+        except Exception as error:
+            print('%s: resolution failed (%s)' % (account.username, error), file=sys.stderr)
+            return
+        # genius being unreachable is not a missing link, the song is resolved again on the next poll of the account
+        # (unless the account has moved on to another song since)
+        if html_address is None:
+            if account.last_track == (item.get('id') or item.get('uri') or item['name']):
+                account.last_track = None
+            print('%s: genius could not be reached, retrying' % account.username, file=sys.stderr)
+            return
+        self.on_change(account.username, html_address, item)
+
+    def poll(self, account):
+        """
+        Asks spotify for the song of an account once, resolving its link if the song changed
+        :param account: Account being polled
+        :return: number of seconds until the account should be polled again
+        """
+
+        from spotipy import SpotifyException
+        from requests.exceptions import RequestException
+
+        self.limiter.acquire('spotify')
+        try:
+            playing = account.user.current_user_playing_track()
+        except SpotifyException as error:
+            # a 429 holds back the polls of every account, not only this one
+            if error.http_status == 429:
+                return self.limiter.retry_after('spotify', (error.headers or {}).get('Retry-After'))
+            playing = None
+        except RequestException:
+            playing = None
+        account.polls += 1
+        instrumentation.count('polls', user=account.username)
+
+        # the link is only resolved when the song changes (local files have no id, so their uri is used)
+        item = playing.get('item') if playing else None
+        if item:
+            track = item.get('id') or item.get('uri') or item['name']
+            if track != account.last_track:
+                account.last_track = track
+                self.executor.submit(self.resolve, account, item)
+
+        interval, account.idle_interval = genius_link.next_poll_interval(playing, account.idle_interval)
+        return interval
+
+    def run(self, max_polls=None):
+        """
+        Polls the accounts until stopped, always polling the account which is due first
+        :param max_polls: total number of polls before returning (None keeps polling forever)
+        """
+
+        polls = 0
+        while self.schedule and (max_polls is None or polls < max_polls):
+            due, num = self.schedule[0]
+            now = self.clock()
+            if due > now:
+                self.sleep(due - now)
+                continue
+            heapq.heappop(self.schedule)
+            interval = self.poll(self.accounts[num])
+            polls += 1
+            heapq.heappush(self.schedule, (self.clock() + interval, num))
+
+    def rates(self):
+        """
+        Determines the poll rate of every account and the request rate of every service since the poller started
+        :return: dictionary of 'users' (username -> polls per second) and 'services' (service -> requests per second)
+        """
+
+        elapsed = max(self.clock() - self.started, 1e-9)
+        return {'users': {account.username: account.polls / elapsed for account in self.accounts},
+                'services': self.limiter.rates()}
+
+    def close(self):
+        """
+        Waits for the resolutions still running
+        """
+
+        self.executor.shutdown(wait=True)
+
+
+def report_rates(poller, every):
+    """
+    Prints the per account and aggregate request rates on standard error at a regular interval (runs on a thread)
+    :param poller: MultiPoller being reported on
+    :param every: number of seconds between two reports
+    """
+
+    while True:
+        time.sleep(every)
+        rates = poller.rates()
+        users = ', '.join('%s %.2f/s' % (username, rate) for username, rate in sorted(rates['users'].items()))
+        services = ', '.join('%s %.2f/s' % (name, rate) for name, rate in sorted(rates['services'].items()))
+        print('polls: %s | total %.2f/s | requests: %s' % (users, sum(rates['users'].values()), services),
+              file=sys.stderr)
+
+
+def main():
+    """
+    Runs the multi account poller from the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Prints the genius link of the songs of many spotify accounts')
+    parser.add_argument('usernames', nargs='+', help='spotify users to watch')
+    parser.add_argument('--token-directory', default=TOKEN_DIRECTORY,
+                        help='directory the token cache of every account is kept in')
+    parser.add_argument('--spotify-rate', type=float, default=SPOTIFY_RATE[0],
+                        help='requests per second sent to spotify across every account')
+    parser.add_argument('--genius-rate', type=float, default=GENIUS_RATE[0],
+                        help='requests per second sent to genius across every account')
+    parser.add_argument('--spotify-api-url', help='base url of the spotify web api (for testing against a stand-in)')
+    parser.add_argument('--spotify-accounts-url', help='base url of the spotify accounts service')
+    parser.add_argument('--genius-url', help='base url of genius (for testing against a stand-in)')
+    parser.add_argument('--probe-concurrency', type=int, default=genius_link.PROBE_CONCURRENCY,
+                        help='largest number of requests sent to genius at the same time (and connections kept open)')
+    parser.add_argument('--index', default=INDEX_PATH,
+                        help='index of known genius slugs checked before probing (used if it exists)')
+    parser.add_argument('--report-every', type=float, default=60,
+                        help='seconds between two reports of the request rates (0 turns them off)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='record timings and counters and serve them on this port (/metrics and /metrics.json)')
+    arguments = parser.parse_args()
+
+    if arguments.metrics_port:
+        instrumentation.enable()
+        instrumentation.serve(arguments.metrics_port)
+    if arguments.genius_url:
+        genius_link.GENIUS_URL = arguments.genius_url
+    genius_link.PROBE_CONCURRENCY = arguments.probe_concurrency
+
+    # one limiter and one pooled session per service are shared by every account and thread
+    limiter = RateLimiter({'spotify': (arguments.spotify_rate, SPOTIFY_RATE[1]),
+                           'genius': (arguments.genius_rate, GENIUS_RATE[1])})
+    genius_link.rate_limiter = limiter
+    spotify_session = pooled_session(max(len(arguments.usernames), 4))
+
+    # every account keeps its own token cache, so each one is refreshed on its own schedule
+    os.makedirs(arguments.token_directory, exist_ok=True)
+    users = {username: genius_link.get_user(username, os.path.join(arguments.token_directory, '.cache-' + username),
+                                            spotify_session, arguments.spotify_api_url,
+                                            arguments.spotify_accounts_url)
+             for username in arguments.usernames}
+
+    cache = ResolutionCache()
+    stats = CandidateStats()
+    poller = MultiPoller(users, limiter, cache, stats, open_index(arguments.index))
+    if arguments.report_every:
+        threading.Thread(target=report_rates, args=(poller, arguments.report_every), daemon=True).start()
+
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.close()
+        stats.save()
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
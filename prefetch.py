@@ -0,0 +1,232 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import genius_link
+import instrumentation
+
+
+# number of upcoming, recently played and top tracks read from spotify each time the song changes
+PREFETCH_DEPTH = 5
+
+# largest number of spotify reads and genius requests the prefetcher makes in any hour
+PREFETCH_BUDGET = 300
+
+# number of genius requests an uncached resolution sends at most in the original chain of fallbacks (one probe per
+# link), a resolution only starts if the budget has room for all of them
+SONG_REQUESTS = 4
+
+# number of prefetched track ids remembered for measuring the hit rate
+REMEMBERED = 1000
+
+
+def upcoming_tracks(user, depth):
+    """
+    Reads the tracks the user is likely to play next, most likely first
+    :param user: spotify user object (authenticated with genius_link.PREFETCH_SCOPE)
+    :param depth: number of tracks read from each source
+    :return: tuple of the list of spotify track objects and the number of spotify requests made
+    """
+
+    from spotipy import SpotifyException
+    from requests.exceptions import RequestException
+
+    tracks = []
+    requests = 0
+
+    # the queue is what plays next for certain, recently played and top tracks are what tends to be played again
+    for read in (lambda: user.queue()['queue'],
+                 lambda: [entry['track'] for entry in user.current_user_recently_played(limit=depth)['items']],
+                 lambda: user.current_user_top_tracks(limit=depth)['items']):
+        requests += 1
+        try:
+            tracks.extend(read()[:depth])
+        except (SpotifyException, RequestException, KeyError, TypeError):
+            continue
+
+    # podcast episodes and local files have no artists to build a link from
+    return [track for track in tracks if track and track.get('artists') and track.get('id')], requests
+
+
+class Prefetcher:
+    """
+    Resolves the links of the songs a user is likely to play next on a background thread, so they are in the cache
+    by the time the song changes
+    """
+
+    def __init__(self, user, cache, stats=None, index=None, depth=PREFETCH_DEPTH, budget=PREFETCH_BUDGET,
+                 clock=time.monotonic, artist_index=None):
+        """
+        Starts the background thread
+        :param user: spotify user object (authenticated with genius_link.PREFETCH_SCOPE)
+        :param cache: ResolutionCache the prefetched links are stored in
+        :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+        :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+        :param depth: number of tracks read from each source every time the song changes
+        :param budget: largest number of spotify reads and genius requests made in any hour
+        :param clock: function returning the current time in seconds
+        :param artist_index: ArtistIndex holding the words of known artists and what their songs resolve with
+        """
+
+        self.user = user
+        self.cache = cache
+        self.stats = stats
+        self.index = index
+        self.artist_index = artist_index
+        self.depth = depth
+        self.budget = budget
+        self.clock = clock
+
+        # times of the requests made within the last hour
+        self.spent = deque()
+        # genius requests sent by prefetch resolutions which have not been taken out of the budget yet (probes keep
+        # running on the shared probe threads after a resolution has its answer, so they are counted as they are sent)
+        self.sent = deque()
+        # track ids whose links have been prefetched, oldest first
+        self.prefetched = OrderedDict()
+        # songs the user changed to which had (hits) or had not (misses) been prefetched
+        self.hits = 0
+        self.misses = 0
+        # number of song changes seen, the first song is playing before anything could be prefetched
+        self.changes = 0
+
+        # cleared while the foreground resolves a song, the background thread waits for it before every resolution
+        self.idle = threading.Event()
+        self.idle.set()
+        # set when the song changed and the upcoming tracks should be read again
+        self.wanted = threading.Event()
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def remaining(self):
+        """
+        Determines how much of the hourly budget is left
+        :return: number of requests which can still be made
+        """
+
+        now = self.clock()
+        while self.sent:
+            self.sent.popleft()
+            self.spent.append(now)
+        while self.spent and now - self.spent[0] >= 3600:
+            self.spent.popleft()
+        return self.budget - len(self.spent)
+
+    def spend(self):
+        """
+        Takes one request out of the hourly budget
+        :return: True if the budget allowed the request
+        """
+
+        if self.remaining() <= 0:
+            return False
+        self.spent.append(self.clock())
+        return True
+
+    @contextmanager
+    def foreground(self):
+        """
+        Holds back prefetching while the song the user is listening to is resolved
+        """
+
+        self.idle.clear()
+        try:
+            yield
+        finally:
+            self.idle.set()
+
+    def song_changed(self, item):
+        """
+        Records if the song the user changed to had been prefetched and asks for the next songs to be prefetched
+        :param item: spotify track object of the new song
+        """
+
+        self.changes += 1
+        if item.get('id') in self.prefetched:
+            self.hits += 1
+            instrumentation.count('prefetch', result='hit')
+        elif self.changes > 1:
+            self.misses += 1
+            instrumentation.count('prefetch', result='miss')
+        self.wanted.set()
+
+    def prefetch(self, track):
+        """
+        Resolves the link of one track into the cache unless it is already there
+        :param track: spotify track object
+        """
+
+        track_name = track['name'].lower()
+        if self.cache.get(track['id'], track['artists'], track_name) is None:
+            # the resolution is charged with every request it actually sends to genius, not once per song
+            if self.remaining() < SONG_REQUESTS:
+                return
+            # waits for the foreground to finish so prefetching never competes with the song being listened to
+            self.idle.wait()
+            html_address = genius_link.resolve_item(track, self.cache, self.stats, self.index, self.artist_index,
+                                                    self.sent)
+            instrumentation.count('prefetch', result='resolved')
+            # only a song whose link is now in the cache has been prefetched (nothing is cached when genius could not
+            # be reached or the title only got its simplified slug)
+            if html_address is None or self.cache.get(track['id'], track['artists'], track_name) is None:
+                return
+
+        self.prefetched[track['id']] = True
+        self.prefetched.move_to_end(track['id'])
+        if len(self.prefetched) > REMEMBERED:
+            self.prefetched.popitem(last=False)
+
+    def run(self):
+        """
+        Background thread, reads the upcoming tracks every time the song changes and prefetches their links
+        """
+
+        while not self.stopped:
+            self.wanted.wait()
+            self.wanted.clear()
+            if self.stopped:
+                break
+            # the three spotify reads are only made if the budget has room for all of them
+            if self.remaining() < 3:
+                continue
+            tracks, requests = upcoming_tracks(self.user, self.depth)
+            for _ in range(requests):
+                self.spend()
+            for track in tracks:
+                # a newer song change makes the rest of this list stale
+                if self.stopped or self.wanted.is_set():
+                    break
+                try:
+                    self.prefetch(track)
+                except Exception:
+                    continue
+
+    def hit_rate(self):
+        """
+        Determines how often the song the user changed to had already been prefetched
+        :return: fraction of song changes which were prefetched (0 before the first change)
+        """
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        """
+        Formats the hit rate of the prefetched links
+        :return: string such as 'prefetch hit rate 0.75 (3 of 4 songs), 12 requests in the last hour'
+        """
+
+        return 'prefetch hit rate %.2f (%d of %d songs), %d requests in the last hour' % (
+            self.hit_rate(), self.hits, self.hits + self.misses, self.budget - self.remaining())
+
+    def stop(self):
+        """
+        Stops the background thread after the resolution it is running
+        """
+
+        self.stopped = True
+        self.wanted.set()
+        self.thread.join()
@@ -0,0 +1,126 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import instrumentation
+
+
+# number of seconds waited after a 429 which did not say how long to wait
+DEFAULT_RETRY_AFTER = 5
+
+# longest wait accepted from a Retry-After header (a broken header should never stop the process for hours)
+MAX_RETRY_AFTER = 300
+
+
+def retry_after_seconds(value):
+    """
+    Reads the Retry-After header of a 429 response
+    :param value: value of the header (a number of seconds or an http date), None if the header is missing
+    :return: number of seconds to wait
+    """
+
+    if value is None:
+        return DEFAULT_RETRY_AFTER
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+class TokenBucket:
+    """
+    Token bucket of one service, refilled at a steady rate up to a burst size
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until', 'requests', 'started')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        # no request is let through before this time (set by a 429 from the service)
+        self.blocked_until = 0.0
+        # number of requests let through since started, for reporting the rate
+        self.requests = 0
+        self.started = now
+
+
+class RateLimiter:
+    """
+    Process wide rate limiter shared by every thread and account, one token bucket per service
+    """
+
+    def __init__(self, rates, clock=time.monotonic, sleep=time.sleep):
+        """
+        Creates the buckets
+        :param rates: dictionary of service name -> (requests per second, burst size)
+        :param clock: function returning the current time in seconds
+        :param sleep: function used to wait for a token
+        """
+
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        now = clock()
+        self.buckets = {name: TokenBucket(rate, burst, now) for name, (rate, burst) in rates.items()}
+
+    def acquire(self, name):
+        """
+        Waits until a request to a service may be sent (returns straight away for services without a bucket)
+        :param name: name of the service
+        """
+
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            return
+
+        while True:
+            with self.lock:
+                now = self.clock()
+                bucket.tokens = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                bucket.updated = now
+                if now < bucket.blocked_until:
+                    wait = bucket.blocked_until - now
+                elif bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    bucket.requests += 1
+                    instrumentation.count('requests', service=name)
+                    return
+                else:
+                    wait = (1 - bucket.tokens) / bucket.rate
+            # the lock is released while waiting so other services keep going
+            self.sleep(wait)
+
+    def retry_after(self, name, value):
+        """
+        Stops every request to a service after it answered with a 429
+        :param name: name of the service
+        :param value: value of the Retry-After header, None if it was missing
+        :return: number of seconds requests are held back for
+        """
+
+        seconds = retry_after_seconds(value)
+        bucket = self.buckets.get(name)
+        if bucket is not None:
+            with self.lock:
+                bucket.blocked_until = max(bucket.blocked_until, self.clock() + seconds)
+                # the bucket starts empty afterwards, so requests resume at the steady rate instead of in a burst
+                bucket.tokens = 0
+        instrumentation.count('rate_limited', service=name)
+        return seconds
+
+    def rates(self):
+        """
+        Determines the average request rate of every service since the limiter was created
+        :return: dictionary of service name -> requests per second
+        """
+
+        with self.lock:
+            now = self.clock()
+            return {name: bucket.requests / (now - bucket.started) if now > bucket.started else 0.0
+                    for name, bucket in self.buckets.items()}
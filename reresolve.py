@@ -0,0 +1,205 @@
+import argparse
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import genius_link
+from resolution_cache import CACHE_PATH, ResolutionCache, name_key
+from slug_index import INDEX_PATH, open_index
+
+
+# number of cache rows read and checked at once
+BATCH_SIZE = 500
+
+# number of songs whose candidate links are probed again at the same time
+PROBE_WORKERS = 4
+
+# number of songs whose outcome is remembered, so the other keys of a song (other track ids) are not probed again
+REMEMBERED = 10000
+
+
+class Outcome:
+    """
+    What the check of one song came to, shared by every key the song is stored under
+    """
+
+    __slots__ = ('kind', 'features', 'candidates', 'link', 'pending', 'keys', 'waiting')
+
+    def __init__(self, kind, features, candidates, keys):
+        # 'skipped', 'unchanged', 'simplified' or 'reprobed'
+        self.kind = kind
+        self.features = features
+        self.candidates = candidates
+        # link found by probing again (None while probing or if the entries keep their own link)
+        self.link = None
+        # True while the song is queued to be probed, if its probes failed or if it only got the simplified slug
+        self.pending = kind in ('reprobed', 'simplified')
+        # every key of the song handled so far, and the ones written once the probes are done
+        self.keys = set(keys)
+        self.waiting = list(keys)
+
+
+def reresolve(cache, index=None, features=None, probe=True, batch_size=BATCH_SIZE, probe_workers=PROBE_WORKERS):
+    """
+    Brings the cache up to date with the current cleanup rules, streaming through the entries resolved under older
+    rules and only probing the songs whose candidate links are different under the new ones
+    :param cache: ResolutionCache being brought up to date
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    :param features: set of token types whose rules changed (such as {'strip', 'slash'}), entries whose title has none
+        of them are marked as current without being checked (None checks every entry)
+    :param probe: if False nothing is probed or written, the counts tell what a real run would do
+    :param batch_size: number of cache rows read and checked at once
+    :param probe_workers: number of songs probed again at the same time
+    :return: dictionary of counters, 'checked' entries were 'unchanged', 'skipped' by their features, 'simplified'
+        (the guards skipped the cleanup rules, they are left stale) or 'reprobed', of which 'changed' got a different
+        link, 'kept' kept their link as nothing was found in its place and 'failed' could not be probed (they are left
+        stale, so the next run checks them again)
+    """
+
+    rules = genius_link.get_rules_fingerprint()
+    counts = dict.fromkeys(('checked', 'skipped', 'unchanged', 'simplified', 'reprobed', 'changed', 'kept', 'failed'),
+                           0)
+
+    # (artists, title) -> Outcome of the songs seen last
+    seen = OrderedDict()
+
+    with ThreadPoolExecutor(max_workers=probe_workers) as pool:
+        for page in cache.stale(rules, batch_size):
+            # songs of this page which have to be probed again, along with the link they had
+            work = []
+            for key, url, artists, title, stored_features, candidates in page:
+                song = (tuple(artists), title)
+                outcome = seen.get(song)
+
+                # the name key of a song is handled along with its track id key, they sort far apart so they are
+                # rarely on the same page (and a dry run leaves both stale), but a key is never counted twice
+                if outcome is not None and key in outcome.keys:
+                    continue
+                keys = list(OrderedDict.fromkeys((key, name_key([{'name': artist} for artist in artists], title))))
+                counts['checked'] += 1
+
+                # other track ids of a song seen before get the same outcome
+                if outcome is not None:
+                    seen.move_to_end(song)
+                    outcome.keys.update(keys)
+                    counts[outcome.kind] += 1
+                    if outcome.pending:
+                        outcome.waiting.extend(keys)
+                    elif probe:
+                        cache.restamp(keys, rules, outcome.features, outcome.candidates, outcome.link)
+                    continue
+
+                # titles without any of the changed token types cannot be affected by the change
+                if features is not None and stored_features is not None and candidates is not None and \
+                        not features.intersection(stored_features.split(',')):
+                    counts['skipped'] += 1
+                    remember(seen, song, Outcome('skipped', stored_features, candidates, keys))
+                    if probe:
+                        cache.restamp(keys, rules, stored_features, candidates)
+                    continue
+
+                # the slug is only rebuilt, which costs microseconds, probing is what a full rebuild would pay for
+                slug = genius_link.Slug.from_track([{'name': artist} for artist in artists], title)
+                # a simplified slug is not what the rules make of the title, the entry keeps its link and stays stale
+                if slug.simplified:
+                    counts['simplified'] += 1
+                    remember(seen, song, Outcome('simplified', None, None, keys))
+                    continue
+                variants = list(slug.variants())
+                new_candidates = [link for variant, link in variants]
+                song_features = genius_link.rule_features(title)
+
+                # entries stored before the candidates were kept only know their link, which is trusted if it is
+                # still the first link tried
+                if new_candidates == candidates or (candidates is None and url and new_candidates[0] == url):
+                    counts['unchanged'] += 1
+                    remember(seen, song, Outcome('unchanged', song_features, new_candidates, keys))
+                    if probe:
+                        cache.restamp(keys, rules, song_features, new_candidates)
+                    continue
+
+                # the song is remembered as soon as it is queued, so its other keys are never queued again
+                counts['reprobed'] += 1
+                outcome = Outcome('reprobed', song_features, new_candidates, keys)
+                remember(seen, song, outcome)
+                work.append((outcome, url, variants))
+
+            if not probe or not work:
+                continue
+            links = pool.map(lambda entry: genius_link.probe_variants(entry[2], index=index), work)
+            for (outcome, url, variants), link in zip(work, links):
+                # genius being unreachable says nothing about the song, its entries stay stale to be checked again
+                if link is None:
+                    counts['failed'] += 1
+                    continue
+                # a link which was found before is still a real page, nothing found never replaces it with a
+                # missing link
+                if not link and url:
+                    counts['kept'] += 1
+                    link = url
+                elif link != url:
+                    counts['changed'] += 1
+                outcome.link = link
+                outcome.pending = False
+                cache.restamp(outcome.waiting, rules, outcome.features, outcome.candidates, link)
+                outcome.waiting = []
+
+    # returns the counters of the run
+    return counts
+
+
+def remember(seen, song, outcome):
+    """
+    Remembers the outcome of a song, forgetting the oldest song once too many are remembered
+    :param seen: OrderedDict of the songs seen last
+    :param song: (artists, title) tuple of the song
+    :param outcome: Outcome of the song
+    """
+
+    seen[song] = outcome
+    if len(seen) > REMEMBERED:
+        seen.popitem(last=False)
+
+
+def main():
+    """
+    Brings the cache up to date with the current rules from the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Probes again the cached songs whose links change under the current '
+                                                 'cleanup rules')
+    parser.add_argument('--cache', default=CACHE_PATH, help='location of the cache database')
+    parser.add_argument('--features',
+                        help='comma separated token types whose rules changed (feat, strip, keep, open, close, slash, '
+                             'hyphen), titles without any of them are not checked')
+    parser.add_argument('--dry-run', action='store_true', help='count what would be probed without probing or writing')
+    parser.add_argument('--index', default=INDEX_PATH,
+                        help='index of known genius slugs checked before probing (used if it exists)')
+    parser.add_argument('--probe-workers', type=int, default=PROBE_WORKERS,
+                        help='number of songs probed at the same time')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='number of cache rows checked at once')
+    arguments = parser.parse_args()
+
+    cache = ResolutionCache(arguments.cache)
+    index = open_index(arguments.index)
+    features = set(arguments.features.split(',')) if arguments.features else None
+
+    start = time.perf_counter()
+    print('rules %s, %d cached keys to check' % (genius_link.get_rules_fingerprint(),
+                                                 cache.count_stale(genius_link.get_rules_fingerprint())),
+          file=sys.stderr)
+    try:
+        counts = reresolve(cache, index, features, not arguments.dry_run, arguments.batch_size,
+                           arguments.probe_workers)
+    finally:
+        cache.close()
+        if index is not None:
+            index.close()
+
+    print(', '.join('%s %d' % (name, count) for name, count in counts.items()) +
+          ' in %.1f s' % (time.perf_counter() - start), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
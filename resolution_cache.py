@@ -0,0 +1,249 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# default location of the cache database (stored in the home directory so every run shares it)
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.genius_link_cache.sqlite')
+
+# number of seconds a found link stays valid (30 days)
+CACHE_TTL = 30 * 24 * 60 * 60
+
+# number of seconds a 'Cannot find link!' result stays valid (1 day, genius pages get added over time)
+NEGATIVE_TTL = 24 * 60 * 60
+
+# maximum number of keys stored before the least recently used ones are removed
+MAX_ENTRIES = 100000
+
+# fraction of the bound removed at once when the cache is full, so a full cache is not counted and pruned on every put
+EVICT_FRACTION = 0.01
+
+# columns added after the first release, existing databases get them on open (null until the row is written again)
+# rules - fingerprint of the cleanup rules the link was resolved with
+# features - token types of the title, which tell the rules it triggered
+# candidates - JSON list of the candidate links which were probed, in their original order
+ADDED_COLUMNS = (('rules', 'TEXT'), ('features', 'TEXT'), ('candidates', 'TEXT'))
+
+
+def track_key(track_id):
+    """
+    Determines the cache key of a song from its spotify track id
+    :param track_id: spotify id of the song
+    :return: cache key string, None if the song has no track id (local files)
+    """
+
+    if not track_id:
+        return None
+    return 'id:' + track_id
+
+
+def name_key(artists_json, track_name):
+    """
+    Determines the fallback cache key of a song from the names of its artists and its title
+    :param artists_json: an list containing the names of all artists responsible in anyway for the making of the song
+    :param track_name: the name of the song
+    :return: cache key string
+    """
+
+    # artists and title are only lowercased and trimmed, the expensive cleanup is exactly what a cache hit skips
+    artists = '\x1f'.join(artist['name'].lower().strip() for artist in artists_json)
+    return 'name:' + artists + '\x1e' + track_name.lower().strip()
+
+
+class ResolutionCache:
+    """
+    Persistent cache mapping songs to their genius link, backed by a sqlite database in WAL mode
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+        """
+        Opens (and creates if needed) the cache database
+        :param path: location of the database file (':memory:' keeps the cache in memory only)
+        :param ttl: number of seconds a found link stays valid
+        :param negative_ttl: number of seconds a missing link stays valid
+        :param max_entries: maximum number of keys stored before the least recently used ones are removed
+        """
+
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        # counters exposed through stats()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+        # the connection is shared between threads, so every statement runs under this lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS resolutions (key TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                                'artists TEXT NOT NULL, title TEXT NOT NULL, created REAL NOT NULL, '
+                                'accessed REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS resolutions_accessed ON resolutions (accessed)')
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(resolutions)')}
+        for column, kind in ADDED_COLUMNS:
+            if column not in columns:
+                self.connection.execute('ALTER TABLE resolutions ADD COLUMN %s %s' % (column, kind))
+        self.connection.commit()
+
+        # number of keys stored, kept up to date by every write so the bound is checked without counting the table
+        self.entries = self.connection.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+
+    def get(self, track_id, artists_json, track_name):
+        """
+        Looks up the genius link of a song, first by track id and then by artists and title
+        :param track_id: spotify id of the song (can be None)
+        :param artists_json: an list containing the names of all artists responsible for the song (empty if only the
+            track id is known)
+        :param track_name: the name of the song
+        :return: genius link of the song, '' if the song is known to have no link, None if the song is not cached
+        """
+
+        now = time.time()
+        keys = [key for key in (track_key(track_id), name_key(artists_json, track_name) if artists_json else None)
+                if key]
+
+        with self.lock:
+            for key in keys:
+                row = self.connection.execute('SELECT url, created FROM resolutions WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    continue
+                url, created = row
+
+                # entries past their ttl are removed so the song gets resolved again
+                if now - created > (self.ttl if url else self.negative_ttl):
+                    self.connection.execute('DELETE FROM resolutions WHERE key = ?', (key,))
+                    self.connection.commit()
+                    self.entries -= 1
+                    self.expired += 1
+                    continue
+
+                # marks the entry as recently used so it is the last to be evicted
+                self.connection.execute('UPDATE resolutions SET accessed = ? WHERE key = ?', (now, key))
+                self.connection.commit()
+                if url:
+                    self.hits += 1
+                else:
+                    self.negative_hits += 1
+                return url
+
+            self.misses += 1
+            return None
+
+    def put(self, track_id, artists_json, track_name, url, rules=None, features=None, candidates=None):
+        """
+        Stores the genius link of a song under both of its keys
+        :param track_id: spotify id of the song (can be None)
+        :param artists_json: an list containing the names of all artists responsible for the song
+        :param track_name: the name of the song
+        :param url: genius link of the song, '' if no link could be found
+        :param rules: fingerprint of the cleanup rules the link was resolved with (None if unknown)
+        :param features: token types of the title from genius_link.rule_features (None if unknown)
+        :param candidates: list of the candidate links which were probed (None if unknown)
+        """
+
+        now = time.time()
+        artists = json.dumps([artist['name'] for artist in artists_json])
+        candidates = json.dumps(candidates) if candidates is not None else None
+        keys = [key for key in (track_key(track_id), name_key(artists_json, track_name)) if key]
+
+        with self.lock:
+            # only keys which are not stored yet add to the number of entries (looked up through the primary key)
+            self.entries += len(keys) - self.connection.execute(
+                'SELECT COUNT(*) FROM resolutions WHERE key IN (%s)' % ', '.join('?' * len(keys)), keys).fetchone()[0]
+            self.connection.executemany('INSERT OR REPLACE INTO resolutions (key, url, artists, title, created, '
+                                        'accessed, rules, features, candidates) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [(key, url, artists, track_name, now, now, rules, features, candidates)
+                                         for key in keys])
+
+            # removes the least recently used entries once the cache grows past its bound, the table is only counted
+            # then (other processes sharing the database can have changed it)
+            if self.entries > self.max_entries:
+                self.entries = self.connection.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+                if self.entries > self.max_entries:
+                    keep = self.max_entries - int(self.max_entries * EVICT_FRACTION)
+                    self.connection.execute('DELETE FROM resolutions WHERE key IN (SELECT key FROM resolutions '
+                                            'ORDER BY accessed LIMIT ?)', (self.entries - keep,))
+                    self.entries = keep
+            self.connection.commit()
+
+    def stale(self, rules, batch_size=500):
+        """
+        Streams the entries resolved under other rules than the current ones, one page of rows at a time
+        :param rules: fingerprint of the current cleanup rules
+        :param batch_size: number of rows read per page
+        :return: generator of lists of (key, url, artists, title, features, candidates) tuples, artists and candidates
+            are decoded from JSON (candidates is None for entries stored before candidates were kept)
+        """
+
+        # pages continue after the last key seen, so rows which stay stale (or get rewritten) are never read twice and
+        # the lock is not held while the caller works on a page
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute('SELECT key, url, artists, title, features, candidates FROM resolutions '
+                                               'WHERE key > ? AND (rules IS NULL OR rules != ?) ORDER BY key LIMIT ?',
+                                               (last_key, rules, batch_size)).fetchall()
+            if not rows:
+                return
+            last_key = rows[-1][0]
+            yield [(key, url, json.loads(artists), title, features,
+                    json.loads(candidates) if candidates is not None else None)
+                   for key, url, artists, title, features, candidates in rows]
+
+    def count_stale(self, rules):
+        """
+        Counts the entries resolved under other rules than the current ones
+        :param rules: fingerprint of the current cleanup rules
+        :return: number of stale keys
+        """
+
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM resolutions WHERE rules IS NULL OR rules != ?',
+                                           (rules,)).fetchone()[0]
+
+    def restamp(self, keys, rules, features, candidates, url=None):
+        """
+        Records that entries were checked against the current rules, only resetting their age if they were probed again
+        :param keys: list of cache keys of the same song
+        :param rules: fingerprint of the current cleanup rules
+        :param features: token types of the title from genius_link.rule_features
+        :param candidates: list of the candidate links under the current rules
+        :param url: genius link found by probing again (None if the candidates did not change and the link is kept)
+        """
+
+        candidates = json.dumps(candidates)
+        with self.lock:
+            if url is None:
+                self.connection.executemany('UPDATE resolutions SET rules = ?, features = ?, candidates = ? '
+                                            'WHERE key = ?', [(rules, features, candidates, key) for key in keys])
+            else:
+                self.connection.executemany('UPDATE resolutions SET url = ?, created = ?, rules = ?, features = ?, '
+                                            'candidates = ? WHERE key = ?',
+                                            [(url, time.time(), rules, features, candidates, key) for key in keys])
+            self.connection.commit()
+
+    def stats(self):
+        """
+        Returns the hit and miss counters of the cache
+        :return: dictionary of counters
+        """
+
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+        return {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+                'expired': self.expired, 'entries': entries}
+
+    def close(self):
+        """
+        Closes the cache database
+        """
+
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import genius_link
+import instrumentation
+from candidate_stats import CandidateStats
+from resolution_cache import ResolutionCache, name_key, track_key
+from slug_index import INDEX_PATH, open_index
+
+
+# number of songs resolved against genius at the same time, every other lookup waits for a free slot (the requests
+# they send share the genius_link.PROBE_CONCURRENCY probe threads, which bound what reaches genius at once)
+MAX_CONCURRENCY = 8
+
+# number of recently resolved songs answered straight from memory (popular songs never reach the cache database)
+RECENT_SIZE = 4096
+
+# largest request body accepted (batch requests), in bytes
+MAX_BODY = 1024 * 1024
+
+# largest number of songs in one batch request
+MAX_BATCH = 500
+
+# reason phrases of the status codes the service answers with
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+
+class RequestError(Exception):
+    """
+    Raised when a request cannot be answered, carries the status code sent back
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResolutionService:
+    """
+    Resolves genius links for many clients at once, identical lookups in flight at the same time share one resolution
+    """
+
+    def __init__(self, cache=None, stats=None, user=None, max_concurrency=MAX_CONCURRENCY, recent_size=RECENT_SIZE,
+                 index=None):
+        """
+        Sets up the service (must be created inside the running event loop)
+        :param cache: ResolutionCache storing previously resolved links (None disables caching)
+        :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+        :param user: spotify user object used to look up songs only known by their track id (None rejects them)
+        :param max_concurrency: number of songs resolved against genius at the same time
+        :param recent_size: number of recently resolved songs kept in memory
+        :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+        """
+
+        self.cache = cache
+        self.stats = stats
+        self.index = index
+        self.user = user
+        self.recent_size = recent_size
+
+        # key -> genius link of the most recently resolved songs, least recently used first
+        self.recent = OrderedDict()
+        # key -> future of the resolution currently running for it
+        self.in_flight = {}
+
+        # resolution blocks on the network, so it runs on threads while the event loop keeps answering requests, the
+        # probes of every song resolved at once go through the shared probe threads, never more than
+        # genius_link.PROBE_CONCURRENCY of them at the same time
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def remember(self, key, html_address):
+        """
+        Keeps a resolved link in memory, forgetting the least recently used one if there are too many
+        :param key: cache key of the song
+        :param html_address: genius link of the song ('' if no link could be found)
+        """
+
+        self.recent[key] = html_address
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+
+    async def resolve(self, track_id=None, artists=None, title=None):
+        """
+        Determines the genius link of a song, joining the resolution already running for it if there is one
+        :param track_id: spotify id of the song
+        :param artists: list of artist names, main artist first (needed if there is no track id)
+        :param title: name of the song as spotify lists it (needed if there is no track id)
+        :return: genius link of the song, '' if no link could be found
+        """
+
+        if not track_id and not (artists and title):
+            raise RequestError(400, 'track_id or artists and title are required')
+        artists_json = [{'name': artist} for artist in artists] if artists and title else None
+        key = track_key(track_id) if track_id else name_key(artists_json, title)
+
+        # popular songs are answered without leaving the event loop
+        if key in self.recent:
+            self.recent.move_to_end(key)
+            instrumentation.count('service', result='memory')
+            return self.recent[key]
+
+        # a lookup for a song which is already being resolved waits for that resolution instead of starting another
+        future = self.in_flight.get(key)
+        if future is not None:
+            instrumentation.count('service', result='coalesced')
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # only the resolution being cancelled is answered, a cancelled lookup is cancelled like any other
+                if not future.cancelled():
+                    raise
+                raise RequestError(503, 'the resolution of the song was cancelled')
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            async with self.semaphore:
+                html_address = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.resolve_blocking, track_id, artists_json, title)
+            instrumentation.count('service', result='resolved')
+            # songs without a link are left to the cache, which retries them once its shorter negative ttl runs out
+            if html_address:
+                self.remember(key, html_address)
+            future.set_result(html_address)
+        except Exception as error:
+            future.set_exception(error)
+            # the exception is retrieved here so it is not reported as never retrieved when nobody else waited on it
+            future.exception()
+            raise
+        except BaseException:
+            # the lookups waiting on this one are released when it is cancelled, instead of waiting forever
+            future.cancel()
+            raise
+        finally:
+            del self.in_flight[key]
+        return html_address
+
+    def resolve_blocking(self, track_id, artists_json, title):
+        """
+        Resolves a song on a worker thread, looking the song up on spotify first if only its track id is known
+        :param track_id: spotify id of the song (None if it is not known)
+        :param artists_json: list of spotify artist objects (None if only the track id is known)
+        :param title: name of the song as spotify lists it (None if only the track id is known)
+        :return: genius link of the song, '' if no link could be found (a RequestError with a 503 is raised if genius
+            could not be reached)
+        """
+
+        if artists_json is None:
+            # a song resolved before is found by its track id without asking spotify
+            if self.cache is not None:
+                html_address = self.cache.get(track_id, [], None)
+                if html_address is not None:
+                    return html_address
+            if self.user is None:
+                raise RequestError(400, 'looking up a track_id needs a spotify user, pass artists and title instead')
+            item = self.user.track(track_id)
+        else:
+            item = {'id': track_id, 'name': title, 'artists': artists_json}
+        html_address = genius_link.resolve_item(item, self.cache, self.stats, self.index)
+        # a song genius could not be asked about is not answered as missing, the client can ask again later
+        if html_address is None:
+            raise RequestError(503, 'genius could not be reached, try again later')
+        return html_address
+
+    async def resolve_query(self, query):
+        """
+        Resolves one song described by the parameters of a request
+        :param query: dictionary with track_id, or artists (list or comma separated) and title
+        :return: dictionary sent back to the client
+        """
+
+        if not isinstance(query, dict):
+            raise RequestError(400, 'every song must be an object')
+        artists = query.get('artists')
+        if isinstance(artists, str):
+            artists = [artist.strip() for artist in artists.split(',') if artist.strip()]
+        if artists is not None and not (isinstance(artists, list) and all(isinstance(artist, str)
+                                                                         for artist in artists)):
+            raise RequestError(400, 'artists must be a list of names')
+        html_address = await self.resolve(query.get('track_id'), artists, query.get('title'))
+        return {'url': html_address or None, 'found': bool(html_address)}
+
+    async def handle(self, method, path, body):
+        """
+        Answers one http request
+        :param method: http method of the request
+        :param path: path of the request including the query string
+        :param body: body of the request as bytes
+        :return: tuple of status code and the JSON object sent back
+        """
+
+        url = urlsplit(path)
+        if url.path == '/resolve':
+            if method != 'GET':
+                raise RequestError(405, 'use GET for /resolve')
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            # several artists can be passed either comma separated or as repeated parameters
+            artists = parse_qs(url.query).get('artists')
+            if artists and len(artists) > 1:
+                query['artists'] = artists
+            return 200, await self.resolve_query(query)
+
+        if url.path == '/resolve/batch':
+            if method != 'POST':
+                raise RequestError(405, 'use POST for /resolve/batch')
+            try:
+                queries = json.loads(body or b'null')
+            except ValueError:
+                raise RequestError(400, 'the body must be a JSON list of songs')
+            if not isinstance(queries, list):
+                raise RequestError(400, 'the body must be a JSON list of songs')
+            if len(queries) > MAX_BATCH:
+                raise RequestError(413, 'at most %d songs per batch' % MAX_BATCH)
+
+            # every song of the batch is resolved at once, a failing song does not fail the others
+            results = await asyncio.gather(*(self.resolve_query(query) for query in queries), return_exceptions=True)
+            return 200, [{'error': str(result)} if isinstance(result, Exception) else result for result in results]
+
+        raise RequestError(404, 'unknown path %s' % url.path)
+
+    async def connection(self, reader, writer):
+        """
+        Serves the http requests of one client connection (kept alive until the client closes it)
+        :param reader: stream the requests are read from
+        :param writer: stream the responses are written to
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                # headers are read up to the empty line, only the body length and keep alive matter here
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                try:
+                    try:
+                        length = int(headers.get('content-length') or 0)
+                    except ValueError:
+                        length = -1
+                    # without a valid length the end of the body is not known, so the connection cannot be reused
+                    if length < 0:
+                        keep_alive = False
+                        raise RequestError(400, 'the content-length header is not a valid length')
+                    if length > MAX_BODY:
+                        keep_alive = False
+                        raise RequestError(413, 'the body is larger than %d bytes' % MAX_BODY)
+                    body = await reader.readexactly(length) if length else b''
+                    status, response = await self.handle(method, path, body)
+                except RequestError as error:
+                    status, response = error.status, {'error': str(error)}
+                except Exception as error:
+                    status, response = 502, {'error': 'resolution failed: %s' % error}
+
+                payload = json.dumps(response).encode('utf-8')
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n' % (status, REASONS[status], len(payload),
+                                                          'keep-alive' if keep_alive else 'close')).encode('latin-1')
+                             + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        """
+        Stops the worker threads once the resolutions running on them are done
+        """
+
+        self.executor.shutdown(wait=True)
+
+
+async def serve(host='127.0.0.1', port=8000, cache=None, stats=None, user=None, max_concurrency=MAX_CONCURRENCY,
+                index=None):
+    """
+    Runs the resolution service until it is cancelled
+    :param host: address to listen on
+    :param port: port to listen on
+    :param cache: ResolutionCache storing previously resolved links (None disables caching)
+    :param stats: CandidateStats used to probe the most likely links first (None keeps the original order)
+    :param user: spotify user object used to look up songs only known by their track id (None rejects them)
+    :param max_concurrency: number of songs resolved against genius at the same time
+    :param index: SlugIndex of known genius slugs checked before probing (None always probes)
+    """
+
+    service = ResolutionService(cache, stats, user, max_concurrency, index=index)
+    server = await asyncio.start_server(service.connection, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main():
+    """
+    Runs the resolution service from the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Serves genius links over http to any number of clients')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENCY,
+                        help='number of songs resolved against genius at the same time')
+    parser.add_argument('--probe-concurrency', type=int, default=genius_link.PROBE_CONCURRENCY,
+                        help='largest number of requests sent to genius at the same time, across every song')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the resolution cache')
+    parser.add_argument('--username', help='spotify user used to look up songs only known by their track id')
+    parser.add_argument('--index', default=INDEX_PATH,
+                        help='index of known genius slugs checked before probing (used if it exists)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='record timings and counters and serve them on this port (/metrics and /metrics.json)')
+    arguments = parser.parse_args()
+
+    if arguments.metrics_port:
+        instrumentation.enable()
+        instrumentation.serve(arguments.metrics_port)
+    genius_link.PROBE_CONCURRENCY = arguments.probe_concurrency
+
+    cache = None if arguments.no_cache else ResolutionCache()
+    stats = CandidateStats()
+    user = genius_link.get_user(arguments.username) if arguments.username else None
+    print('serving genius links on http://%s:%d/resolve' % (arguments.host, arguments.port))
+    try:
+        asyncio.run(serve(arguments.host, arguments.port, cache, stats, user, arguments.concurrency,
+                          open_index(arguments.index)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.save()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == '__main__':
+    main()
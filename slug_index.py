@@ -0,0 +1,324 @@
+import argparse
+import gzip
+import heapq
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+
+
+# default location of the index (stored in the home directory so every run shares it)
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.genius_link_index')
+
+# number of slugs sorted in memory at once while building, memory stays bounded however many urls are ingested
+CHUNK_SIZE = 500000
+
+# number of bytes of the index on each side of a missing slug compared against it when looking for near misses
+SUGGEST_WINDOW = 16 * 1024
+
+# precompiled pattern finding genius lyrics links anywhere in a line (plain lists, sitemaps and html dumps alike)
+LYRICS_URL = re.compile(r'genius\.com/([^\s<>"\'?#/]+)-lyrics\b', re.IGNORECASE)
+
+
+def slug_of(html_address):
+    """
+    Takes the slug out of a genius lyrics link
+    :param html_address: genius link such as https://genius.com/travis-scott-goosebumps-lyrics
+    :return: lowercase slug such as travis-scott-goosebumps, None if the link is not a lyrics link
+    """
+
+    match = LYRICS_URL.search(html_address)
+    return match.group(1).lower() if match else None
+
+
+def read_slugs(paths):
+    """
+    Streams the slugs of every genius lyrics link found in a list of files
+    :param paths: list of text files, sitemaps or gzipped versions of either ('-' reads from standard input)
+    :return: generator of lowercase slugs (may contain duplicates)
+    """
+
+    for path in paths:
+        if path == '-':
+            file = sys.stdin
+        elif path.endswith('.gz'):
+            file = gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+        else:
+            file = open(path, encoding='utf-8', errors='replace')
+        try:
+            for line in file:
+                # a sitemap can hold many urls on a single line
+                for match in LYRICS_URL.finditer(line):
+                    yield match.group(1).lower()
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+
+def write_run(slugs, directory):
+    """
+    Sorts a chunk of slugs and writes it to a temporary file
+    :param slugs: list of slugs
+    :param directory: directory the temporary file is created in
+    :return: location of the temporary file
+    """
+
+    slugs.sort()
+    descriptor, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(descriptor, 'w', encoding='utf-8', newline='\n') as file:
+        previous = None
+        for slug in slugs:
+            if slug != previous:
+                file.write(slug + '\n')
+            previous = slug
+    return path
+
+
+def build_index(paths, index_path=INDEX_PATH, chunk_size=CHUNK_SIZE):
+    """
+    Builds the index from lists of genius links with an external merge sort, so memory stays bounded by the chunk size
+    :param paths: list of text files or sitemaps holding genius lyrics links
+    :param index_path: location the index is written to
+    :param chunk_size: number of slugs sorted in memory at once
+    :return: number of distinct slugs in the index
+    """
+
+    directory = os.path.dirname(os.path.abspath(index_path))
+    runs = []
+    chunk = []
+
+    try:
+        # every full chunk is sorted and written out as a run
+        for slug in read_slugs(paths):
+            chunk.append(slug)
+            if len(chunk) >= chunk_size:
+                runs.append(write_run(chunk, directory))
+                chunk = []
+        if chunk or not runs:
+            runs.append(write_run(chunk, directory))
+        del chunk
+
+        # the runs are merged into one sorted file of distinct slugs, reading one line of each run at a time
+        files = [open(run, encoding='utf-8') for run in runs]
+        count = 0
+        try:
+            with open(index_path + '.tmp', 'w', encoding='utf-8', newline='\n') as output:
+                previous = None
+                for line in heapq.merge(*files):
+                    if line != previous:
+                        output.write(line)
+                        count += 1
+                    previous = line
+        finally:
+            for file in files:
+                file.close()
+        os.replace(index_path + '.tmp', index_path)
+    finally:
+        for run in runs:
+            os.remove(run)
+
+    return count
+
+
+def edit_distance(first, second, limit):
+    """
+    Determines the levenshtein distance between two strings, giving up once it is known to be above a limit
+    :param first: first string
+    :param second: second string
+    :param limit: largest distance of interest
+    :return: edit distance, limit + 1 if it is larger than the limit
+    """
+
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+
+    # only the diagonal band of the table within the limit is filled, every cell outside it is above the limit anyway
+    above = limit + 1
+    previous = [num if num <= limit else above for num in range(len(second) + 1)]
+    for num, char in enumerate(first, 1):
+        low, high = max(1, num - limit), min(len(second), num + limit)
+        current = [above] * (len(second) + 1)
+        current[0] = num if num <= limit else above
+        for other_num in range(low, high + 1):
+            current[other_num] = min(previous[other_num] + 1, current[other_num - 1] + 1,
+                                     previous[other_num - 1] + (char != second[other_num - 1]))
+        # every later row is at least as large as the smallest value of this one
+        if min(current[low - 1:high + 1]) > limit:
+            return above
+        previous = current
+    return min(previous[-1], above)
+
+
+class SlugIndex:
+    """
+    Sorted file of known genius slugs, memory mapped and binary searched so lookups never load it into memory
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        """
+        Opens the index
+        :param path: location of the index built by build_index
+        """
+
+        self.path = path
+        self.file = open(path, 'rb')
+        # an empty file cannot be memory mapped, an empty index simply never has an answer
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+
+    def line_start(self, offset):
+        """
+        Determines the start of the line an offset falls in
+        :param offset: position in the file
+        :return: position of the first byte of the line
+        """
+
+        return self.data.rfind(b'\n', 0, offset) + 1
+
+    def line_at(self, start):
+        """
+        Reads the line starting at a position
+        :param start: position of the first byte of the line
+        :return: tuple of the line without its newline and the position of the next line
+        """
+
+        end = self.data.find(b'\n', start)
+        if end == -1:
+            end = len(self.data)
+        return self.data[start:end], end + 1
+
+    def lower_bound(self, key):
+        """
+        Binary searches for the first line which is not smaller than a key
+        :param key: slug as bytes
+        :return: position of the first byte of that line (the size of the file if every line is smaller)
+        """
+
+        low, high = 0, len(self.data)
+        # invariant: every line starting before low is smaller than the key, every line starting at or after high is not
+        while low < high:
+            start = self.line_start((low + high) // 2)
+            line, following = self.line_at(start)
+            if line < key:
+                low = following
+            else:
+                high = start
+        return low
+
+    def __contains__(self, slug):
+        """
+        Determines if a slug is in the index
+        :param slug: lowercase slug
+        :return: True if genius is known to have the slug
+        """
+
+        key = slug.encode('utf-8')
+        start = self.lower_bound(key)
+        return start < len(self.data) and self.line_at(start)[0] == key
+
+    def find(self, candidates):
+        """
+        Finds the most preferred candidate link which is in the index
+        :param candidates: list of genius links ordered from most to least preferred
+        :return: the first candidate in the index, None if none of them are
+        """
+
+        for html_address in candidates:
+            slug = slug_of(html_address)
+            if slug and slug in self:
+                return html_address
+        return None
+
+    def suggest(self, slug, max_distance=2, limit=5):
+        """
+        Finds slugs in the index close to a missing one (for example a title with a typo or an extra word)
+        :param slug: lowercase slug
+        :param max_distance: largest edit distance of a suggestion
+        :param limit: largest number of suggestions
+        :return: list of (distance, slug) tuples, closest first
+        """
+
+        # only slugs sharing the first word (the start of the main artist) are compared, those are stored together,
+        # and of those only the ones stored near where the slug would be, so a common first word stays cheap
+        key = slug.encode('utf-8')
+        prefix = key.split(b'-', 1)[0]
+        position = self.lower_bound(key)
+        start = max(self.lower_bound(prefix), self.line_start(max(position - SUGGEST_WINDOW, 0)))
+        end = min(self.lower_bound(prefix + b'\xff'), position + SUGGEST_WINDOW)
+
+        suggestions = []
+        for line in self.data[start:end].split(b'\n'):
+            # lines differing in length by more than the distance are skipped before decoding them
+            if abs(len(line) - len(key)) > max_distance or not line.startswith(prefix):
+                continue
+            other = line.decode('utf-8')
+            distance = edit_distance(slug, other, max_distance)
+            if distance <= max_distance:
+                suggestions.append((distance, other))
+        return sorted(suggestions)[:limit]
+
+    def __len__(self):
+        """
+        Counts the slugs in the index (reads the whole file, only meant for reporting)
+        :return: number of slugs
+        """
+
+        return self.data.count(b'\n') if self.data else 0
+
+    def close(self):
+        """
+        Closes the index
+        """
+
+        if self.data:
+            self.data.close()
+        self.file.close()
+
+
+def open_index(path=INDEX_PATH):
+    """
+    Opens the index if one has been built
+    :param path: location of the index
+    :return: SlugIndex object, None if there is no index at that location
+    """
+
+    return SlugIndex(path) if path and os.path.exists(path) else None
+
+
+def main():
+    """
+    Builds or queries the index from the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Builds and queries the offline index of known genius slugs')
+    parser.add_argument('--path', default=INDEX_PATH, help='location of the index')
+    actions = parser.add_subparsers(dest='action', required=True)
+    build = actions.add_parser('build', help='build the index from text files or sitemaps of genius links')
+    build.add_argument('sources', nargs='+', help='files holding genius lyrics links (.gz is read compressed)')
+    build.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of slugs sorted in memory at once')
+    lookup = actions.add_parser('lookup', help='check if slugs or links are in the index')
+    lookup.add_argument('slugs', nargs='+', help='slugs or genius links')
+    suggest = actions.add_parser('suggest', help='list the slugs in the index closest to a slug')
+    suggest.add_argument('slug', help='slug or genius link')
+    suggest.add_argument('--distance', type=int, default=2, help='largest edit distance of a suggestion')
+    arguments = parser.parse_args()
+
+    if arguments.action == 'build':
+        start = time.perf_counter()
+        count = build_index(arguments.sources, arguments.path, arguments.chunk_size)
+        print('indexed %d slugs in %.1f s' % (count, time.perf_counter() - start))
+        return
+
+    index = SlugIndex(arguments.path)
+    if arguments.action == 'lookup':
+        for slug in arguments.slugs:
+            print('%s %s' % ('found  ' if (slug_of(slug) or slug.lower()) in index else 'missing', slug))
+    else:
+        for distance, other in index.suggest(slug_of(arguments.slug) or arguments.slug.lower(), arguments.distance):
+            print('%d %s' % (distance, other))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import genius_link
+
+
+class StubGenius(BaseHTTPRequestHandler):
+    """
+    Local stand-in for genius, the path of every link tells it how to answer
+    /found-*, /missing-*, /error-* - 200, 404 or 500 to every request
+    /nohead-* - 405 to HEAD requests and 200 to GET requests
+    /slow-* - 200 after waiting half a second
+    """
+
+    # (method, path) of every request received, shared by the tests
+    requests = []
+
+    def answer(self):
+        StubGenius.requests.append((self.command, self.path))
+        name = self.path.strip('/')
+        if name.startswith('slow'):
+            time.sleep(0.5)
+        if name.startswith('nohead'):
+            status = 405 if self.command == 'HEAD' else 200
+        else:
+            status = {'found': 200, 'missing': 404, 'error': 500, 'slow': 200}[name.split('-')[0]]
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_HEAD = answer
+    do_GET = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class ProbeTest(unittest.TestCase):
+    """
+    Checks the concurrent probing of candidate links against the local stand-in
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubGenius)
+        cls.url = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubGenius.requests.clear()
+
+    def links(self, *names):
+        return [self.url + name for name in names]
+
+    def requested(self, variants):
+        # probes of earlier tests which were not waited for can still arrive, so only the links of the test are kept
+        paths = ['/' + link[len(self.url):] for variant, link in variants]
+        return [path for method, path in StubGenius.requests if path in paths]
+
+    def test_most_preferred_link_wins(self):
+        # the slow link is more preferred, so the link answering first is not accepted before it
+        links = self.links('missing-a', 'slow-b', 'found-c')
+        self.assertEqual(genius_link.probe_candidates(links), links[1])
+
+    def test_less_preferred_probes_are_not_waited_for(self):
+        links = self.links('found-a', 'slow-b', 'slow-c')
+        start = time.perf_counter()
+        self.assertEqual(genius_link.probe_candidates(links), links[0])
+        self.assertLess(time.perf_counter() - start, 0.4)
+
+    def test_head_not_allowed_falls_back_to_get(self):
+        links = self.links('nohead-a')
+        self.assertEqual(genius_link.probe_candidates(links), links[0])
+        # probes of earlier tests which were not waited for can still arrive, so only this link is looked at
+        self.assertEqual([method for method, path in StubGenius.requests if path == '/nohead-a'], ['HEAD', 'GET'])
+
+    def test_every_link_missing(self):
+        self.assertEqual(genius_link.probe_candidates(self.links('missing-a', 'missing-b')), '')
+
+    def test_failed_probe_is_not_a_missing_link(self):
+        self.assertIsNone(genius_link.probe_candidates(self.links('missing-a', 'error-b')))
+        # a link found is still returned when a less preferred probe failed
+        links = self.links('found-a', 'error-b')
+        self.assertEqual(genius_link.probe_candidates(links), links[0])
+
+    def test_unreachable_genius(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubGenius)
+        closed = 'http://127.0.0.1:%d/found-a' % server.server_address[1]
+        server.server_close()
+        self.assertIsNone(genius_link.probe_candidates([closed]))
+
+    def test_outcomes(self):
+        outcomes = {}
+        links = self.links('missing-a', 'found-b')
+        genius_link.probe_candidates(links, outcomes=outcomes)
+        self.assertEqual(outcomes, {links[0]: False, links[1]: True})
+
+    def test_learned_stats_never_change_the_winner(self):
+        from candidate_stats import CandidateStats
+
+        # songs like this one have always resolved without their container, so that link is probed on its own first
+        stats = CandidateStats(None)
+        for _ in range(10):
+            stats.record('remix', ['all_artists'], 'without_container')
+        variants = list(zip(['all_artists', 'without_container'], self.links('slow-remix', 'found-plain')))
+        self.assertTrue(stats.probe_alone('remix', 'without_container'))
+
+        # the link with the container still exists, so it wins and is recorded as found
+        self.assertEqual(genius_link.probe_variants(variants, stats, 'remix'), variants[0][1])
+        self.assertEqual(stats.table['remix']['all_artists'], [1, 11])
+
+    def test_confirmed_artist_correction_skips_the_other_rule(self):
+        from artist_index import ArtistIndex
+
+        artists = [{'id': 'a1', 'name': 'Khalid'}, {'id': 'a2', 'name': 'Swae Lee'}]
+        artist_index = ArtistIndex(':memory:')
+        variants = list(zip(['all_artists', 'main_artist'], self.links('missing-both', 'found-main')))
+
+        # a correction learned from one song still waits for the link with every artist
+        artist_index.learn(artists, 'main_artist')
+        preferred, confirmed = artist_index.correction(artists)
+        self.assertEqual((preferred, confirmed), ('main_artist', False))
+        self.assertEqual(genius_link.probe_variants(variants, preferred=preferred, confirmed=confirmed), variants[1][1])
+        self.assertEqual(len(self.requested(variants)), 2)
+
+        # once confirmed, the link of the main artist is accepted without probing the other one
+        StubGenius.requests.clear()
+        artist_index.learn(artists, 'main_artist+without_container')
+        preferred, confirmed = artist_index.correction(artists)
+        self.assertEqual((preferred, confirmed), ('main_artist', True))
+        self.assertEqual(genius_link.probe_variants(variants, preferred=preferred, confirmed=confirmed), variants[1][1])
+        self.assertEqual(self.requested(variants), ['/found-main'])
+
+        # a confirmed rule without any link of its own still falls back to the other one
+        variants = list(zip(['all_artists', 'main_artist'], self.links('found-both', 'missing-main')))
+        self.assertEqual(genius_link.probe_variants(variants, preferred=preferred, confirmed=confirmed), variants[0][1])
+        artist_index.close()
+
+    def test_watcher_retries_while_genius_is_unreachable(self):
+        item = {'id': 'song', 'name': 'Song', 'artists': [{'name': 'Found'}], 'duration_ms': 200000}
+
+        class User:
+            def current_user_playing_track(self):
+                return {'is_playing': True, 'progress_ms': 0, 'item': item}
+
+        # genius cannot be reached for the first poll and is back for the next ones
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubGenius)
+        closed = 'http://127.0.0.1:%d/' % server.server_address[1]
+        server.server_close()
+        original, genius_link.GENIUS_URL = genius_link.GENIUS_URL, closed
+
+        def sleep(seconds):
+            genius_link.GENIUS_URL = self.url
+
+        reported = []
+        try:
+            genius_link.watch(User(), on_change=lambda link, changed: reported.append(link), max_polls=3, sleep=sleep)
+        finally:
+            genius_link.GENIUS_URL = original
+
+        # nothing is reported while genius is unreachable, the song is resolved again and reported once
+        self.assertEqual(reported, [self.url + 'found-song-lyrics'])
+
+    def test_simplified_links_are_not_kept(self):
+        from candidate_stats import CandidateStats
+        from resolution_cache import ResolutionCache
+
+        cache = ResolutionCache(':memory:')
+        stats = CandidateStats(None)
+        title = 'song ' + 'x ' * genius_link.MAX_TITLE_LENGTH
+        original, genius_link.GENIUS_URL = genius_link.GENIUS_URL, self.url
+        try:
+            link = genius_link.resolve(['Found'], title, cache, 'long', stats)
+        finally:
+            genius_link.GENIUS_URL = original
+
+        # the title is too long for the cleanup rules, its simplified link is answered but not cached or learned from
+        self.assertTrue(link.startswith(self.url + 'found-song-x-x-'))
+        self.assertIsNone(cache.get('long', [{'name': 'Found'}], title))
+        self.assertEqual(stats.table, {})
+        cache.close()
+
+    def test_prefetch_is_charged_per_request(self):
+        from prefetch import Prefetcher
+        from resolution_cache import ResolutionCache
+
+        cache = ResolutionCache(':memory:')
+        prefetcher = Prefetcher(None, cache, budget=100, clock=lambda: 0)
+        original, genius_link.GENIUS_URL = genius_link.GENIUS_URL, self.url
+        try:
+            # genius fails every link of this song, nothing is cached so it is not counted as prefetched
+            prefetcher.prefetch({'id': 'error', 'name': 'Song (Live) / Other', 'artists': [{'name': 'Error'}]})
+            self.assertNotIn('error', prefetcher.prefetched)
+            self.assertIsNone(cache.get('error', [{'name': 'Error'}], 'song (live) / other'))
+            prefetcher.prefetch({'id': 'found', 'name': 'Song', 'artists': [{'name': 'Found'}]})
+            self.assertIn('found', prefetcher.prefetched)
+        finally:
+            genius_link.GENIUS_URL = original
+            prefetcher.stop()
+            cache.close()
+
+        # every request sent to genius came out of the budget, not one per song
+        time.sleep(0.2)
+        sent = [path for method, path in StubGenius.requests if path.startswith(('/error-song', '/found-song'))]
+        self.assertGreater(len(sent), 2)
+        self.assertEqual(100 - prefetcher.remaining(), len(sent))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+import genius_link
+from reresolve import reresolve
+from resolution_cache import ResolutionCache
+from test_genius_link import StubGenius
+
+
+class ReresolveTest(unittest.TestCase):
+    """
+    Checks bringing a cache up to date with the current rules against the local stand-in for genius
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubGenius)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.genius_url = genius_link.GENIUS_URL
+        genius_link.GENIUS_URL = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        genius_link.GENIUS_URL = cls.genius_url
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def fill(self, songs):
+        # every song is stored under two track ids as if it had been resolved under older rules
+        cache = ResolutionCache(':memory:')
+        for num, (artist, title, url, current) in enumerate(songs):
+            artists = [{'name': artist}]
+            slug = genius_link.Slug.from_track(artists, title)
+            candidates = [link for variant, link in slug.variants()] if current else [url]
+            for track_id in ('a%d' % num, 'b%d' % num):
+                cache.put(track_id, artists, title, url, 'old', genius_link.rule_features(title), candidates)
+        return cache
+
+    def songs(self):
+        url = genius_link.GENIUS_URL
+        songs = []
+        for num in range(5):
+            # found under the new rules, a missing link which keeps its old one, a failed probe, and unchanged links
+            songs.append(('Found', 'rerun song %d (live)' % num, url + 'old-%d' % num, False))
+            songs.append(('Missing', 'rerun tune %d' % num, url + 'old-tune-%d' % num, False))
+            songs.append(('Error', 'rerun track %d' % num, url + 'old-track-%d' % num, False))
+            songs.append(('Found', 'rerun same %d' % num, url + 'found-rerun-same-%d-lyrics' % num, True))
+        return songs
+
+    def rows(self, cache):
+        return cache.connection.execute('SELECT key, url, rules FROM resolutions ORDER BY key').fetchall()
+
+    def test_page_size_does_not_change_the_outcome(self):
+        results = []
+        for batch_size in (1, 500):
+            cache = self.fill(self.songs())
+            counts = reresolve(cache, batch_size=batch_size)
+            results.append((counts, self.rows(cache)))
+            cache.close()
+
+        self.assertEqual(results[0], results[1])
+        counts = results[0][0]
+        # both track ids of the 20 songs are checked (the name key goes along with the first one), each song is only
+        # probed once
+        self.assertEqual(counts['checked'], 40)
+        self.assertEqual((counts['reprobed'], counts['unchanged']), (30, 10))
+        self.assertEqual((counts['changed'], counts['kept'], counts['failed']), (5, 5, 5))
+
+    def test_failed_probes_stay_stale(self):
+        cache = self.fill(self.songs())
+        rules = genius_link.get_rules_fingerprint()
+        reresolve(cache)
+
+        # only the keys of the songs genius failed on are left to the next run, with the link they had
+        self.assertEqual(cache.count_stale(rules), 15)
+        stale = [row for page in cache.stale(rules) for row in page]
+        self.assertTrue(all(artists == ['Error'] and 'old-track' in url for key, url, artists, *rest in stale))
+        counts = reresolve(cache)
+        self.assertEqual((counts['checked'], counts['failed']), (10, 5))
+        cache.close()
+
+    def test_features_skip_unrelated_titles(self):
+        cache = self.fill(self.songs())
+        StubGenius.requests.clear()
+        counts = reresolve(cache, features={'strip'})
+
+        # none of the titles has a strip keyword, so nothing is rebuilt or probed and every entry is current (the
+        # request log is shared with the other tests, so only the links of these songs are looked at)
+        self.assertEqual((counts['checked'], counts['skipped']), (40, 40))
+        self.assertEqual([path for method, path in StubGenius.requests if 'rerun' in path], [])
+        self.assertEqual(cache.count_stale(genius_link.get_rules_fingerprint()), 0)
+        cache.close()
+
+        # the songs with a container are checked once the container rules changed
+        cache = self.fill(self.songs())
+        counts = reresolve(cache, features={'open'})
+        self.assertEqual((counts['skipped'], counts['reprobed'], counts['changed']), (30, 10, 5))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import resolution_cache
+from resolution_cache import ResolutionCache
+
+
+class Clock:
+    """
+    Stand-in for the time module of the cache, whose time only moves when a test says so
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class CacheTest(unittest.TestCase):
+    """
+    Checks the expiry, eviction and keys of the resolution cache, kept in memory unless it has to be opened again
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(resolution_cache, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = ResolutionCache(':memory:', ttl=100, negative_ttl=10, max_entries=100)
+        self.addCleanup(self.cache.close)
+
+    def counted(self):
+        return self.cache.connection.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+
+    def test_found_link_expires_after_its_ttl(self):
+        artists = [{'name': 'Khalid'}]
+        self.cache.put('id1', artists, 'song', 'https://genius.com/khalid-song-lyrics')
+        self.clock.now += 100
+        self.assertEqual(self.cache.get('id1', artists, 'song'), 'https://genius.com/khalid-song-lyrics')
+
+        # both keys of the song are past the ttl, each is removed as it is looked at
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('id1', artists, 'song'))
+        self.assertEqual(self.cache.stats()['expired'], 2)
+        self.assertEqual(self.cache.entries, 0)
+        self.assertEqual(self.counted(), 0)
+
+    def test_missing_link_has_the_shorter_ttl(self):
+        artists = [{'name': 'Khalid'}]
+        self.cache.put('id1', artists, 'song', '')
+        self.clock.now += 10
+        self.assertEqual(self.cache.get('id1', artists, 'song'), '')
+        self.assertEqual(self.cache.stats()['negative_hits'], 1)
+
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('id1', artists, 'song'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_least_recently_used_keys_are_evicted(self):
+        # songs without a track id are stored under their name key only, one key each
+        for num in range(100):
+            self.clock.now += 1
+            self.cache.put(None, [{'name': 'Artist'}], 'song %d' % num, 'link %d' % num)
+        # the oldest song is used again, so the next oldest ones go first
+        self.clock.now += 1
+        self.assertEqual(self.cache.get(None, [{'name': 'Artist'}], 'song 0'), 'link 0')
+        self.clock.now += 1
+        self.cache.put(None, [{'name': 'Artist'}], 'song 100', 'link 100')
+
+        # a fraction of the bound is freed at once instead of one key per put
+        keep = 100 - int(100 * resolution_cache.EVICT_FRACTION)
+        self.assertEqual(self.cache.entries, keep)
+        self.assertEqual(self.counted(), keep)
+        titles = {row[0] for row in self.cache.connection.execute('SELECT title FROM resolutions')}
+        self.assertEqual({'song %d' % num for num in range(101)} - titles, {'song 1', 'song 2'})
+
+    def test_name_key_fallback(self):
+        self.cache.put('id1', [{'name': 'Khalid'}, {'name': 'Swae Lee'}], 'Song', 'link')
+        # another release of the song (a different track id) is found by its artists and title, whatever their case
+        # and surrounding spaces
+        self.assertEqual(self.cache.get('id2', [{'name': 'khalid '}, {'name': 'SWAE LEE'}], ' song'), 'link')
+        # the track id alone is enough, the artists are not needed
+        self.assertEqual(self.cache.get('id1', [], 'anything'), 'link')
+        # the artists are part of the key, as is their order
+        self.assertIsNone(self.cache.get('id2', [{'name': 'Swae Lee'}, {'name': 'Khalid'}], 'song'))
+        self.assertIsNone(self.cache.get(None, [{'name': 'Khalid'}], 'song'))
+
+    def test_entries_count_matches_the_table(self):
+        artists = [{'name': 'Khalid'}]
+        self.cache.put('id1', artists, 'song', 'link')
+        self.assertEqual(self.cache.entries, 2)
+        # writing the same song again replaces its keys, a new track id of it only adds its own key
+        self.cache.put('id1', artists, 'song', 'other link')
+        self.assertEqual(self.cache.entries, 2)
+        self.cache.put('id2', artists, 'song', 'other link')
+        self.assertEqual(self.cache.entries, 3)
+        self.cache.put(None, artists, 'other song', 'link')
+        self.assertEqual(self.cache.entries, 4)
+        self.assertEqual(self.counted(), 4)
+        self.assertEqual(self.cache.stats()['entries'], 4)
+
+    def test_entries_are_counted_on_open(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            cache = ResolutionCache(path)
+            cache.put('id1', [{'name': 'Khalid'}], 'song', 'link')
+            cache.close()
+            cache = ResolutionCache(path)
+            self.assertEqual(cache.entries, 2)
+            cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import genius_link
+from resolution_service import MAX_BODY, ResolutionService
+
+
+class CountingService(ResolutionService):
+    """
+    Service whose resolution is a short wait instead of probing genius, counting how often each song is resolved
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # title -> number of times it was resolved
+        self.resolved = {}
+
+    def resolve_blocking(self, track_id, artists_json, title):
+        self.resolved[title] = self.resolved.get(title, 0) + 1
+        time.sleep(0.2)
+        return '' if title.startswith('missing') else genius_link.GENIUS_URL + title + '-lyrics'
+
+
+class SlowGenius(BaseHTTPRequestHandler):
+    """
+    Local stand-in for genius answering every link with a 200 after a short wait, recording how many requests it was
+    answering at the same time
+    """
+
+    lock = threading.Lock()
+    active = 0
+    most_active = 0
+
+    def do_HEAD(self):
+        with SlowGenius.lock:
+            SlowGenius.active += 1
+            SlowGenius.most_active = max(SlowGenius.most_active, SlowGenius.active)
+        time.sleep(0.05)
+        with SlowGenius.lock:
+            SlowGenius.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RunningService:
+    """
+    Runs a service on its own event loop in the background, the tests talk to it like any client
+    """
+
+    # class of the service being run
+    service_class = ResolutionService
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.service, self.server = self.run_async(self.start())
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.run_async(self.server.wait_closed())
+        self.service.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def start(self):
+        service = self.service_class()
+        return service, await asyncio.start_server(service.connection, '127.0.0.1', 0)
+
+    def run_async(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(10)
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            connection.request(method, path, body=json.dumps(body) if body is not None else None)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def raw_request(self, data):
+        with socket.create_connection(('127.0.0.1', self.port), timeout=10) as client:
+            client.sendall(data)
+            answer = b''
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    return answer
+                answer += chunk
+
+
+class ServiceTest(RunningService, unittest.TestCase):
+    """
+    Checks the http handling and the single-flight coalescing of the resolution service, over real connections
+    """
+
+    service_class = CountingService
+
+    def test_identical_lookups_share_one_resolution(self):
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            answers = list(pool.map(lambda num: self.request('GET', '/resolve?artists=Khalid&title=song'), range(5)))
+        self.assertEqual(answers, [(200, {'url': genius_link.GENIUS_URL + 'song-lyrics', 'found': True})] * 5)
+        self.assertEqual(self.service.resolved, {'song': 1})
+
+        # a song with a link is then answered from memory, a song without one is resolved again
+        self.request('GET', '/resolve?artists=Khalid&title=song')
+        self.assertEqual(self.request('GET', '/resolve?artists=Khalid&title=missing'), (200, {'url': None,
+                                                                                             'found': False}))
+        self.request('GET', '/resolve?artists=Khalid&title=missing')
+        self.assertEqual(self.service.resolved, {'song': 1, 'missing': 2})
+
+    def test_batch(self):
+        status, results = self.request('POST', '/resolve/batch', [
+            {'artists': ['Khalid', 'Swae Lee'], 'title': 'ways'}, {'artists': 'Khalid, Swae Lee', 'title': 'ways'},
+            {'title': 'no artists'}, {'artists': [1], 'title': 'bad artists'}, 'not a song'])
+        self.assertEqual(status, 200)
+        self.assertEqual(results[:2], [{'url': genius_link.GENIUS_URL + 'ways-lyrics', 'found': True}] * 2)
+        self.assertEqual([sorted(result) for result in results[2:]], [['error']] * 3)
+        # both spellings of the artists are the same song, resolved once
+        self.assertEqual(self.service.resolved, {'ways': 1})
+
+    def test_bad_requests(self):
+        self.assertEqual(self.request('POST', '/resolve/batch', {'title': 'x'})[0], 400)
+        self.assertEqual(self.request('POST', '/resolve/batch', [{}] * 501)[0], 413)
+        self.assertEqual(self.request('POST', '/resolve?title=x')[0], 405)
+        self.assertEqual(self.request('GET', '/elsewhere')[0], 404)
+
+    def test_bad_content_length(self):
+        for length in (b'abc', b'-5'):
+            answer = self.raw_request(b'POST /resolve/batch HTTP/1.1\r\nContent-Length: ' + length + b'\r\n\r\n[]')
+            # the end of the body is not known, so the connection is closed after the answer
+            self.assertTrue(answer.startswith(b'HTTP/1.1 400 '), answer)
+            self.assertIn(b'Connection: close', answer)
+
+    def test_oversize_body(self):
+        # the body is refused from its length alone, without being read
+        answer = self.raw_request(b'POST /resolve/batch HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (MAX_BODY + 1))
+        self.assertTrue(answer.startswith(b'HTTP/1.1 413 '), answer)
+        self.assertIn(b'Connection: close', answer)
+
+
+class ProbeBoundTest(RunningService, unittest.TestCase):
+    """
+    Checks the requests sent to genius stay within the shared probe threads however many songs are resolved at once
+    """
+
+    def setUp(self):
+        self.genius = ThreadingHTTPServer(('127.0.0.1', 0), SlowGenius)
+        threading.Thread(target=self.genius.serve_forever, daemon=True).start()
+        self.genius_url = genius_link.GENIUS_URL
+        genius_link.GENIUS_URL = 'http://127.0.0.1:%d/' % self.genius.server_address[1]
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        genius_link.GENIUS_URL = self.genius_url
+        self.genius.shutdown()
+        self.genius.server_close()
+
+    def test_probes_are_bounded(self):
+        # 16 songs of 4 candidate links each, resolved 8 at a time, would send 32 requests at once without the bound
+        SlowGenius.most_active = 0
+        songs = [{'artists': ['A%d' % num, 'B'], 'title': 'Song %d (Live) / Other' % num} for num in range(16)]
+        status, results = self.request('POST', '/resolve/batch', songs)
+        self.assertEqual(status, 200)
+        self.assertTrue(all(result['found'] for result in results))
+        self.assertLessEqual(SlowGenius.most_active, genius_link.PROBE_CONCURRENCY)
+
+
+if __name__ == '__main__':
+    unittest.main()